@@ -11,112 +11,190 @@
 
 # ============== IMPORTS =============================================
 import pathlib
-import os, urllib, ssl
+import os, ssl
+import math
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.merge import merge
 import geopandas as gpd
 
-def main():
+import cache
+import profiling
+import sidecar
 
-    # ================= SETTINGS =========================================
-    # specify directory (volume conected via docker)
-    directory = ''
-    # specify AOI in the form of a shapefile
-    shpName = 'aoi.shp'
+# ================= FUNCTIONS =========================================
 
-    # ================= MAIN PROGRAM ======================================
-    volume = pathlib.Path(directory)
-    shp_file_path = volume / pathlib.Path(shpName)
+# ArcGIS Configuration parameteres (settings)
+ArcGISserver = {"url": os.environ.get('ARCGIS_URL', "https://image.discomap.eea.europa.eu"),  # Image server
+                "bboxSR": 3035,  # bbox CRS
+                "imageSR": 3035,  # exported image CRS
+                "maxPixels": 4000,  # ARCGIS REST service has a limit of 4000 pixels per side
+                "tilePixels": 1000,  # size of the (cached) request tiles, must be <= maxPixels
+                "Imperviousness2018": "GioLandPublic/HRL_ImperviousnessDensity_2018/ImageServer"
+                }
 
-    # open shapefile with geopandas
-    shapefile = gpd.read_file(str(shp_file_path))
-    # transform to EPSG:4326 CRS because that's what OSM uses
-    shapefile_transformed = shapefile.to_crs(epsg=3035)
 
-    # get the bounding box in EPSG:3035 (for meters)
-    bboxArray = shapefile_transformed.total_bounds
+def tile_grid(xmin, ymin, xmax, ymax, pixelSize, tilePixels):
+    """Split a bounding box into tiles of ``tilePixels`` x ``tilePixels`` pixels at ``pixelSize``.
+    Tiles lie on a fixed grid anchored at the CRS origin, so overlapping AOIs request (and cache)
+    identical tiles and all tiles mosaic without resampling.
+    Returns a list of (xmin, ymin, xmax, ymax, width, height) tuples."""
+    span = tilePixels * pixelSize
 
-    # create area string from bounding box to pass in WMS query
-    # Left, bottom, right, top
-    boundingBox = (bboxArray[0],bboxArray[1],bboxArray[2],bboxArray[3])
+    tiles = []
+    for row in range(int(math.floor(ymin / span)), int(math.ceil(ymax / span))):
+        for col in range(int(math.floor(xmin / span)), int(math.ceil(xmax / span))):
+            tiles.append((col * span, row * span, (col + 1) * span, (row + 1) * span,
+                          tilePixels, tilePixels))
+    return tiles
 
-    ########################################
 
-    # download from ArcGIS rest services WMS
+def snap_bounds(xmin, ymin, xmax, ymax, pixelSize):
+    """Expand a bounding box outwards to the ``pixelSize`` grid"""
+    return (math.floor(xmin / pixelSize) * pixelSize, math.floor(ymin / pixelSize) * pixelSize,
+            math.ceil(xmax / pixelSize) * pixelSize, math.ceil(ymax / pixelSize) * pixelSize)
 
-    # https://image.discomap.eea.europa.eu/arcgis/rest/services/GioLandPublic/HRL_ImperviousnessDensity_2018/ImageServer
-    # https://image.discomap.eea.europa.eu/arcgis/rest/services/Corine/CLC2018_WM/MapServer
 
+def get_shape_from_rest(session, xmin, ymin, xmax, ymax, width, height, service_name, tileCache=None):
+    """Request one exportImage tile from the ArcGIS REST service and return the GeoTIFF bytes.
+    Tiles already in ``tileCache`` are returned without a request."""
 
-    if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
-        getattr(ssl, '_create_unverified_context', None)):
-        ssl._create_default_https_context = ssl._create_unverified_context
-
-    # ArcGIS Configuration parameteres (settings)
-    ArcGISserver = {"url": "https://image.discomap.eea.europa.eu",  # Image server
-                    "bboxSR": 3035,  # bbox CRS
-                    "imageSR": 3035,  # exported image CRS
-                    "Imperviousness2018": "GioLandPublic/HRL_ImperviousnessDensity_2018/ImageServer"
-                    }
-
-    def get_shape_from_rest(xmin, ymin, xmax, ymax, pixelSize, filename, service_name):
-
-        # ARCGIS REST service has a limit of 4000 pixels. If pixelSize requires more than 4000 pixels, lower the resolution
-        width = round((xmax-xmin)/pixelSize)
-        height = round((ymax-ymin)/pixelSize)
-        if ((width > 4000) or (height > 4000)):
-            pixelSize = 20  # try for 20m pixel size
-            width = round((xmax - xmin) / pixelSize)
-            height = round((ymax - ymin) / pixelSize)
-            print("Changed pixel size from 10m to 20m because of WMS request size limitation ...")
-            if ((width > 4000) or (height > 4000)):
-                pixelSize = 30  # try for 30m pixel size
-                width = round((xmax - xmin) / pixelSize)
-                height = round((ymax - ymin) / pixelSize)
-                print("Changed pixel size from 10m to 30m because of WMS request size limitation ...")
-                if ((width > 4000) or (height > 4000)):
-                    # UN instructions require pixel size <= 30m (Landsat imagery equivalent)
-                    print("ERROR: Area is too large for WMS request. Choose a smaller area.")
-                    return
-
-        # Parameters
-        ArcGIS_server_url = ArcGISserver['url']
-        Servicename = ArcGISserver[service_name]
-        bboxSR = ArcGISserver['bboxSR']
-        widthpixels = width
-        heightpixels = height
-        imageSR = ArcGISserver['imageSR']
-
-        # secured url
-        url = ArcGIS_server_url + '/arcgis/rest/services/' + Servicename + '/exportImage?'
-
-        params = "bbox=" + str(xmin) + "%2C" + str(ymin) + "%2C" + str(xmax) + "%2C" + str(ymax) + "&bboxSR=" + str(bboxSR) \
-                 + "&size=" + str(widthpixels) + "%2C" + str(heightpixels) + "&imageSR=" + str(imageSR) + \
-                 "&time=&format=tiff&pixelType=UNKNOWN&noData=&noDataInterpretation=esriNoDataMatchAny&interpolation=+RSP_BilinearInterpolation&compression=&compressionQuality=&bandIds=&mosaicRule=&renderingRule=&f=image"
-
-        response = urllib.request.urlopen(url+params)
+    # Parameters
+    ArcGIS_server_url = ArcGISserver['url']
+    Servicename = ArcGISserver[service_name]
+    bboxSR = ArcGISserver['bboxSR']
+    imageSR = ArcGISserver['imageSR']
+
+    # secured url
+    url = ArcGIS_server_url + '/arcgis/rest/services/' + Servicename + '/exportImage?'
+
+    params = "bbox=" + str(xmin) + "%2C" + str(ymin) + "%2C" + str(xmax) + "%2C" + str(ymax) + "&bboxSR=" + str(bboxSR) \
+             + "&size=" + str(width) + "%2C" + str(height) + "&imageSR=" + str(imageSR) + \
+             "&time=&format=tiff&pixelType=UNKNOWN&noData=&noDataInterpretation=esriNoDataMatchAny&interpolation=+RSP_BilinearInterpolation&compression=&compressionQuality=&bandIds=&mosaicRule=&renderingRule=&f=image"
+
+    def download():
+        response = session.get(url + params)
 
         #Check service status
-        if response.status != 200:
+        if response.status_code != 200:
             warnings.warn("Server is not responding")
-            # return status 0 - server error
-            status = 0
-            return (status)
+            response.raise_for_status()
+
+        profiling.add_downloaded(len(response.content))
+        return response.content
+
+    if tileCache is None:
+        return download()
+    key = tileCache.key(url=url, bbox=[xmin, ymin, xmax, ymax], bboxSR=bboxSR, size=[width, height], imageSR=imageSR)
+    return tileCache.fetch(key, download)
+
+
+def get_tiled_from_rest(xmin, ymin, xmax, ymax, pixelSize, service_name, maxWorkers=4):
+    """Download the bbox at ``pixelSize`` as a set of tiles within the service pixel limit, fetched
+    concurrently over a pooled HTTP session (or from the download cache), and mosaic them.
+    Returns the mosaic (bands, rows, cols) and its GeoTIFF metadata."""
+
+    bounds = snap_bounds(xmin, ymin, xmax, ymax, pixelSize)
+    tilePixels = min(ArcGISserver['tilePixels'], ArcGISserver['maxPixels'])
+    tiles = tile_grid(bounds[0], bounds[1], bounds[2], bounds[3], pixelSize, tilePixels)
+    tileCache = cache.default_cache()
+    print("Requesting {n} tile(s) at {p}m pixel size ...".format(n=len(tiles), p=pixelSize))
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxWorkers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # keep the behaviour of the unverified default https context unless PYTHONHTTPSVERIFY is set
+    if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
+        getattr(ssl, '_create_unverified_context', None)):
+        session.verify = False
+
+    def fetch(tile):
+        return get_shape_from_rest(session, tile[0], tile[1], tile[2], tile[3], tile[4], tile[5], service_name,
+                                   tileCache)
+
+    with profiling.stage('fetch'):
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            responses = list(executor.map(fetch, tiles))
+    session.close()
+
+    # mosaic tiles on the common pixel grid and crop to the AOI bbox
+    with profiling.stage('mosaic'):
+        memfiles = [MemoryFile(r) for r in responses]
+        datasets = [m.open() for m in memfiles]
+        mosaic, out_transform = merge(datasets, bounds=bounds, res=pixelSize)
 
-        ResponseObj = response.read()
+    out_meta = datasets[0].meta.copy()
+    out_meta.update({"driver": "GTiff", "height": mosaic.shape[1], "width": mosaic.shape[2],
+                     "transform": out_transform})
 
-        out = open(str(directory / pathlib.Path(filename + '.tif')), "wb")
-        out.write(ResponseObj)
-        out.close()
+    for d, m in zip(datasets, memfiles):
+        d.close()
+        m.close()
+
+    return mosaic, out_meta
+
+
+def download_hrl(aoi, pixelSize=10, maxWorkers=4):
+    """Get HRL Imperviousness 2018 for the bounding box of the ``aoi`` GeoDataFrame.
+    Returns the band array and its profile."""
+
+    # transform to EPSG:3035 CRS (HRL projection)
+    shapefile_transformed = aoi.to_crs(epsg=3035)
+
+    # get the bounding box in EPSG:3035 (for meters)
+    bboxArray = shapefile_transformed.total_bounds
+
+    ########################################
+
+    # download from ArcGIS rest services WMS
+
+    # https://image.discomap.eea.europa.eu/arcgis/rest/services/GioLandPublic/HRL_ImperviousnessDensity_2018/ImageServer
+    # https://image.discomap.eea.europa.eu/arcgis/rest/services/Corine/CLC2018_WM/MapServer
 
     print("Getting HRL Imperviousness 2018 from WMS for ΑΟΙ ...")
 
     # run the function to get Imperviousness density 2018 for the AOI
-    # TAKE 20m SPATIAL RESOLUTION INSTEAD OF 10m BECAUSE OTHERWISE WMS CRASHES FOR LARGE AREAS (4000 PIXEL LIMIT)
-    get_shape_from_rest(bboxArray[0], bboxArray[1], bboxArray[2], bboxArray[3], 10, "1-HRL_AOI", "Imperviousness2018")
+    # large AOIs are split in tiles of <=4000 pixels (WMS request size limit), so the resolution stays at 10m
+    mosaic, out_meta = get_tiled_from_rest(bboxArray[0], bboxArray[1], bboxArray[2], bboxArray[3], pixelSize,
+                                           "Imperviousness2018", maxWorkers)
 
     print("done.")
 
+    return mosaic[0], out_meta
+
+
+def main():
+
+    # ================= SETTINGS =========================================
+    # specify directory (volume conected via docker)
+    directory = ''
+    # specify AOI in the form of a shapefile
+    shpName = 'aoi.shp'
+    # HRL pixel size in meters (UN instructions require pixel size <= 30m)
+    pixelSize = 10
+    # number of tiles requested concurrently
+    maxWorkers = 4
+
+    # ================= MAIN PROGRAM ======================================
+    volume = pathlib.Path(directory)
+    shp_file_path = volume / pathlib.Path(shpName)
+
+    # open shapefile with geopandas
+    shapefile = gpd.read_file(str(shp_file_path))
+
+    hrl, profile = download_hrl(shapefile, pixelSize, maxWorkers)
+
+    with rasterio.open(str(volume / pathlib.Path("1-HRL_AOI.tif")), "w", **profile) as dest:
+        dest.write_band(1, hrl)
+    # memory-mappable copy for 2_City_Area.py
+    sidecar.save(volume / pathlib.Path("1-HRL_AOI.tif"), hrl)
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.script('0_Download_data'):
+        main()
@@ -9,124 +9,152 @@
 
 
 # ============== IMPORTS =============================================
+import os
 import pathlib
 import requests
 
-import ogr, osr, gdal
 import rasterio.mask
+import rasterio.features
 import geopandas as gpd
+import shapely.geometry
+
+import cache
+import profiling
+import raster_windows
+import sidecar
 
 # ================= FUNCTIONS =========================================
 def getFeatures(gdf):
-    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
+    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them
+    (the geometries of all features)"""
     import json
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
+    return [feature['geometry'] for feature in json.loads(gdf.to_json())['features']]
 
 
-def main():
+def download_to_file(url, f, chunkSize=1024*1024):
+    """Stream the response body of ``url`` into the open binary file ``f`` in chunks"""
+    r = requests.get(url, stream=True)
+    r.raise_for_status()
+    for chunk in r.iter_content(chunk_size=chunkSize):
+        profiling.add_downloaded(len(chunk))
+        f.write(chunk)
+    r.close()
 
-    # ================= SETTINGS =========================================
 
-    # specify directory (volume conected via docker)
-    directory = ''
-    # specify AOI in the form of a shapefile
-    shpName = 'aoi.shp'
-    # set CLC file name
-    CLC_fileName = 'CLC2018_1,2,3,10,11.tif'  # made by NV. Only contains urban classes (1,2,3,10,11)
+def clip_window(raster, shapes):
+    """Read only the window of ``raster`` covering the bounds of ``shapes``
+    and set the pixels outside ``shapes`` to nodata (as rasterio.mask.mask does).
+    Returns the clipped array (bands, rows, cols) and its transform."""
+    window = raster_windows.aoi_window(shapes, raster.transform, raster.width, raster.height)
 
-    # ================= MAIN PROGRAM ======================================
+    out_img = raster.read(window=window)
+    out_transform = raster.window_transform(window)
 
-    volume = pathlib.Path(directory)
-    shp_file_path = volume / pathlib.Path(shpName)
+    outside = rasterio.features.geometry_mask(shapes, out_shape=out_img.shape[1:], transform=out_transform)
+    out_img[:, outside] = raster.nodata if raster.nodata is not None else 0
+
+    return out_img, out_transform
+
+
+def clc_source(volume, CLC_fileName, CLC_path=''):
+    """Path of the CLC raster: ``CLC_path`` when given (a local copy, VRT or COG read in place),
+    otherwise the CLC edited image downloaded into (or reused from) the download cache"""
+    if CLC_path:
+        return CLC_path
 
-    # download the CLC edited image
+    # download the CLC edited image (or reuse it from the download cache)
+    # the body is streamed to disk in chunks instead of being held in memory
     url = 'https://github.com/n-verde/GeoEssential_11.7.1_AUTH/raw/master/CLC2018_1%2C2%2C3%2C10%2C11.tif'
-    r = requests.get(url)
-    with open(str(volume / pathlib.Path(CLC_fileName)), 'wb') as f:
-        f.write(r.content)
-    clc_path = pathlib.Path(CLC_fileName)
+    clcCache = cache.default_cache()
+    clcKey = clcCache.key(url=url)
+    clc_path = clcCache.get(clcKey)
+    if clc_path is None:
+        with profiling.stage('download'):
+            if clcCache.enabled:
+                with clcCache.writer(clcKey) as f:
+                    download_to_file(url, f)
+                clc_path = clcCache.get(clcKey)
+            # without the cache, or if a concurrent process already evicted the entry, the image is
+            # downloaded to the working directory
+            if clc_path is None:
+                clc_path = volume / pathlib.Path(CLC_fileName)
+                with open(str(clc_path), 'wb') as f:
+                    download_to_file(url, f)
+    return str(clc_path)
+
+
+def clip_clc(aoi, clc_path):
+    """Clip the CLC raster at ``clc_path`` to (all the features of) the ``aoi`` GeoDataFrame.
+    Returns the band array and its profile, or None if the AOI does not intersect CLC."""
 
     # ---------- CLC ----------
     print('Check if CLC intersects with AOI ...')
 
+    raster = rasterio.open(str(clc_path))
+    raster_crs = raster.crs
+
     # make sure AOI shapefile intersects CLC layer
-    # create empty list to save intersecting rasters
-    intersectingRasters = []
-
-    item = clc_path
-    raster = gdal.Open(str(item))
-
-    # Get raster geometry
-    transform = raster.GetGeoTransform()
-    pixelWidth = transform[1]
-    pixelHeight = transform[5]
-    cols = raster.RasterXSize
-    rows = raster.RasterYSize
-
-    # create geometry out of raster bounds
-    xLeft = transform[0]
-    yTop = transform[3]
-    xRight = xLeft + cols * pixelWidth
-    yBottom = yTop+rows*pixelHeight
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(xLeft, yTop)
-    ring.AddPoint(xLeft, yBottom)
-    ring.AddPoint(xRight, yBottom)
-    ring.AddPoint(xRight, yTop)
-    ring.AddPoint(xLeft, yTop)
-    rasterGeometry = ogr.Geometry(ogr.wkbPolygon)
-    rasterGeometry.AddGeometry(ring)
-
-    # read shapefile & get geometry & CRS
-    vector = ogr.Open(str(shp_file_path))
-    layer = vector.GetLayer()
-    feature = layer.GetFeature(0)
-    sourceprj = layer.GetSpatialRef()
-
-    # get raster CRS & set crs transformation (to transform vector to raster crs)
-    targetprj = osr.SpatialReference(wkt=raster.GetProjection())
-    transform = osr.CoordinateTransformation(sourceprj, targetprj)
-
-    # transform vector crs
-    transformedVect = feature.GetGeometryRef()
-    transformedVect.Transform(transform)
-
-    # test raster for intersection with vector and save path
-    if (rasterGeometry.Intersects(transformedVect)):
+    # reproject to raster crs
+    shapefile_reproj = aoi.to_crs(raster_crs.to_wkt())
+
+    # create geometry out of raster bounds & test raster for intersection with vector
+    rasterGeometry = shapely.geometry.box(*raster.bounds)
+    if shapefile_reproj.geometry.intersects(rasterGeometry).any():
         print("AOI intersects with CLC ...")
-        intersectingRasters.append(str(item))
     else:
         print("ERROR - AOI does not intersect with Corine Land Cover!")
+        return None
 
     print("Clipping CLC to AOI...")
 
-    # clip CLC to AOI
-    if len(intersectingRasters)>0:
-        for i in range(len(intersectingRasters)):  # loop through items in dir
-            rasterPath = intersectingRasters[i]
-            raster = rasterio.open(rasterPath)
-            raster_crs = raster.crs
+    # get the geometry coordinates
+    coords = getFeatures(shapefile_reproj)
 
-            # open shapefile with geopandas
-            shapefile = gpd.read_file(str(shp_file_path))
-            shapefile_crs = shapefile.crs
+    # clip CLC, reading only the window covering the AOI
+    out_meta = raster.meta.copy()  # Copy the metadata
+    with profiling.stage('clip'):
+        out_img, out_transform = clip_window(raster, coords)
+    out_meta.update({"driver": "GTiff", "height": out_img.shape[1], "width": out_img.shape[2],
+                     "transform": out_transform})
+    raster.close()
 
-            # reproject to raster crs
-            shapefile_reproj = shapefile.to_crs(epsg=str(raster_crs['init'])[5:])
+    print("done.")
 
-            # get the geometry coordinates
-            coords = getFeatures(shapefile_reproj)
+    return out_img[0], out_meta
 
-            # clip CLC
-            out_meta = raster.meta.copy()  # Copy the metadata
-            epsg_code = int(raster.crs.data['init'][5:])  # Parse EPSG code
-            out_img, out_transform = rasterio.mask.mask(raster, coords, crop=True)
-            out_meta.update({"driver": "GTiff", "height": out_img.shape[1], "width": out_img.shape[2],
-                             "transform": out_transform})
-            with rasterio.open(str(volume / '2-CLC_AOI.tif'), "w", **out_meta) as dest:  # replace file with clipped one
-                dest.write(out_img)
 
-    print("done.")
+def main():
+
+    # ================= SETTINGS =========================================
+
+    # specify directory (volume conected via docker)
+    directory = ''
+    # specify AOI in the form of a shapefile
+    shpName = 'aoi.shp'
+    # set CLC file name
+    CLC_fileName = 'CLC2018_1,2,3,10,11.tif'  # made by NV. Only contains urban classes (1,2,3,10,11)
+    # optional CLC source that is read in place: a local copy, a VRT or a Cloud-Optimized GeoTIFF
+    # (e.g. /vsicurl/https://...). When empty, the CLC image is downloaded (and cached)
+    CLC_path = os.environ.get('CLC_PATH', '')
+
+    # ================= MAIN PROGRAM ======================================
+
+    volume = pathlib.Path(directory)
+    shp_file_path = volume / pathlib.Path(shpName)
+
+    clc_path = clc_source(volume, CLC_fileName, CLC_path)
+
+    # open shapefile with geopandas
+    shapefile = gpd.read_file(str(shp_file_path))
+
+    clc = clip_clc(shapefile, clc_path)
+
+    if clc is not None:
+        with rasterio.open(str(volume / '2-CLC_AOI.tif'), "w", **clc[1]) as dest:  # replace file with clipped one
+            dest.write_band(1, clc[0])
+        # memory-mappable copy for 2_City_Area.py
+        sidecar.save(volume / '2-CLC_AOI.tif', clc[0])
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.script('1_CLC_Clip'):
+        main()
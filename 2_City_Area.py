@@ -12,20 +12,31 @@
 # https://github.com/Ciaran1981/geospatial-learn/blob/b4c62705e0f9f6a69698109a49d4d2589d3c2e64/geospatial_learn/raster.py
 
 # ============== IMPORTS =============================================
+import os
 import pathlib
-import copy
 import sys
 
 import numpy as np
-import math
 import rasterio
-from rasterio.mask import mask
+import rasterio.features
+import rasterio.windows
+import rasterio.warp
+from rasterio.windows import Window
+from rasterio.vrt import WarpedVRT
 import gdal
-import cv2
-from scipy.ndimage import convolve
 import ogr
 import osr
 import geopandas as gpd
+import shapely.geometry
+from shapely.ops import unary_union
+from scipy import ndimage
+
+import cpus
+import neighbourhood
+import profiling
+import raster_windows
+import sidecar
+import urbanness_tiles
 
 # ================= FUNCTIONS =========================================
 
@@ -39,7 +50,10 @@ def raster2array(geotif_file):
     noDataValue = dataset.nodatavals
 
     if bands == 1:
-        raster = dataset.read(1)
+        # map the .npy sidecar written with the raster (see sidecar.py) instead of copying the band
+        raster = sidecar.load(geotif_file, (dataset.height, dataset.width), dataset.dtypes[0])
+        if raster is None:
+            raster = dataset.read(1)
 
         # raster = raster[::-1] #inverse array because Python is column major
         return raster, profile
@@ -48,67 +62,14 @@ def raster2array(geotif_file):
         print('More than one band ... need to modify function for case of multiple bands')
 
 
-def reproject_image_to_master (master,slave):
-    """This function reprojects an image (``slave``) to
-    match the extent, resolution and projection of another
-    (``master``) using GDAL. The newly reprojected image
-    is a GDAL VRT file for efficiency. A different spatial
-    resolution can be chosen by specifyign the optional
-    ``res`` parameter. The function returns the new file's
-    name.
-    Parameters
-    -------------
-    master: str
-        A filename (with full path if required) with the
-        master image (that that will be taken as a reference)
-    slave: str
-        A filename (with path if needed) with the image
-        that will be reprojected
-    res: float, optional
-        The desired output spatial resolution, if different
-        to the one in ``master``.
-    Returns
-    ----------
-    The reprojected filename
-    """
-    slave_ds = gdal.Open(slave)
-    slave_proj = slave_ds.GetProjection()
-    data_type = slave_ds.GetRasterBand(1).DataType
-    n_bands = slave_ds.RasterCount
-
-    master_ds = gdal.Open(master)
-    master_proj = master_ds.GetProjection()
-    master_geotrans = master_ds.GetGeoTransform()
-    w = master_ds.RasterXSize
-    h = master_ds.RasterYSize
-
-    dst_filename = slave.replace( ".tif", "_resampled.tif" )
-    dst_ds = gdal.GetDriverByName('GTiff').Create(dst_filename,
-                                                w, h, n_bands, data_type)
-    dst_ds.SetGeoTransform(master_geotrans)
-    dst_ds.SetProjection(master_proj)
-
-    gdal.ReprojectImage(slave_ds, dst_ds, slave_proj,
-                         master_proj, gdal.GRA_NearestNeighbour)
-
-    message = "reprojected CLC to match HRL"
-
-    return message
-
-
-def rescaleToUnint8(im):
-    min = np.amin(im)
-    max = np.amax(im)
-
-    if (min < 0):  # if image contains negative values, turn to positive
-        im = np.add(im, abs(min))
-        max = max + abs(min)  # also change new max
-    np.float32(im)
-    norm = np.divide(im, max)  # normalize data to 0-1
-    scaled = np.multiply(norm, 255)  # now scale to 255
-    rescaled = np.uint8(scaled)
-
-    return rescaled
+def warped_to_master(dataset, master_profile):
+    """Resample an open rasterio ``dataset`` on the fly to the extent, resolution and projection
+    of ``master_profile`` (nearest neighbour), as a WarpedVRT: nothing is written to disk and
+    windows of the master grid can be read from it like from any dataset. Pixels outside
+    ``dataset`` are 0."""
+    return WarpedVRT(dataset, crs=master_profile['crs'], transform=master_profile['transform'],
+                     width=master_profile['width'], height=master_profile['height'],
+                     nodata=0, resampling=rasterio.warp.Resampling.nearest)
 
 
 def polygonize(inRas, outPoly, outField=None, mask=True, band=1, filetype="ESRI Shapefile"):
@@ -183,66 +144,243 @@ def polygonize(inRas, outPoly, outField=None, mask=True, band=1, filetype="ESRI
     dst_ds = None
 
 def getFeatures(gdf):
-    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
+    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them
+    (the geometries of all features)"""
     import json
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
-
-def main():
-
-    # ================= SETTINGS =========================================
-    # specify directory (volume conected via docker)
-    directory = ''
-    # specify AOI in the form of a shapefile
-    shpName = 'aoi.shp'
-    # specify HRL imperviousness mosaicked + clipped layer (to AOI)
-    hrlName = '1-HRL_AOI.tif'
-    # specify CLC clipped layer (to AOI)
-    clcName = '2-CLC_AOI.tif'
-
-    # ================= MAIN PROGRAM ======================================
-    volume = pathlib.Path(directory)
-    shp_file_path = volume / pathlib.Path(shpName)
-    hrl_path = volume / pathlib.Path(hrlName)
-    clc_path = volume / pathlib.Path(clcName)
+    return [feature['geometry'] for feature in json.loads(gdf.to_json())['features']]
+
+def urban_classes(clc):
+    """Mask (with 0) CLC classes that are not of interest, keep classes 1,2,3,10,11"""
+    if clc.dtype.itemsize == 1:
+        # one lookup in a 256-entry table instead of full-size masks and temporaries
+        values = np.arange(256, dtype=np.uint8).view(clc.dtype)
+        lut = np.where((values<=3) | (values==10) | (values==11), values, 0).astype(clc.dtype)
+        return lut[clc.view(np.uint8)]
+    clc_urban = np.where((clc<=3),clc,0)
+    clc_urban = np.where((clc==10),clc,clc_urban)
+    clc_urban = np.where((clc==11),clc,clc_urban)
+    return clc_urban
+
+def builtup_mask(clc_res, hrl, out=None):
+    """Binary (uint8) built-up mask: HRL imperviousness inside CLC urban areas.
+    Written to ``out`` (a uint8 array, may be ``clc_res`` itself) if given."""
+    mask = np.logical_and(clc_res, hrl, out=None if out is None else out.view(bool))
+    return mask.view(np.uint8)
+
+def urbanness_classes(c, kernelSize):
+    """Degree of urban-ness of every pixel from its neighbourhood sum ``c`` (UN rule), in one uint8 array:
+    2 urban (>=50% of the kernel built-up), 1 suburban (>=25% and <50%), 0 rural (<25%)"""
+    # eg. in the binary built-up image, 100% built-up means neighborhood sum for each pixel = 2500
+    #       >=25% means sum 2500/4 >= 625, >=50% means sum 2500/2 >= 1250
+    perc100 = kernelSize*kernelSize
+    classes = np.greater_equal(c, int(round(perc100/4))).view(np.uint8)
+    classes += c >= int(round(perc100/2))
+    return classes
+
+def read_rows(dataset, row, rows):
+    """Read rows ``row:row+rows`` of band 1 of an open rasterio dataset"""
+    return dataset.read(1, window=Window(0, row, dataset.width, rows))
+
+def clip_blocks(src_path, dst_path, shapes, blockRows):
+    """Block-wise equivalent of rasterio.mask.mask(crop=True): copy the window of ``src_path`` covering
+    ``shapes`` to ``dst_path``, ``blockRows`` rows at a time, setting pixels outside ``shapes`` to nodata"""
+    with rasterio.open(src_path) as src:
+        window = raster_windows.aoi_window(shapes, src.transform, src.width, src.height)
+        col_off, row_off = int(window.col_off), int(window.row_off)
+        width, height = int(window.width), int(window.height)
+
+        out_meta = src.meta.copy()
+        out_meta.update({"driver": "GTiff", "height": height, "width": width,
+                         "transform": src.window_transform(window)})
+        fill = src.nodata if src.nodata is not None else 0
+        with rasterio.open(dst_path, "w", **out_meta) as dst:
+            for row, rows, _, _ in neighbourhood.row_blocks(height, blockRows):
+                block_window = Window(col_off, row_off + row, width, rows)
+                block = src.read(window=block_window)
+                outside = rasterio.features.geometry_mask(shapes, out_shape=block.shape[1:],
+                                                          transform=src.window_transform(block_window))
+                block[:, outside] = fill
+                dst.write(block, window=Window(0, row, width, rows))
+
+def reproject_array_to_master(array, profile, master_profile):
+    """In-memory counterpart of ``warped_to_master``: resample ``array`` (with ``profile``)
+    to the grid of ``master_profile`` with nearest neighbour (GDAL warper on MEM datasets)"""
+    out = np.zeros((master_profile['height'], master_profile['width']), array.dtype)
+    rasterio.warp.reproject(array, out,
+                            src_transform=profile['transform'], src_crs=profile['crs'], src_nodata=profile.get('nodata'),
+                            dst_transform=master_profile['transform'], dst_crs=master_profile['crs'], dst_nodata=0,
+                            resampling=rasterio.warp.Resampling.nearest)
+    return out
+
+def clip_array(array, profile, shapes):
+    """In-memory equivalent of rasterio.mask.mask(crop=True) for a single band ``array`` with ``profile``.
+    Returns the clipped array and its profile."""
+    window = raster_windows.aoi_window(shapes, profile['transform'], profile['width'], profile['height'])
+
+    out_img = array[window.toslices()].copy()
+    out_transform = rasterio.windows.transform(window, profile['transform'])
+    outside = rasterio.features.geometry_mask(shapes, out_shape=out_img.shape, transform=out_transform)
+    out_img[outside] = profile['nodata'] if profile.get('nodata') is not None else 0
+
+    out_profile = profile.copy()
+    out_profile.update({"driver": "GTiff", "height": out_img.shape[0], "width": out_img.shape[1],
+                        "transform": out_transform})
+    return out_img, out_profile
+
+def label_components(mask, connectivity=4):
+    """Label the connected components of the non-zero pixels of ``mask`` (1...n, 0 is background),
+    with 4- (edges) or 8-connectivity (edges and corners). Returns the labels and n."""
+    structure = ndimage.generate_binary_structure(2, 1 if connectivity == 4 else 2)
+    return ndimage.label(mask, structure=structure)
+
+def select_components(counts, pixelArea, minClusterAreaKm2=None):
+    """Labels of the urban clusters among the components with pixel ``counts`` (index 0 is background):
+    all components of at least ``minClusterAreaKm2``, or only the largest one if ``minClusterAreaKm2``
+    is None (or none is large enough). Returns the labels, largest component first."""
+    order = np.argsort(-counts[1:], kind='stable') + 1
+    order = order[counts[order] > 0]
+    if len(order) == 0:
+        raise ValueError("No urban cluster found in AOI")
+    if minClusterAreaKm2 is not None:
+        keep = order[counts[order] * pixelArea >= minClusterAreaKm2 * 1000 * 1000]
+        if len(keep):
+            return keep
+        print("No urban cluster of at least {a} km2, keeping the largest one".format(a=minClusterAreaKm2))
+    return order[:1]
+
+def _find(parent, a):
+    """Root of label ``a`` in the union-find forest ``parent`` (with path halving)"""
+    while parent[a] != a:
+        parent[a] = parent[parent[a]]
+        a = parent[a]
+    return a
+
+def border_pairs(above, below, connectivity=4):
+    """Unique pairs of labels of the last row of a block (``above``) and the first row of the next
+    block (``below``) that touch, i.e. belong to the same component"""
+    pairs = [np.column_stack((above, below))]
+    if connectivity == 8:
+        pairs.append(np.column_stack((above[:-1], below[1:])))
+        pairs.append(np.column_stack((above[1:], below[:-1])))
+    pairs = np.concatenate(pairs)
+    pairs = pairs[(pairs[:, 0] > 0) & (pairs[:, 1] > 0)]
+    return np.unique(pairs, axis=0)
+
+def label_blocks(read, height, blockRows, connectivity=4):
+    """Block-wise ``label_components``: ``read(row, rows)`` returns rows ``row:row+rows`` of the mask.
+    Each block is labelled on its own (labels offset by the labels of the blocks above) and labels
+    touching across block borders are merged. Returns the offset of each block, the component (root
+    label) of every block label and the pixel count of every component (indexed by root label)."""
+    parent = np.zeros(1, np.int64)
+    counts = np.zeros(1, np.int64)
+    offsets = []
+    last = None
+    for row, rows, _, _ in neighbourhood.row_blocks(height, blockRows):
+        labels, n = label_components(read(row, rows), connectivity)
+        offset = len(parent) - 1
+        offsets.append(offset)
+        labels[labels > 0] += offset
+        parent = np.concatenate((parent, np.arange(offset + 1, offset + n + 1)))
+        counts = np.concatenate((counts, np.bincount(labels.ravel(), minlength=offset + n + 1)[offset + 1:]))
+        if last is not None:
+            for a, b in border_pairs(last, labels[0], connectivity):
+                ra, rb = _find(parent, a), _find(parent, b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+        last = labels[-1]
+
+    # point every label to its root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    return offsets, parent, np.bincount(parent, weights=counts, minlength=len(parent)).astype(np.int64)
+
+def cluster_id_blocks(read, height, blockRows, offsets, roots, keep, connectivity=4):
+    """Raster of the urban cluster numbers (1 for ``keep[0]``, 2 for ``keep[1]``, ...), 0 elsewhere, from the
+    block labels of ``label_blocks`` (recomputed for each block). Yields (row, numbers) for consecutive blocks."""
+    dtype = cluster_dtype(len(keep))
+    numbers = np.zeros(len(roots), dtype)
+    numbers[keep] = np.arange(1, len(keep) + 1, dtype=dtype)
+    lut = numbers[roots]
+    for (row, rows, _, _), offset in zip(neighbourhood.row_blocks(height, blockRows), offsets):
+        labels, n = label_components(read(row, rows), connectivity)
+        labels[labels > 0] += offset
+        yield row, lut[labels]
+
+def cluster_ids(mask, pixelArea, minClusterAreaKm2=None, connectivity=4, blockPixels=1 << 16):
+    """Raster of the urban cluster numbers of ``mask`` (see ``cluster_id_blocks``) and the labels of the
+    clusters (see ``select_components``). ``mask`` is labelled with ``label_blocks`` in blocks of about
+    ``blockPixels`` pixels, so only the labels of one block are in memory, not int32 labels of the whole mask."""
+    blockRows = max(1, blockPixels // mask.shape[1])
+    read = lambda row, rows: mask[row:row + rows]
+    offsets, roots, counts = label_blocks(read, mask.shape[0], blockRows, connectivity)
+    keep = select_components(counts, pixelArea, minClusterAreaKm2)
+    ids = np.empty(mask.shape, cluster_dtype(len(keep)))
+    for row, numbers in cluster_id_blocks(read, mask.shape[0], blockRows, offsets, roots, keep, connectivity):
+        ids[row:row + numbers.shape[0]] = numbers
+    return ids, keep
+
+def cluster_dtype(n):
+    """Smallest dtype for the numbers of ``n`` clusters that rasterio can polygonize"""
+    if n <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if n <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.int32
+
+def clusters_gdf(clusters, crs):
+    """GeoDataFrame of the urban clusters, numbered from 1 (largest first), with their area in km2"""
+    return gpd.GeoDataFrame({'cluster': list(range(1, len(clusters) + 1)),
+                             'area_km2': [c.area / (1000*1000) for c in clusters]},
+                            crs=crs, geometry=clusters)
+
+def urban_clusters(mask, transform, minClusterAreaKm2=None, connectivity=4):
+    """Array counterpart of ``polygonize`` + picking the urban clusters: label the connected
+    components of the non-zero pixels of ``mask``, select the clusters by pixel count and
+    polygonize only the selected clusters. Returns the cluster polygons, largest first."""
+    with profiling.stage('label'):
+        ids, keep = cluster_ids(mask, abs(transform.a * transform.e), minClusterAreaKm2, connectivity)
+    with profiling.stage('polygonize'):
+        # no mask (rasterio copies it), the polygons of 0 are skipped instead
+        parts = [[] for k in keep]
+        for geom, value in rasterio.features.shapes(ids, transform=transform, connectivity=connectivity):
+            if value:
+                parts[int(value) - 1].append(shapely.geometry.shape(geom))
+        return [p[0] if len(p) == 1 else unary_union(p) for p in parts]
+
+def city_area(clc, hrl, neighbourhoodMethod='sat', minClusterAreaKm2=None, connectivity=4):
+    """Find the urban cluster(s) in memory.
+    ``clc`` and ``hrl`` are (array, profile) tuples of the CLC and HRL rasters clipped to the AOI.
+    Returns a dict with the binary built-up mask ('builtup'), the urban-ness classes ('classes', see
+    ``urbanness_classes``), both on the HRL grid, the urban cluster polygons ('bounds', GeoDataFrame with one row
+    per cluster, see ``select_components``) and the built-up area of the urban clusters ('bua');
+    rasters are (array, profile) tuples."""
 
-    clc = raster2array(str(clc_path))
-    hrl = raster2array(str(hrl_path))
     HRLpixelSize = round(hrl[1]['transform'][0])
 
     print("Masking areas in CLC that do not belong to urban areas ...")
 
     # mask (with 0) classes that are not of interest
     # keep classes 1,2,3,10,11
-    clc_urban = copy.copy(clc[0])
-    clc_urban = np.where((clc[0]<=3),clc_urban,0)
-    clc_urban = np.where((clc[0]==10),clc[0],clc_urban)
-    clc_urban = np.where((clc[0]==11),clc[0],clc_urban)
-
-    profile = clc[1]
-
-    # export processed CLC raster with urban classes
-    with rasterio.open(str(volume / '3-CLC_AOI_urban.tif') , 'w', **profile) as dst:
-        dst.write_band(1, clc_urban)
+    clc_urban = urban_classes(clc[0])
 
     print("done.")
 
     print("Masking HRL imperviousness layer, based on CLC urban areas ...")
 
-    reproject_image_to_master(str(hrl_path),str(volume / '3-CLC_AOI_urban.tif'))
-    clc_res = raster2array(str(volume / '3-CLC_AOI_urban') + '_resampled.tif')
-
-    clc_hrl_urban = copy.copy(clc_res[0])
-    clc_hrl_urban = np.where((clc_res[0]!=0),hrl[0],0)
-    clc_hrl_urban = np.where((clc_hrl_urban!=0),1,0)
-    clc_hrl_urban = clc_hrl_urban.astype('uint8')
-
-    profile = hrl[1]
+    # reproject CLC to match HRL
+    with profiling.stage('builtup'):
+        clc_res = reproject_array_to_master(clc_urban, clc[1], hrl[1])
+        del clc_urban
 
-    # export processed CLC raster with urban classes
-    with rasterio.open(str(volume / '4-CLC_HRL_AOI_urban.tif') , 'w', **profile) as dst:
-        dst.write_band(1, clc_hrl_urban)
+        # the mask overwrites the resampled CLC classes
+        clc_hrl_urban = builtup_mask(clc_res, hrl[0], out=clc_res if clc_res.dtype == np.uint8 else None)
+        del clc_res
 
-    del clc_urban, hrl
+    profile = hrl[1].copy()
+    profile['dtype'] = clc_hrl_urban.dtype
 
     print("done.")
 
@@ -258,77 +396,139 @@ def main():
     print("Finding level of urban-ness with walking window and UN instructions ...")
 
     # kernel according to UN instructions should be 1km2 in area
-    # the kernel is always a square so with basic trigonometry we can find the size of the kernel
-    # A = πr^2 and r^2 + r^2 = a^2
-    r = math.sqrt(1/math.pi) # km
-    aKm = math.sqrt(math.pow(r,2)+math.pow(r,2)) # km
-    a = aKm * 1000 # m
+    # create a kernel of 1km in x pixels
+    kernelSize = neighbourhood.kernel_size(HRLpixelSize)
+
+    # get neighborhood sum (same counts as a convolution with a kernel of ones) in blocks of rows (with halos),
+    # each in strips on several threads, so only the sums of one block are in memory
+    # rural (0), suburban (1) and urban (2) pixels; urban and suburban pixels form the city
+    with profiling.stage('neighbourhood'):
+        workers = cpus.workers()
+        classes = np.empty(clc_hrl_urban.shape, np.uint8)
+        c = None
+        blocks = neighbourhood.neighbourhood_sum_blocks(lambda row, rows: clc_hrl_urban[row:row + rows],
+                                                        clc_hrl_urban.shape[0], kernelSize, 4 * kernelSize * workers,
+                                                        method=neighbourhoodMethod, workers=workers)
+        for row, c in blocks:
+            classes[row:row + c.shape[0]] = urbanness_classes(c, kernelSize)
+        del c
 
+    print("done.")
 
-    # create a kernel of 1km in x pixels
-    # eg. 1km is 50 pixels in the 20m-pixel size of HRL
-    kernelSize = int(a/HRLpixelSize)
-    kernel = np.ones((kernelSize,kernelSize),np.uint32)
+    return urban_city(clc_hrl_urban, classes, profile, minClusterAreaKm2, connectivity)
 
-    # cast img to np.uint32
-    img32 = clc_hrl_urban.astype(np.uint32)
+def urban_city(clc_hrl_urban, classes, profile, minClusterAreaKm2=None, connectivity=4):
+    """Second half of ``city_area``: the urban cluster(s) and their built-up area from the binary built-up
+    mask ``clc_hrl_urban`` and the urban-ness ``classes`` (uint8 arrays on the grid of ``profile``, e.g. read
+    from the urban-ness tiles, see urbanness_tiles.py). Returns the dict of ``city_area``."""
 
-    # do the convolution to get neighborhood sum
-    c = convolve(img32, kernel, mode='constant')
+    print("Finding basic urban cluster (largest city area in AOI) ...")
 
-    # get >=25% threshold for built-up image
-    # eg. in the binary built-up image, 100% built-up means neighborhood sum for each pixel = 2500
-    #       >=25% means sum 2500/4 >= 625
-    #       so threshold to 625 to get urban cluster
-    perc100 = kernelSize*kernelSize
-    percLarger25 = perc100/4
-    thresh = copy.copy(c)
-    thresh[thresh < int(round(percLarger25))] = 0
-    del c, img32
+    # label contiguous pixels, find largest cluster (or all clusters above minClusterAreaKm2) and polygonize it
+    clusters = urban_clusters(classes, profile['transform'], minClusterAreaKm2, connectivity)
+    city_gdf = clusters_gdf(clusters, profile['crs'].to_wkt())
 
     print("done.")
 
-    print("Finding city extents ...")
+    print("Finding built-up area of urban cluster ...")
 
-    # for city area (urban cluster) by combining contiguous pixels and find largest area in AOI
-    # use openCV + gdal
+    # clip HRL/CLC to city area to get urban cluster (one masking pass for all clusters)
+    coords = getFeatures(city_gdf)
+    with profiling.stage('mask'):
+        bua = clip_array(clc_hrl_urban, profile, coords)
 
-    # to get outer boundary only:
-    # 1) first threshold
+    print("done.")
 
-    thresh8 = rescaleToUnint8(thresh)
-    ret, th = cv2.threshold(thresh8,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
-    # invert values because with threshold city turns up as 0
-    th_inv = copy.copy(th)
-    th_inv[th_inv==255] = 5
-    th_inv[th_inv==0] = 1
-    th_inv[th_inv==5] = 0
-    th_inv = th_inv.astype('uint8')
-    profile['dtype'] = th_inv.dtype
-    with rasterio.open(str(volume / '5-thres.tif') , 'w', **profile) as dst:
-        dst.write_band(1, th_inv)
-    del th
+    return {'builtup': (clc_hrl_urban, profile), 'classes': (classes, profile),
+            'bounds': city_gdf, 'bua': bua}
 
-    # polygonize boundaries with gdal
+def city_area_blocks(volume, hrl_path, clc_path, blockRows, neighbourhoodMethod='sat', minClusterAreaKm2=None,
+                     connectivity=4):
+    """Out-of-core version of ``city_area``: the rasters are read and written in blocks of
+    ``blockRows`` rows, so memory use is bounded by the block size instead of the AOI size.
+    Writes the intermediate rasters, 7-bounds.shp and 8-URBAN_CLUSTER_BUA.tif to ``volume``."""
 
-    raster_path = str(volume / '5-thres.tif')
-    shapefile_path = str(volume / '6-polygonized.shp')
+    with rasterio.open(str(hrl_path)) as hrl_ds:
+        HRLpixelSize = round(hrl_ds.transform[0])
+    # kernel according to UN instructions should be 1km2 in area
+    # create a kernel of 1km in x pixels
+    kernelSize = neighbourhood.kernel_size(HRLpixelSize)
+
+    print("Masking HRL imperviousness layer, based on CLC urban areas ...")
+
+    # CLC is read through a warped VRT on the HRL grid, block by block, and its classes that are
+    # not of interest are masked on the fly (keep classes 1,2,3,10,11)
+    with profiling.stage('builtup'):
+        with rasterio.open(str(hrl_path)) as hrl_ds, rasterio.open(str(clc_path)) as clc_ds, \
+                warped_to_master(clc_ds, hrl_ds.profile) as clc_res_ds:
+            profile = hrl_ds.profile
+            with rasterio.open(str(volume / '4-CLC_HRL_AOI_urban.tif'), 'w', **profile) as dst:
+                for row, rows, _, _ in neighbourhood.row_blocks(hrl_ds.height, blockRows):
+                    clc_urban = urban_classes(read_rows(clc_res_ds, row, rows))
+                    dst.write_band(1, builtup_mask(clc_urban, read_rows(hrl_ds, row, rows),
+                                                   out=clc_urban if clc_urban.dtype == np.uint8 else None),
+                                   window=Window(0, row, hrl_ds.width, rows))
+        sidecar.save_from_raster(volume / '4-CLC_HRL_AOI_urban.tif', blockRows)
+
+    print("done.")
+
+    print("Finding level of urban-ness with walking window and UN instructions ...")
 
-    doit = polygonize(raster_path, shapefile_path)
+    # rural (0), suburban (1) and urban (2) pixels, from the neighbourhood sum of each block (with halos)
+    # the blocks (halos included) are slices of the memory-mapped sidecar of the built-up mask, or are
+    # read from the GeoTIFF if the sidecar can't be used
+    with profiling.stage('neighbourhood'):
+        builtup = sidecar.load(volume / '4-CLC_HRL_AOI_urban.tif', (profile['height'], profile['width']),
+                               profile['dtype'])
+        profile['dtype'] = 'uint8'
+        with rasterio.open(str(volume / '4-CLC_HRL_AOI_urban.tif')) as src, \
+                rasterio.open(str(volume / '5-thres.tif') , 'w', **profile) as dst:
+            if builtup is None:
+                read = lambda row, rows: read_rows(src, row, rows)
+            else:
+                read = lambda row, rows: builtup[row:row + rows]
+            blocks = neighbourhood.neighbourhood_sum_blocks(read, profile['height'], kernelSize, blockRows,
+                                                            method=neighbourhoodMethod,
+                                                            workers=cpus.workers())
+            for row, c in blocks:
+                classes = urbanness_classes(c, kernelSize)
+                dst.write_band(1, classes, window=Window(0, row, classes.shape[1], classes.shape[0]))
+        del builtup
 
     print("done.")
 
     print("Finding basic urban cluster (largest city area in AOI) ...")
 
-    # find largest polygon in shapefile --->
+    # label contiguous pixels block by block and find largest cluster (or all clusters above minClusterAreaKm2)
+    with profiling.stage('label'):
+        with rasterio.open(str(volume / '5-thres.tif')) as src:
+            offsets, roots, counts = label_blocks(lambda row, rows: read_rows(src, row, rows), src.height, blockRows,
+                                                  connectivity)
+        keep = select_components(counts, HRLpixelSize * HRLpixelSize, minClusterAreaKm2)
 
-    shp = gpd.read_file(shapefile_path)
+        # write the cluster numbers of the selected clusters only
+        profile['dtype'] = np.dtype(cluster_dtype(len(keep))).name
+        with rasterio.open(str(volume / '5-thres.tif')) as src, \
+                rasterio.open(str(volume / '6-clusters.tif'), 'w', **profile) as dst:
+            for row, numbers in cluster_id_blocks(lambda row, rows: read_rows(src, row, rows), src.height, blockRows,
+                                                  offsets, roots, keep, connectivity):
+                dst.write_band(1, numbers, window=Window(0, row, src.width, numbers.shape[0]))
 
-    # find largest poly in multipolygons
-    city = max(shp['geometry'], key=lambda a: a.area)
+    # polygonize the selected clusters with gdal
+
+    raster_path = str(volume / '6-clusters.tif')
+    shapefile_path = str(volume / '6-polygonized.shp')
+
+    with profiling.stage('polygonize'):
+        doit = polygonize(raster_path, shapefile_path)
+
+        shp = gpd.read_file(shapefile_path)
+
+        # merge the polygons of each cluster (8-connected clusters can be polygonized in parts)
+        clusters = [unary_union(list(shp.geometry[shp['DN'] == n])) for n in range(1, len(keep) + 1)]
 
     # export
-    city_gdf = gpd.GeoDataFrame(crs=shp.crs, geometry=[city])
+    city_gdf = clusters_gdf(clusters, shp.crs)
     exportString = volume / pathlib.Path('7-bounds.shp')
     city_gdf.to_file(str(exportString))
 
@@ -337,21 +537,72 @@ def main():
     print("Finding built-up area of urban cluster ...")
 
     # clip HRL/CLC to city area to get urban cluster
-
-    raster = rasterio.open(str(volume / '4-CLC_HRL_AOI_urban.tif'))
-    raster_crs = raster.crs
     coords = getFeatures(city_gdf)
-
-    # clip HRL built-up area to city extension
-    out_meta = raster.meta.copy()  # Copy the metadata
-    epsg_code = int(raster.crs.data['init'][5:])  # Parse EPSG code
-    out_img, out_transform = rasterio.mask.mask(raster, coords, crop=True)
-    out_meta.update({"driver": "GTiff", "height": out_img.shape[1], "width": out_img.shape[2],
-                     "transform": out_transform})
-    with rasterio.open(str(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')), "w", **out_meta) as dest:  # replace file with clipped one
-        dest.write(out_img)
+    with profiling.stage('mask'):
+        clip_blocks(str(volume / '4-CLC_HRL_AOI_urban.tif'), str(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')),
+                    coords, blockRows)
+        sidecar.save_from_raster(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif'), blockRows)
 
     print("done.")
 
+def main():
+
+    # ================= SETTINGS =========================================
+    # specify directory (volume conected via docker)
+    directory = ''
+    # specify AOI in the form of a shapefile
+    shpName = 'aoi.shp'
+    # specify HRL imperviousness mosaicked + clipped layer (to AOI)
+    hrlName = '1-HRL_AOI.tif'
+    # specify CLC clipped layer (to AOI)
+    clcName = '2-CLC_AOI.tif'
+    # neighbourhood sum backend: 'sat' (summed-area table, O(N)) or 'convolve' (scipy, O(N*k^2))
+    neighbourhoodMethod = 'sat'
+    # process rasters in blocks of this many rows to bound memory use (0 = whole rasters in memory)
+    blockRows = int(os.environ.get('GEOESSENTIAL_BLOCK_ROWS', '') or 0)
+    # keep every urban cluster of at least this area in km2 (None = only the largest cluster in the AOI)
+    minClusterAreaKm2 = None
+    # contiguous pixels of an urban cluster: 4 (sharing an edge) or 8 (sharing an edge or a corner)
+    connectivity = 4
+    # precomputed urban-ness tiles (VRT built by urbanness_tiles.py); if set, HRL and CLC are not read
+    urbannessTiles = os.environ.get('URBANNESS_TILES', '')
+
+    # ================= MAIN PROGRAM ======================================
+    volume = pathlib.Path(directory)
+    shp_file_path = volume / pathlib.Path(shpName)
+    hrl_path = volume / pathlib.Path(hrlName)
+    clc_path = volume / pathlib.Path(clcName)
+
+    if urbannessTiles:
+        print("Reading built-up areas and level of urban-ness of AOI from {p} ...".format(p=urbannessTiles))
+        builtup, classes, profile = urbanness_tiles.read_aoi(urbannessTiles, gpd.read_file(str(shp_file_path)))
+        print("done.")
+        result = urban_city(builtup, classes, profile, minClusterAreaKm2, connectivity)
+    elif blockRows:
+        city_area_blocks(volume, hrl_path, clc_path, blockRows, neighbourhoodMethod, minClusterAreaKm2, connectivity)
+        return
+    else:
+        clc = raster2array(str(clc_path))
+        hrl = raster2array(str(hrl_path))
+
+        result = city_area(clc, hrl, neighbourhoodMethod, minClusterAreaKm2, connectivity)
+
+    # export built-up (CLC urban areas & HRL) and urban-ness class rasters
+    for name, (array, profile) in (('4-CLC_HRL_AOI_urban.tif', result['builtup']), ('5-thres.tif', result['classes'])):
+        with rasterio.open(str(volume / name) , 'w', **profile) as dst:
+            dst.write_band(1, array)
+
+    # export urban cluster
+    exportString = volume / pathlib.Path('7-bounds.shp')
+    result['bounds'].to_file(str(exportString))
+
+    # export built-up area of urban cluster
+    out_img, out_meta = result['bua']
+    with rasterio.open(str(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')), "w", **out_meta) as dest:
+        dest.write_band(1, out_img)
+    # memory-mappable copy for 4_Index_calculation.py
+    sidecar.save(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif'), out_img)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.script('2_City_Area'):
+        main()
\ No newline at end of file
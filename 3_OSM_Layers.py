@@ -13,45 +13,307 @@
 # https://stackoverflow.com/questions/34549767/how-to-calculate-the-center-of-the-bounding-box
 
 # ============== IMPORTS =============================================
+import os
+import re
+import math
+import time
 import pathlib
+import json
+import codecs
+import contextlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import requests
 import geopandas as gpd
 import shapely.geometry
 import shapely.wkt
-from shapely.ops import cascaded_union
+import numpy as np
 import pyproj
-from shapely.ops import transform
-
-def main():
-
-    # ================= SETTINGS =========================================
-    # specify directory (volume conected via docker)
-    directory = ''
-    # specify AOI in the form of a shapefile
-    shpName = '7-bounds.shp'
 
-    # ================= MAIN PROGRAM ======================================
-
-    volume = pathlib.Path(directory)
-    shp_file_path = volume / pathlib.Path(shpName)
+import cache
+import profiling
+import dissolve
+import osm_pbf
+import osm_store
+
+# ================= FUNCTIONS =========================================
+
+# Overpass API configuration parameters (settings)
+Overpass = {"url": os.environ.get('OVERPASS_URL', "http://overpass-api.de/api/interpreter"),
+            "tileDegrees": 0.1,  # the bbox is queried in tiles of a 0.1 x 0.1 degree grid
+            "maxConcurrent": 2,  # concurrent queries (Overpass gives a few query slots per client)
+            "retries": 5,  # retries of a query answered with 429 (too many requests) or 504 (gateway timeout)
+            "backoff": 2,  # seconds before the first retry, doubled on every retry
+            "timeout": (30, 300),  # seconds to connect, and without any byte of the response before giving up
+            }
+
+# top-level remark at the end of an Overpass JSON response, after the elements (e.g. "runtime error: Query timed
+# out ..." when the server gave up and the elements are incomplete), looked for in its last REMARK_BYTES
+REMARK = re.compile(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")\s*}\s*$')
+REMARK_BYTES = 64 * 1024
+
+# cells of the per-city geometry store (see osm_store.py), in the units of the CRS each layer is unioned in
+StoreCells = {"open_areas": 0.02,  # degrees (EPSG:4326)
+              "roads": 2000,  # meters (EPSG:3035)
+              }
+
+
+def refresh_requested():
+    """True if the OSM_REFRESH environment variable asks for an OSM refresh (1, true or yes; 0, false,
+    no or empty don't)"""
+    return os.environ.get('OSM_REFRESH', '').strip().lower() in ('1', 'true', 'yes')
+
+
+def bbox_tiles(bbox, tileDegrees):
+    """Split a (minx, miny, maxx, maxy) lon/lat bounding box along a grid of ``tileDegrees`` anchored at
+    (0, 0), so the same AOI always gives the same (cached) queries. Returns the tiles clipped to ``bbox``."""
+    tiles = []
+    for row in range(int(math.floor(bbox[1] / tileDegrees)), int(math.ceil(bbox[3] / tileDegrees))):
+        for col in range(int(math.floor(bbox[0] / tileDegrees)), int(math.ceil(bbox[2] / tileDegrees))):
+            tiles.append((max(bbox[0], col * tileDegrees), max(bbox[1], row * tileDegrees),
+                          min(bbox[2], (col + 1) * tileDegrees), min(bbox[3], (row + 1) * tileDegrees)))
+    return tiles
+
+
+def overpass_request(session, overpass_url, query):
+    """Send an Overpass query (response streamed), retrying with exponential backoff while the
+    server answers 429 (too many requests) or 504 (gateway timeout), or the connection fails or stalls"""
+    for attempt in range(Overpass['retries'] + 1):
+        try:
+            response = session.get(overpass_url,
+                                   params={'data': query}, stream=True, timeout=Overpass['timeout'])
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == Overpass['retries']:
+                raise
+            response, status = None, type(e).__name__
+        else:
+            if response.status_code not in (429, 504) or attempt == Overpass['retries']:
+                break
+            response.close()
+            status = response.status_code
+        delay = Overpass['backoff'] * 2 ** attempt
+        retryAfter = response.headers.get('Retry-After', '') if response is not None else ''
+        if retryAfter.isdigit():
+            delay = max(delay, int(retryAfter))
+        print("Overpass answered {c}, retrying in {w}s ...".format(c=status, w=delay))
+        time.sleep(delay)
+    response.raise_for_status()
+    return response
+
+
+def runtime_error(tail):
+    """The top-level "remark" of an Overpass JSON response if it reports a runtime error (e.g. the query
+    timed out and the elements are incomplete), from the last bytes ``tail`` of the response, else None"""
+    match = REMARK.search(tail.decode('utf-8', 'replace'))
+    if match is None:
+        return None
+    try:
+        remark = json.loads(match.group(1))
+    except ValueError:
+        return None
+    return remark if remark.startswith('runtime error') else None
+
+
+def overpass_chunks(overpass_url, query, queryCache, session=requests, chunkSize=1024*1024, refresh=False):
+    """Run an Overpass query and yield the response body in chunks of bytes, streaming it into the
+    cache at the same time. Responses already cached for the same query text are read from the cache,
+    unless ``refresh`` (the query is run again and its response replaces the cached one).
+    A response whose remark reports a runtime error is not cached, and raises RuntimeError once read."""
+    key = queryCache.key(url=overpass_url, query=query)
+    path = None if refresh else queryCache.get(key)
+    if path is not None:
+        try:
+            with open(str(path), 'rb') as f:
+                # entries cached before runtime errors were checked are dropped
+                f.seek(max(0, os.fstat(f.fileno()).st_size - REMARK_BYTES))
+                if runtime_error(f.read()) is None:
+                    f.seek(0)
+                    for chunk in iter(lambda: f.read(chunkSize), b''):
+                        yield chunk
+                    return
+            path.unlink()
+        except FileNotFoundError:  # evicted by a concurrent process since get(), a miss
+            pass
+
+    response = overpass_request(session, overpass_url, query)
+    with contextlib.closing(response):
+        # the entry only becomes visible if the whole response was read without runtime error
+        with (queryCache.writer(key) if queryCache.enabled else contextlib.nullcontext()) as f:
+            tail = b''
+            for chunk in response.iter_content(chunkSize):
+                profiling.add_downloaded(len(chunk))
+                if f is not None:
+                    f.write(chunk)
+                tail = (tail + chunk)[-REMARK_BYTES:]
+                yield chunk
+            remark = runtime_error(tail)
+            if remark is not None:
+                raise RuntimeError("Overpass query failed: {r}".format(r=remark))
+
+
+def iter_elements(chunks):
+    """Parse the "elements" array of an Overpass JSON response incrementally from the iterator of its
+    ``chunks`` (bytes) and yield the elements one at a time, so only one element is held in memory as dicts"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    text = ''
+    pos = 0
+    inElements = False
+    for chunk in chunks:
+        text = text[pos:] + utf8.decode(chunk)
+        pos = 0
+        if not inElements:
+            start = text.find('"elements"')
+            start = text.find('[', start) if start >= 0 else -1
+            if start < 0:  # not there yet
+                continue
+            pos = start + 1
+            inElements = True
+        while True:
+            # skip separators between elements
+            while pos < len(text) and text[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(text):
+                break
+            if text[pos] == ']':  # end of the elements, read the rest so the response is cached
+                for chunk in chunks:
+                    pass
+                return
+            try:
+                element, pos = decoder.raw_decode(text, pos)
+            except ValueError:  # element not complete yet, read the next chunk
+                break
+            yield element
+    raise ValueError("Incomplete Overpass response")
+
+
+def query_overpass(overpass_url, query, queryCache, session=requests, refresh=False):
+    """Run an Overpass query (or read the cached response for the same query text, unless ``refresh``)
+    and yield its elements"""
+    return iter_elements(overpass_chunks(overpass_url, query, queryCache, session, refresh=refresh))
+
+
+def iter_ways(elements):
+    """Yield the (id, tags, coordinates) of the ways in the Overpass ``elements``, with the
+    (lon, lat) coordinates as a (n, 2) array"""
+    for element in elements:
+        if ((element['type'] == 'way') or (element['type'] == 'rel')) and 'geometry' in element:
+            coords = np.array([(point['lon'], point['lat']) for point in element['geometry']],
+                              dtype=np.float64).reshape(-1, 2)
+            yield (element['type'], element.get('id')), element.get('tags', {}), coords
+
+
+def query_tiles(queryString, bbox, queryCache, maxConcurrent=None, withIds=False, refresh=False):
+    """Run the Overpass ``queryString`` ({s} stands for the bbox) for the tiles of the lon/lat ``bbox``,
+    ``maxConcurrent`` tiles at a time, and yield the (tags, coordinates) of the ways (the (id, tags,
+    coordinates) ``withIds``) tile by tile, in the order the tiles are finished. At most ``maxConcurrent``
+    tiles are queried or waiting to be yielded at a time, so a slow tile doesn't keep the ways of all the
+    others in memory. Ways crossing tile borders are returned by several tiles and are only yielded once.
+    With ``refresh``, the tiles are queried again instead of read from ``queryCache``."""
+    tiles = bbox_tiles(bbox, Overpass['tileDegrees'])
+    maxConcurrent = maxConcurrent or Overpass['maxConcurrent']
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=maxConcurrent, pool_maxsize=maxConcurrent)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def fetch(tile):
+        # create area string from the tile to pass in Overpass API
+        areaString = str(tile[1]) + "," \
+                   + str(tile[0]) + "," \
+                   + str(tile[3]) + "," \
+                   + str(tile[2])
+        return list(iter_ways(query_overpass(Overpass['url'], queryString.format(s=areaString), queryCache, session,
+                                             refresh)))
+
+    seen = set()
+    pending = iter(tiles)
+    try:
+        with ThreadPoolExecutor(max_workers=maxConcurrent) as executor:
+            running = {executor.submit(fetch, tile) for tile in itertools.islice(pending, maxConcurrent)}
+            while running:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    ways = future.result()
+                    # query the next tile while the ways of this one are consumed
+                    tile = next(pending, None)
+                    if tile is not None:
+                        running.add(executor.submit(fetch, tile))
+                    for wayId, tags, coords in ways:
+                        if wayId in seen:
+                            continue
+                        seen.add(wayId)
+                        yield (wayId, tags, coords) if withIds else (tags, coords)
+                    del ways
+    finally:
+        session.close()
+
+
+def road_width(tags, laneWidth=3):
+    """Approximate width (in meters) of a road from its OSM ``tags``: ``laneWidth`` per lane for roads
+    which 'lanes' are known, otherwise assume roads have one lane"""
+    lanes = 1
+    if 'lanes' in tags:
+        try:
+            # sometimes the 'lanes' field contains more than one number, separated with ';'
+            lanes = max(sum(float(i) for i in tags['lanes'].split(';')), 1)
+        except ValueError:  # not a number (e.g. 'lanes=unknown')
+            pass
+    return lanes * laneWidth
+
+
+def road_lines(ways, epsg):
+    """Road lines of the (tags, lon/lat coordinates) ``ways`` in the EPSG:``epsg`` projected CRS and
+    their widths. The vertices of all ways are reprojected with a single transformer call.
+    Returns a list of LineStrings and an array of widths (in meters)."""
+    coords = []
+    widths = []
+    for tags, lonlat in ways:
+        if not tags or len(lonlat) < 2:
+            continue
+        coords.append(lonlat)
+        widths.append(road_width(tags))
+
+    ends = np.cumsum([len(c) for c in coords]).tolist()
+    lonlat = np.concatenate(coords) if coords else np.empty((0, 2))
+    del coords
+
+    projectToUTM = pyproj.Transformer.from_crs(4326, epsg, always_xy=True)
+    x, y = projectToUTM.transform(lonlat[:, 0], lonlat[:, 1])
+    xy = np.column_stack((x, y))
+
+    lines = [shapely.geometry.LineString(xy[start:end]) for start, end in zip([0] + ends[:-1], ends)]
+    return lines, np.asarray(widths, dtype=np.float64)
+
+
+def osm_layers(bounds, pbfPath='', storeDir='', refresh=False):
+    """Get the OSM open areas and the buffered road network (land allocated to streets) for the
+    bounding box of the ``bounds`` GeoDataFrame, from the Overpass API or, if ``pbfPath`` is given,
+    from the index of a local .osm.pbf extract. With ``storeDir``, the layers are updated from the
+    geometries stored there by the last run, with only the ways changed since then (see osm_store.py).
+    With ``refresh``, the Overpass queries are run again instead of read from the download cache.
+    Returns two GeoDataFrames in EPSG:3035."""
 
-    # open shapefile with geopandas
-    shapefile = gpd.read_file(str(shp_file_path))
     # transform to EPSG:4326 CRS because that's what OSM uses
-    shapefile_transformed = shapefile.to_crs(epsg=4326)
+    shapefile_transformed = bounds.to_crs(epsg=4326)
 
     # get the bounding box
     bbox = shapefile_transformed.total_bounds
 
     # ---------- DO THE QUERY TO GET OPEN AREAS OSM DATA ----------
-    # Overpass API uses a custom query language to define queries
-    overpass_url = "http://overpass-api.de/api/interpreter"
-
-    # create area string from bounding box to pass in Overpass API
-    areaString =  str(bbox[1]) + "," \
-                + str(bbox[0]) + "," \
-                + str(bbox[3]) + "," \
-                + str(bbox[2])
+    if pbfPath:
+        # same tags, read from the (prebuilt) spatial index of the extract
+        print('Reading OSM layers from {p} ...'.format(p=pbfPath))
+        pbfIndex = osm_pbf.open_index(pbfPath)
+    else:
+        # Overpass API uses a custom query language to define queries
+        # the bbox is queried in tiles, {s} in the query strings is replaced by the bbox of each tile
+        print('Splitting bounding box in {n} tile(s) for the Overpass queries ...'.format(
+            n=len(bbox_tiles(bbox, Overpass['tileDegrees']))))
+        # responses are cached by query text (a refresh queries again and replaces them)
+        queryCache = cache.default_cache()
 
     # create query string
     # search for more tags here: https://taginfo.openstreetmap.org/tags
@@ -86,41 +348,43 @@ def main():
      rel["landuse"="cemetery"]({s});
     );
     out geom;
-    '''.format(s=areaString)
+    '''
 
     print('Querying for open areas in OSM ...')
 
     overpass_query = queryString
-    response = requests.get(overpass_url,
-                            params={'data': overpass_query})
-    data = response.json()
-
 
-    # Collect polygons into list
+    # Collect polygons into list (elements are parsed as they are downloaded)
     polygons = []
-    for element in data['elements']:
-        if ((element['type'] == 'way') or (element['type'] == 'rel')) :
-            lon_list = []
-            lat_list = []
-            for point in element['geometry']:
-                lon = point['lon']
-                lat = point['lat']
-                lon_list.append(lon)
-                lat_list.append(lat)
-            if (len(lon_list)<3):
-                continue
-            else:
-                poly_geom = shapely.geometry.Polygon(zip(lon_list, lat_list)) # create polygon geometry
-                polygons.append(poly_geom) # add polygon to list
+    store = osm_store.load(storeDir, 'open_areas', StoreCells['open_areas']) if storeDir else None
+    if pbfPath:
+        ways = osm_pbf.pbf_ways(pbfIndex, 'open_areas', bbox, withIds=store is not None)
+    else:
+        ways = query_tiles(overpass_query, bbox, queryCache, withIds=store is not None, refresh=refresh)
+    with profiling.stage('open_areas_query'):
+        if store is not None:
+            # polygons only for the ways added or changed since the last run
+            changed, removed = osm_store.changes(store, (way for way in ways if len(way[2]) >= 3))
+            polygons = [shapely.geometry.Polygon(coords) for wayId, digest, tags, coords in changed]
+        else:
+            for tags, coords in ways:
+                if (len(coords)<3):
+                    continue
+                else:
+                    poly_geom = shapely.geometry.Polygon(coords) # create polygon geometry
+                    polygons.append(poly_geom) # add polygon to list
 
     # POLYGONS ----
-    union = cascaded_union(polygons)
+    with profiling.stage('open_areas_union'):
+        if store is not None:
+            union = osm_store.apply(store, changed, polygons, removed)
+            osm_store.save(storeDir, 'open_areas', store)
+            del store, changed, removed
+        else:
+            union = dissolve.dissolve(polygons)
     multi_polygon = gpd.GeoDataFrame(crs='epsg:4326', geometry=[union])
     # reproject to UTM
-    multi_polygon_utm = multi_polygon.to_crs('epsg:' + '3035')  # utm epsg code for AOI)
-    # export OSM polygons
-    exportString = volume / pathlib.Path('9-osm_open_areas.shp')
-    multi_polygon_utm.to_file(str(exportString))
+    open_areas = multi_polygon.to_crs('epsg:' + '3035')  # utm epsg code for AOI)
 
     print("done.")
 
@@ -190,70 +454,80 @@ def main():
      rel["cycleway"="track"]({s});
     );
     out geom;
-    '''.format(s=areaString)
+    '''
 
     print('Querying for streets in OSM ...')
 
     overpass_query = queryString
-    response = requests.get(overpass_url,
-                            params={'data': overpass_query})
-    data = response.json()
+
+    # in order to apply buffer to road network, must reproject to projected CRS
+    # (ways are parsed as they are downloaded, all vertices are projected in one call,
+    # and roads are buffered in EPSG:3035)
+    store = osm_store.load(storeDir, 'roads', StoreCells['roads']) if storeDir else None
+    if pbfPath:
+        ways = osm_pbf.pbf_ways(pbfIndex, 'roads', bbox, withIds=store is not None)
+    else:
+        ways = query_tiles(overpass_query, bbox, queryCache, withIds=store is not None, refresh=refresh)
+    with profiling.stage('roads_query'):
+        if store is not None:
+            # lines only for the ways added or changed since the last run (road_lines skips the same ways)
+            changed, removed = osm_store.changes(store, (way for way in ways if way[1] and len(way[2]) >= 2))
+            ways = [(tags, coords) for wayId, digest, tags, coords in changed]
+        lines, widths = road_lines(ways, 3035)
 
     print("done.")
 
     print('Buffering road network in order to find land allocated to streets ...')
 
-    # in order to apply buffer to road network, must reproject to projected CRS
-    s = 'epsg:' + '3035'  # utm epsg code for AOI
-    projectToUTM = pyproj.Transformer.from_proj(
-        pyproj.Proj('epsg:4326'),  # OSM coordinate system
-        pyproj.Proj(s))  # utm coordinate system
-    projectToWGS = pyproj.Transformer.from_proj( # reproject to OSM CRS
-        pyproj.Proj(s),  # utm coordinate system
-        pyproj.Proj('epsg:4326'))  # OSM coordinate system
-
-    # Collect roads into list and buffer to get width
-    polygons = []
-    for element in data['elements']:
-        if ((element['type'] == 'way') or (element['type'] == 'rel')):
-            lon_list = []
-            lat_list = []
-            for point in element['geometry']:
-                lon = point['lon']
-                lat = point['lat']
-                lon_list.append(lon)
-                lat_list.append(lat)
-            for tag in element['tags']:
-                if tag == 'lanes': # for roads which 'lanes' are known, and thus approx. width can be calculated
-                    fullstring = element['tags']['lanes']
-                    substring = ";"  # sometimes the 'lanes' field contains more than one number, separated with ';'
-                    if substring in fullstring:
-                        stringList = fullstring.split(substring)
-                        numList = [float(i) for i in stringList]
-                        lanes = sum(numList)
-                    else:
-                        lanes = float(fullstring)
-                    width = lanes * 3
-                else:  # otherwise, assume roads have one lane
-                    width = 3
-
-                line_geom = shapely.geometry.LineString(zip(lon_list, lat_list))
-
-                # in order to apply buffer to road network, must reproject to projected CRS
-                line_geom_trans = transform(projectToUTM.transform, line_geom)  # apply projection
-                buff = line_geom_trans.buffer(width) # in meters
-                buff_trans = transform(projectToWGS.transform, buff)  # apply projection
-                polygons.append(buff_trans)  # add polygon to list
+    with profiling.stage('roads_buffer'):
+        buffers = gpd.GeoSeries(lines, crs='epsg:3035').buffer(widths)  # in meters
 
     # POLYGONS ----
-    union = cascaded_union(polygons)
-    multi_polygon = gpd.GeoDataFrame(crs='epsg:4326', geometry=[union])
-    multi_polygon_utm = multi_polygon.to_crs('epsg:' + '3035')  # utm epsg code for AOI)
-    # export OSM polygons
-    exportString = volume / pathlib.Path('10-osm_roads.shp')
-    multi_polygon_utm.to_file(str(exportString))
+    with profiling.stage('roads_union'):
+        if store is not None:
+            union = osm_store.apply(store, changed, list(buffers), removed)
+            osm_store.save(storeDir, 'roads', store)
+            del store, changed, removed
+        else:
+            union = dissolve.dissolve(list(buffers))
+    roads = gpd.GeoDataFrame(crs='epsg:3035', geometry=[union])
 
     print("done.")
 
+    return open_areas, roads
+
+
+def main():
+
+    # ================= SETTINGS =========================================
+    # specify directory (volume conected via docker)
+    directory = ''
+    # specify AOI in the form of a shapefile
+    shpName = '7-bounds.shp'
+    # optional local .osm.pbf extract (e.g. a Geofabrik country file) to read instead of querying the
+    # Overpass API. Its index is built next to it on first use (or beforehand with osm_pbf.py)
+    pbfPath = os.environ.get('OSM_PBF', '')
+    # optional directory (in the working directory) for the OSM geometries of the city: the next run then
+    # only processes the ways changed since this one (see osm_store.py)
+    osmStore = os.environ.get('OSM_STORE', '')
+
+    # OSM refresh (set by runner.py --refresh-osm): query Overpass again instead of reading the download cache
+    osmRefresh = refresh_requested()
+
+    # ================= MAIN PROGRAM ======================================
+
+    volume = pathlib.Path(directory)
+    shp_file_path = volume / pathlib.Path(shpName)
+
+    # open shapefile with geopandas
+    shapefile = gpd.read_file(str(shp_file_path))
+
+    open_areas, roads = osm_layers(shapefile, pbfPath, str(volume / osmStore) if osmStore else '', osmRefresh)
+
+    # export OSM polygons
+    open_areas.to_file(str(volume / pathlib.Path('9-osm_open_areas.shp')))
+    roads.to_file(str(volume / pathlib.Path('10-osm_roads.shp')))
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.script('3_OSM_Layers'):
+        main()
\ No newline at end of file
@@ -9,20 +9,27 @@
 # https://www.programcreek.com/python/example/101827/gdal.RasterizeLayer
 
 # ============== IMPORTS =============================================
-import pathlib
 import os
-import sys
+import json
+import pathlib
 
 import rasterio
-from rasterio.mask import mask
+import rasterio.features
+import rasterio.transform
+import rasterio.windows
 import numpy as np
 import geopandas as gpd
-from shapely.ops import cascaded_union
-import gdal
-import ogr
+
+import dissolve
+import profiling
+import raster_windows
+import sidecar
 
 # ================= FUNCTIONS =========================================
 
+# built-up area (km2) of the urban clusters of 7-bounds.shp in 8-URBAN_CLUSTER_BUA.tif, kept for OSM refreshes
+BUA_FILE = '8-URBAN_CLUSTER_BUA.json'
+
 def raster2array(geotif_file):
     bands = 0
     dataset = rasterio.open(geotif_file)
@@ -33,7 +40,10 @@ def raster2array(geotif_file):
     noDataValue = dataset.nodatavals
 
     if bands == 1:
-        raster = dataset.read(1)
+        # map the .npy sidecar written with the raster (see sidecar.py) instead of copying the band
+        raster = sidecar.load(geotif_file, (dataset.height, dataset.width), dataset.dtypes[0])
+        if raster is None:
+            raster = dataset.read(1)
 
         # raster = raster[::-1] #inverse array because Python is column major
         return raster, profile
@@ -41,63 +51,106 @@ def raster2array(geotif_file):
     elif bands > 1:
         print('More than one band ... need to modify function for case of multiple bands')
 
-def Feature_to_Raster(input_shp, output_tiff,
-                      cellsize, field_name=False, NoData_value=-9999):
-    """
-    Converts a shapefile into a raster
-    """
+def getFeatures(gdf):
+    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them
+    (the geometries of all features)"""
+    import json
+    return [feature['geometry'] for feature in json.loads(gdf.to_json())['features']]
 
-    # Input
-    inp_driver = ogr.GetDriverByName('ESRI Shapefile')
-    inp_source = inp_driver.Open(input_shp, 0)
-    inp_lyr = inp_source.GetLayer()
-    inp_srs = inp_lyr.GetSpatialRef()
+def features_to_array(geometries, cellsize, window_shapes, blockRows=1024):
+    """In-memory counterpart of rasterizing a layer at ``cellsize`` (burn value 1) and masking it with
+    rasterio.mask.mask(crop=True): the grid is anchored at the top-left corner of the extent of
+    ``geometries``, but only the window covering ``window_shapes`` is rasterized, and pixels outside
+    ``window_shapes`` are set to 0 (``blockRows`` rows at a time). Returns the uint8 array and its profile."""
 
     # Extent
-    x_min, x_max, y_min, y_max = inp_lyr.GetExtent()
+    x_min, y_min, x_max, y_max = geometries.total_bounds
     x_ncells = int((x_max - x_min) / cellsize)
     y_ncells = int((y_max - y_min) / cellsize)
+    transform = rasterio.transform.from_origin(x_min, y_max, cellsize, cellsize)
 
-    # Output
-    out_driver = gdal.GetDriverByName('GTiff')
-    if os.path.exists(output_tiff):
-        out_driver.Delete(output_tiff)
-    out_source = out_driver.Create(output_tiff, x_ncells, y_ncells,
-                                   1, gdal.GDT_Byte)
-
-    out_source.SetGeoTransform((x_min, cellsize, 0, y_max, 0, -cellsize))
-    out_source.SetProjection(inp_srs.ExportToWkt())
-    out_lyr = out_source.GetRasterBand(1)
-    out_lyr.SetNoDataValue(NoData_value)
+    # window of the masking shapes
+    window = raster_windows.aoi_window(window_shapes, transform, x_ncells, y_ncells)
+    out_transform = rasterio.windows.transform(window, transform)
+    out_shape = (int(window.height), int(window.width))
 
     # Rasterize
-    if field_name:
-        gdal.RasterizeLayer(out_source, [1], inp_lyr,
-                            options=["ATTRIBUTE={0}".format(field_name)])
+    shapes = [(geom, 1) for geom in geometries if geom is not None and not geom.is_empty]
+    if shapes:
+        out_img = rasterio.features.rasterize(shapes, out_shape=out_shape, transform=out_transform,
+                                              fill=0, dtype='uint8')
     else:
-        gdal.RasterizeLayer(out_source, [1], inp_lyr, burn_values=[1])
+        out_img = np.zeros(out_shape, 'uint8')
+    # mask in blocks of rows, so the 1m boolean mask never covers the whole window
+    for row in range(0, out_shape[0], blockRows):
+        block = out_img[row:row + blockRows]
+        block_transform = rasterio.windows.transform(rasterio.windows.Window(0, row, out_shape[1], block.shape[0]),
+                                                     out_transform)
+        block[rasterio.features.geometry_mask(window_shapes, out_shape=block.shape, transform=block_transform)] = 0
 
-    # Save and/or close the data sources
-    inp_source = None
-    out_source = None
+    profile = {"driver": "GTiff", "dtype": 'uint8', "nodata": None, "count": 1, "crs": geometries.crs.to_wkt(),
+               "height": out_shape[0], "width": out_shape[1], "transform": out_transform}
+    return out_img, profile
 
-    # Return
-    return output_tiff
+def bua_km2(urban_aggl, urb_bua):
+    """Built-up area (km2) of each urban cluster of ``urban_aggl`` in the built-up area raster ``urb_bua``
+    ((array, profile) tuple)"""
 
-def getFeatures(gdf):
-    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-    import json
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
+    # urban clusters on the grid of the built-up area raster
+    clusters_bua = urban_aggl.to_crs(urb_bua[1]['crs'].to_wkt()).geometry
 
-def main():
-
-    # ================= SETTINGS =========================================
-    # specify directory (volume conected via docker)
-    directory = ''
-
-    # ================= MAIN PROGRAM ======================================
-    volume = pathlib.Path(directory)
-    urb_bua_path = volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')
+    pixelSize = int(round(urb_bua[1]['transform'][0])) # pixel size = x meters (depending on WMS request)
+    # label the pixels of the urban clusters (1...n) in one pass, then
+    # count pixels that are =1 (rasterio reads the values as uint8) per cluster
+    # (labels in the smallest dtype rasterio can burn, counted in blocks of 1M pixels because
+    # bincount makes an int64 copy of what it counts)
+    dtype = 'uint8' if len(clusters_bua) < 256 else 'uint16' if len(clusters_bua) < 65536 else 'int32'
+    labels = rasterio.features.rasterize(((geom, n) for n, geom in enumerate(clusters_bua, 1)),
+                                         out_shape=urb_bua[0].shape, transform=urb_bua[1]['transform'],
+                                         fill=0, dtype=dtype)
+    labels, bua = labels.ravel(), urb_bua[0].ravel()
+    bua_pixels = np.zeros(len(clusters_bua) + 1, np.int64)
+    for start in range(0, labels.size, 1 << 20):
+        block = slice(start, start + (1 << 20))
+        bua_pixels += np.bincount(labels[block][bua[block] == 1], minlength=len(clusters_bua) + 1)
+    bua_pixels = bua_pixels[1:]
+    del labels, bua
+    return (bua_pixels * (pixelSize * pixelSize)) / (1000*1000)  # calculate in square km
+
+def save_bua(volume, bua_clusters):
+    """Keep the built-up area (km2) of each cluster in ``volume`` (BUA_FILE), for OSM refreshes"""
+    tmp = volume / pathlib.Path(BUA_FILE + '.tmp')
+    with open(str(tmp), 'w') as f:
+        json.dump({'bua_km2': [float(b) for b in bua_clusters]}, f, indent=2)
+    os.replace(str(tmp), str(volume / pathlib.Path(BUA_FILE)))
+
+def load_bua(volume, nClusters):
+    """Built-up area (km2) of each cluster kept by ``save_bua`` in ``volume``, or None if there is none,
+    it is older than 7-bounds.shp or 8-URBAN_CLUSTER_BUA.tif or it is not for ``nClusters`` clusters"""
+    path = volume / pathlib.Path(BUA_FILE)
+    try:
+        mtime = os.stat(str(path)).st_mtime_ns
+        if any(os.stat(str(volume / pathlib.Path(name))).st_mtime_ns > mtime
+               for name in ('7-bounds.shp', '8-URBAN_CLUSTER_BUA.tif')):
+            return None
+        with open(str(path)) as f:
+            bua_clusters = np.asarray(json.load(f)['bua_km2'], dtype=np.float64)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if len(bua_clusters) != nClusters:
+        return None
+    return bua_clusters
+
+def index_calculation(volume, urban_aggl, open_areas, roads, urb_bua, exportRasters=True, bua_clusters=None):
+    """Calculate the 11.7.1 indicator for the urban cluster(s) ``urban_aggl`` from the OSM ``open_areas`` and
+    ``roads`` (GeoDataFrames) and the built-up area raster ``urb_bua`` ((array, profile) tuple), or the
+    built-up area (km2) of each cluster ``bua_clusters`` of a previous run (see ``load_bua``; ``urb_bua``
+    is then not used and can be None).
+    Open area and street areas are computed from the geometries; the 1m rasters of the OSM layers
+    (9-osm_open_areas.tif, 10-osm_roads.tif) are only written to ``volume`` if ``exportRasters``.
+    Writes 11-results.txt (and the built-up area of the clusters, if computed from ``urb_bua``) and returns
+    the cleaned roads (roads except roads in open areas) GeoDataFrame and a dict with the areas (in km2)
+    and the value of the indicator, in total and per cluster ('clusters')."""
 
     # ================= ================= =================
 
@@ -105,115 +158,65 @@ def main():
 
     # =================
     # 1.1 reproject urban_aggl to match OSM files
-    urban_aggl_path = volume / pathlib.Path('7-bounds.shp')
-    open_areas_path = volume / pathlib.Path('9-osm_open_areas.shp')
-    roads_path = volume / pathlib.Path('10-osm_roads.shp')
-
-    urban_aggl = gpd.read_file(str(urban_aggl_path))
-    open_areas = gpd.read_file(str(open_areas_path))
-    roads = gpd.read_file(str(roads_path))
 
     # reproject urban agglomeration to same projection as open areas
     urban_aggl = urban_aggl.to_crs(open_areas.crs)
-    # urban_aggl = urban_aggl.assign(VALUE=1)
-    urban_aggl.to_file(str(urban_aggl_path)) # replace file
-
-    # merge & union open areas and LAS because in some cases roads appear on open spaces
-    # used for calculating area
-    polygons = [roads.geometry[0], open_areas.geometry[0]]
-    boundary = gpd.GeoSeries(cascaded_union(polygons))
-    LAS_openAreas = gpd.GeoDataFrame(crs='epsg:3035', geometry=[boundary.geometry[0]])
 
     # clip roads from open areas
     #used for exporting roads
-    roads_clean_geom = roads.geometry[0].difference(open_areas.geometry[0])
+    with profiling.stage('difference'):
+        roads_clean_geom = dissolve.difference(roads.geometry[0], open_areas.geometry[0])
     roads_clean = gpd.GeoDataFrame(crs='epsg:3035', geometry=[roads_clean_geom])
-    # export "cleaned" roads (roads except roads in open areas)
-    exportString = roads_path
-    roads_clean.to_file(str(exportString))
 
     # =================
-    # 1.2 Turn all shapefiles to raster
-
-    print("Turning layers to raster ...")
-
-    rasterized = Feature_to_Raster(str(urban_aggl_path), (str(urban_aggl_path)[0:-4] + '.tif'), 1)
-    print("done urban area file")
+    # 1.2 calculate total surface of open areas and roads in urban agglomeration
 
-    rasterized = Feature_to_Raster(str(open_areas_path), (str(open_areas_path)[0:-4] + '.tif'), 1)
-    print("done OSM open areas file")
+    print("Calculating areas ...")
 
-    rasterized = Feature_to_Raster(str(roads_path), (str(roads_path)[0:-4] + '.tif'), 1)
-    print("done OSM roads file")
+    # intersect the layers with each urban cluster and sum the exact areas (EPSG:3035, in m2)
 
-    print("done.")
+    with profiling.stage('areas'):
+        # open areas
+        open_areas_clusters = urban_aggl.geometry.intersection(open_areas.geometry[0]).area.values / (1000*1000)  # calculate in square km
+        open_areas_area = open_areas_clusters.sum()
 
-    # =================
-    # 1.3 Mask to urban extent
-
-    print("Masking to urban extent ...")
-
-    coords = getFeatures(urban_aggl)
-
-    # open areas
-    raster = rasterio.open(str(open_areas_path)[0:-4] + '.tif')
-    out_meta = raster.meta.copy()  # Copy the metadata
-    open_areas_ext, out_transform = rasterio.mask.mask(raster, coords, crop=True)
-    out_meta.update({"driver": "GTiff", "height": open_areas_ext.shape[1], "width": open_areas_ext.shape[2],
-                     "transform": out_transform})
-    with rasterio.open(str(open_areas_path)[0:-4] + '.tif', "w", **out_meta) as dest:  # replace file with clipped one
-        dest.write(open_areas_ext)
-
-    # land allocated to streets
-    raster = rasterio.open(str(roads_path)[0:-4] + '.tif')
-    out_meta = raster.meta.copy()  # Copy the metadata
-    roads_ext, out_transform = rasterio.mask.mask(raster, coords, crop=True)
-    out_meta.update({"driver": "GTiff", "height": roads_ext.shape[1], "width": open_areas_ext.shape[2],
-                     "transform": out_transform})
-    with rasterio.open(str(roads_path)[0:-4] + '.tif', "w", **out_meta) as dest:  # replace file with clipped one
-        dest.write(roads_ext)
+        # roads (land allocated to streets)
+        LAS_clusters = urban_aggl.geometry.intersection(roads_clean_geom).area.values / (1000*1000)  # calculate in square km
+        LAS_area = LAS_clusters.sum()
 
     # =================
-    # 1.4 calculate total surface of open areas and roads in urban agglomeration
-
-    print("Calculating areas ...")
-
-    print("done.")
+    # 1.3 (optional) turn layers to 1m rasters, masked to urban extent
 
-    print("----------")
-    print("----------")
-    print("Successfully finished process for SDG indicator 11.7.1 calculation.")
-    print("----------")
-    print("----------")
+    if exportRasters:
+        print("Turning layers to raster and masking to urban extent ...")
 
-    # ALSO CREATE A TEXT FILE TO SAVE PRINTS!
-    sys.stdout = open(str(directory / pathlib.Path('11-results.txt')), 'w')
+        with profiling.stage('rasterize'):
+            coords = getFeatures(urban_aggl)
 
-    # count pixels that are =1
+            # open areas
+            open_areas_ext, out_meta = features_to_array(open_areas.geometry, 1, coords)
+            with rasterio.open(str(volume / pathlib.Path('9-osm_open_areas.tif')), "w", **out_meta) as dest:
+                dest.write_band(1, open_areas_ext)
+            del open_areas_ext
+            print("done OSM open areas file")
 
-    # open areas
-    open_areas_pixels_sum = np.sum(open_areas_ext[0])
-    open_areas_area = open_areas_pixels_sum / (1000*1000)  # pixel size = 1m, calculate in square km
-    print("TOTAL AREA OF OPEN AREAS: {x} square km".format(x=open_areas_area))
-
-    # roads (land allocated to streets)
-    LAS_pixels_sum = np.sum(roads_ext[0])
-    LAS_area = LAS_pixels_sum / (1000*1000) # pixel size = 1m, calculate in square km
-    print("TOTAL AREA OF LAND ALLOCATED TO STREETS: {x} square km".format(x=LAS_area))
+            # land allocated to streets
+            roads_ext, out_meta = features_to_array(roads_clean.geometry, 1, coords)
+            with rasterio.open(str(volume / pathlib.Path('10-osm_roads.tif')), "w", **out_meta) as dest:
+                dest.write_band(1, roads_ext)
+            del roads_ext
+            print("done OSM roads file")
 
     # ================= ================= =================
 
     # 2. calculate total surface of built-up area of the urban agglomeration
 
-    # read raster as np array
-    urb_bua = raster2array(str(urb_bua_path))
-    pixelSize = int(round(urb_bua[1]['transform'][0])) # pixel size = x meters (depending on WMS request)
-    urb_bua[0][urb_bua[0]!=1] = 0 # change the values because rasterio reads it as uint8
-    # count pixels that are =1
-    bua_pixels_sum = np.sum(urb_bua[0])
-    bua_area = (bua_pixels_sum * (pixelSize * pixelSize)) / (1000*1000)  # calculate in square km
-
-    print("TOTAL BUILT-UP AREA OF URBAN AGGLOMERATION: {x} square km".format(x=bua_area))
+    # (the built-up area does not change with OSM, a refresh reuses the area of the previous run)
+    if bua_clusters is None:
+        with profiling.stage('bua'):
+            bua_clusters = bua_km2(urban_aggl, urb_bua)
+        save_bua(volume, bua_clusters)
+    bua_area = bua_clusters.sum()
 
     # ================= ================= =================
 
@@ -222,15 +225,75 @@ def main():
     i = ((open_areas_area + LAS_area) / bua_area)
     perc = "{:.2%}".format(i)
 
-    print("Value for SDG indicator 11.7.1: {v}".format(v=perc))
+    # and for each urban cluster
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i_clusters = (open_areas_clusters + LAS_clusters) / bua_clusters
+
+    print("done.")
+
+    # save results in a text file
+    results = ["TOTAL AREA OF OPEN AREAS: {x} square km".format(x=open_areas_area),
+               "TOTAL AREA OF LAND ALLOCATED TO STREETS: {x} square km".format(x=LAS_area),
+               "TOTAL BUILT-UP AREA OF URBAN AGGLOMERATION: {x} square km".format(x=bua_area),
+               "Value for SDG indicator 11.7.1: {v}".format(v=perc)]
+
+    # results of each urban cluster, if there are more than one
+    clusters = []
+    for n in range(len(bua_clusters)):
+        clusters.append({'cluster': n + 1, 'open_areas_km2': open_areas_clusters[n], 'las_km2': LAS_clusters[n],
+                         'bua_km2': bua_clusters[n], 'sdg_11_7_1': i_clusters[n]})
+    if len(clusters) > 1:
+        for c in clusters:
+            results.append("URBAN CLUSTER {n}: open areas {o} square km, land allocated to streets {l} square km, "
+                           "built-up area {b} square km, SDG indicator 11.7.1: {v:.2%}".format(
+                            n=c['cluster'], o=c['open_areas_km2'], l=c['las_km2'], b=c['bua_km2'], v=c['sdg_11_7_1']))
+
+    banner = ["----------",
+              "----------",
+              "Successfully finished process for SDG indicator 11.7.1 calculation.",
+              "----------",
+              "----------"]
+
+    with open(str(volume / pathlib.Path('11-results.txt')), 'w') as f:
+        f.write("\n".join(results + banner) + "\n")
+
+    print("\n".join(banner + results))
+
+    indicator = {'open_areas_km2': open_areas_area, 'las_km2': LAS_area, 'bua_km2': bua_area, 'sdg_11_7_1': i,
+                 'clusters': clusters}
+
+    return roads_clean, indicator
+
+def main():
+
+    # ================= SETTINGS =========================================
+    # specify directory (volume conected via docker)
+    directory = ''
+    # export the OSM layers as 1m rasters (declared outputs of the VLab workflow, not needed for the indicator)
+    exportRasters = True
 
-    print("----------")
-    print("----------")
-    print("Successfully finished process for SDG indicator 11.7.1 calculation.")
-    print("----------")
-    print("----------")
+    # ================= MAIN PROGRAM ======================================
+    volume = pathlib.Path(directory)
+    urb_bua_path = volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')
+    urban_aggl_path = volume / pathlib.Path('7-bounds.shp')
+    open_areas_path = volume / pathlib.Path('9-osm_open_areas.shp')
+    roads_path = volume / pathlib.Path('10-osm_roads.shp')
+
+    urban_aggl = gpd.read_file(str(urban_aggl_path))
+    open_areas = gpd.read_file(str(open_areas_path))
+    roads = gpd.read_file(str(roads_path))
+
+    # built-up area of the clusters from the previous run if the clusters did not change since (e.g. when
+    # only the OSM layers were refreshed), else read raster as np array
+    bua_clusters = load_bua(volume, len(urban_aggl))
+    urb_bua = raster2array(str(urb_bua_path)) if bua_clusters is None else None
 
-    sys.stdout.close()
+    roads_clean, indicator = index_calculation(volume, urban_aggl, open_areas, roads, urb_bua, exportRasters,
+                                               bua_clusters)
+
+    # export "cleaned" roads (roads except roads in open areas)
+    roads_clean.to_file(str(roads_path))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.script('4_Index_calculation'):
+        main()
\ No newline at end of file
@@ -0,0 +1,166 @@
+# ============ 11.7.1 BATCH =================
+
+# script for 11.7.1 indicator
+
+# This script runs the pipeline (pipeline.py) for many AOIs in one invocation: every feature of a
+# multi-feature AOI file, or every AOI file (.shp, .gpkg, .geojson) of a directory. The CLC raster
+# is downloaded (or opened) once and shared, cities are processed in parallel processes, the
+# outputs of every city are written to its own directory and the indicators of all cities are
+# collected in one table (results.csv). --refresh-osm recalculates the indicator of the cities of a
+# previous batch with the current OSM data only (see pipeline.refresh_osm).
+
+# usage: python3 batch.py cities.gpkg --name-field NAME [--cities 4] [--out cities] [--refresh-osm]
+#        python3 batch.py aois/ [--cities 4] [--out cities] [--refresh-osm]
+
+# ============== IMPORTS =============================================
+import os
+import re
+import csv
+import shutil
+import pathlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+
+import cpus
+import pipeline
+import osm_pbf
+
+# ================= FUNCTIONS =========================================
+
+AOI_SUFFIXES = ('.shp', '.gpkg', '.geojson', '.json')
+
+COLUMNS = ['name', 'open_areas_km2', 'las_km2', 'bua_km2', 'sdg_11_7_1', 'status']
+
+
+def safe_name(name):
+    """Name usable as a directory name"""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name)).strip('_.') or 'aoi'
+
+
+def read_aois(source, nameField=None):
+    """List of (name, AOI GeoDataFrame) from a directory of AOI files (named after the files) or from
+    the features of one file (named after ``nameField``, or numbered)"""
+    source = pathlib.Path(source)
+    aois = []
+    if source.is_dir():
+        for path in sorted(source.iterdir()):
+            if path.suffix.lower() in AOI_SUFFIXES:
+                aois.append((path.stem, gpd.read_file(str(path))))
+    else:
+        features = gpd.read_file(str(source))
+        for i in range(len(features)):
+            name = features[nameField].iloc[i] if nameField else 'aoi_{i}'.format(i=i + 1)
+            aois.append((name, features.iloc[[i]].reset_index(drop=True)))
+
+    # unique directory names
+    names = set()
+    unique = []
+    for name, aoi in aois:
+        name = base = safe_name(name)
+        n = 1
+        while name in names:
+            n += 1
+            name = '{b}_{n}'.format(b=base, n=n)
+        names.add(name)
+        unique.append((name, aoi))
+    return unique
+
+
+def run_city(args):
+    """Run the pipeline for one city in its directory. Returns a row of the results table."""
+    name, aoi, cityDir, options, refreshOsm = args
+    cityDir.mkdir(parents=True, exist_ok=True)
+    row = {'name': name}
+    try:
+        if refreshOsm:
+            indicator = pipeline.refresh_osm(cityDir, options['OSM_pbf'], options['osmStore'])
+        else:
+            indicator = pipeline.run_aoi(cityDir, aoi, **options)
+        if indicator is None:
+            row['status'] = 'outside CLC extent'
+        else:
+            row.update(indicator)
+            row['status'] = 'ok'
+    except Exception as e:
+        traceback.print_exc()
+        row['status'] = 'failed: {e}'.format(e=e)
+    return row
+
+
+def keep_file(path, target):
+    """Hard link (or copy, across file systems) the file ``path`` to ``target``, unless it is ``target``.
+    Returns the path of ``target``."""
+    path, target = pathlib.Path(path), pathlib.Path(target)
+    if path.resolve() != target.resolve():
+        tmp = target.with_name(target.name + '.tmp')
+        if tmp.exists():
+            tmp.unlink()
+        try:
+            os.link(str(path), str(tmp))
+        except OSError:
+            shutil.copyfile(str(path), str(tmp))
+        os.replace(str(tmp), str(target))
+    return str(target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calculate SDG indicator 11.7.1 for many AOIs')
+    parser.add_argument('aois', help='multi-feature AOI file, or directory of AOI files')
+    parser.add_argument('--name-field', default=None, help='attribute with the city names (multi-feature file)')
+    parser.add_argument('--out', default='cities', help='directory for the per-city outputs and results.csv')
+    parser.add_argument('--cities', type=int, default=max(1, cpus.available_cpus() // 2),
+                        help='cities processed in parallel')
+    parser.add_argument('--pixel-size', type=int, default=10, help='HRL pixel size in meters')
+    parser.add_argument('--min-cluster-area', type=float, default=None,
+                        help='keep every urban cluster of at least this area in km2 (default: only the largest)')
+    parser.add_argument('--refresh-osm', action='store_true',
+                        help='only query OSM again for the cities of a previous batch in --out')
+    args = parser.parse_args()
+
+    out = pathlib.Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+
+    aois = read_aois(args.aois, args.name_field)
+    print("Processing {n} AOI(s) with {c} parallel process(es) ...".format(n=len(aois), c=args.cities))
+
+    # download (or open) CLC once for all cities, unless the urban-ness tiles are used or only OSM is refreshed
+    urbannessTiles = os.environ.get('URBANNESS_TILES', '')
+    CLC_path = ''
+    if not urbannessTiles and not args.refresh_osm:
+        clc_clip = pipeline.load_stage('1_CLC_Clip')
+        CLC_path = os.environ.get('CLC_PATH', '')
+        if not CLC_path:
+            # the cities write HRL tiles and Overpass responses to the download cache, whose eviction could
+            # drop the cached CLC image during the batch: the cities read a link (or copy) of it in --out
+            CLC_path = keep_file(clc_clip.clc_source(out, 'CLC2018_1,2,3,10,11.tif'), out / 'CLC2018_1,2,3,10,11.tif')
+
+    # share the CPUs of the dissolve step between the cities processed in parallel
+    os.environ.setdefault('GEOESSENTIAL_WORKERS', str(max(1, cpus.available_cpus() // args.cities)))
+
+    # build the index of the OSM extract (if any) once, before the cities read it
+    OSM_pbf = os.environ.get('OSM_PBF', '')
+    if OSM_pbf:
+        osm_pbf.open_index(OSM_pbf)
+
+    options = {'pixelSize': args.pixel_size, 'CLC_path': CLC_path, 'OSM_pbf': OSM_pbf,
+               'minClusterAreaKm2': args.min_cluster_area, 'urbannessTiles': urbannessTiles,
+               'osmStore': os.environ.get('OSM_STORE', '')}
+    tasks = [(name, aoi, out / name, options, args.refresh_osm) for name, aoi in aois]
+
+    with open(str(out / 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        with ProcessPoolExecutor(max_workers=args.cities) as executor:
+            for row in executor.map(run_city, tasks):
+                writer.writerow(row)
+                f.flush()
+                print("{n}: {s}".format(n=row['name'], s=row['status']))
+
+    print("Results written to {p}".format(p=out / 'results.csv'))
+
+
+if __name__ == '__main__':
+    main()
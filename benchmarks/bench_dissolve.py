@@ -0,0 +1,66 @@
+# ============ BENCHMARK: DISSOLVE =================
+
+# Compares a single unary_union with the partitioned, multi-process dissolve of dissolve.py
+# on synthetic buffered road networks of increasing size, and checks that both give the
+# same geometry (up to floating point noise in the overlay).
+
+# usage: python3 benchmarks/bench_dissolve.py [--ways 1000 10000 50000] [--workers 4]
+
+# ============== IMPORTS =============================================
+import sys
+import time
+import pathlib
+import argparse
+
+import numpy as np
+import shapely.geometry
+from shapely.ops import unary_union
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import dissolve
+
+# ================= FUNCTIONS =========================================
+
+def synthetic_roads(ways, seed=0):
+    """Buffered random polylines (3-9 m wide, 2-8 vertices) with the density of a city
+    street network: about 1000 ways per km2 of a square AOI, in meters"""
+    rng = np.random.RandomState(seed)
+    side = 1000 * np.sqrt(ways / 1000.0)
+    polygons = []
+    for i in range(ways):
+        n = rng.randint(2, 9)
+        start = rng.uniform(0, side, 2)
+        steps = rng.uniform(-40, 40, (n - 1, 2))
+        xy = np.vstack((start, start + np.cumsum(steps, axis=0)))
+        polygons.append(shapely.geometry.LineString(xy).buffer(3 * rng.randint(1, 4)))
+    return polygons
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark unary_union against the partitioned dissolve')
+    parser.add_argument('--ways', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: number of CPUs)')
+    parser.add_argument('--partition-size', type=int, default=2000)
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12} {:>14}".format('ways', 'unary_union', 'dissolve', 'area diff (m2)'))
+    for ways in args.ways:
+        polygons = synthetic_roads(ways)
+
+        start = time.perf_counter()
+        reference = unary_union(polygons)
+        tUnion = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = dissolve.dissolve(polygons, args.workers, args.partition_size)
+        tDissolve = time.perf_counter() - start
+
+        diff = reference.symmetric_difference(result).area
+        print("{:>8} {:>12.3f} {:>12.3f} {:>14.6f}".format(ways, tUnion, tDissolve, diff))
+        if diff > 1e-6 * reference.area:
+            print("MISMATCH: dissolve differs from unary_union for {n} ways".format(n=ways))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# ============ BENCHMARK: RASTER MEMORY =================
+
+# Measures the memory allocated by every raster step of 2_City_Area.py (and the built-up area count of
+# 4_Index_calculation.py) on a synthetic city, for 10/20/30m HRL pixels, with tracemalloc (numpy
+# reports its array buffers to it). The peak of each step includes its output but not its inputs.
+# Every step is also run in the formulation it had before the compact dtypes (int64 masks from
+# np.where, uint32 cumulative sums gathered with index arrays, int32 labels), to show the gain, and
+# the outputs of both are checked to be identical. The in-memory city_area is measured as a whole
+# at the end, next to the same step chained from the legacy formulations.
+
+# usage: python3 benchmarks/bench_memory.py [--km 20] [--pixel-sizes 10 20 30]
+
+# ============== IMPORTS =============================================
+import io
+import gc
+import sys
+import pathlib
+import argparse
+import contextlib
+import tracemalloc
+
+import numpy as np
+import rasterio.crs
+import rasterio.features
+from rasterio.transform import from_origin
+import shapely.geometry
+from shapely.ops import unary_union
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+import neighbourhood
+import pipeline
+import mock_arcgis
+from bench_pipeline import CENTRE, CLC_URBAN
+
+# ================= FUNCTIONS =========================================
+
+def traced(func, *args, **kwargs):
+    """Run ``func`` and return its result and the peak of the memory it allocated, in MB"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak / (1024. * 1024.)
+
+
+def legacy_urban_classes(clc):
+    clc_urban = np.where((clc<=3),clc,0)
+    clc_urban = np.where((clc==10),clc,clc_urban)
+    clc_urban = np.where((clc==11),clc,clc_urban)
+    return clc_urban
+
+
+def legacy_builtup_mask(clc_res, hrl):
+    clc_hrl_urban = np.where((clc_res!=0),hrl,0)
+    clc_hrl_urban = np.where((clc_hrl_urban!=0),1,0)
+    return clc_hrl_urban.astype('uint8')
+
+
+def legacy_box_sum_axis(a, kernelSize, axis):
+    before, after = neighbourhood.kernel_reach(kernelSize)
+    n = a.shape[axis]
+    shape = list(a.shape)
+    shape[axis] = n + 1
+    cs = np.zeros(shape, dtype=np.uint32)
+    body = [slice(None)] * a.ndim
+    body[axis] = slice(1, None)
+    np.cumsum(a, axis=axis, dtype=np.uint32, out=cs[tuple(body)])
+    idx = np.arange(n)
+    hi = np.minimum(idx + after + 1, n)
+    lo = np.maximum(idx - before, 0)
+    return np.take(cs, hi, axis=axis) - np.take(cs, lo, axis=axis)
+
+
+def legacy_neighbourhood_sum(img, kernelSize):
+    return legacy_box_sum_axis(legacy_box_sum_axis(img, kernelSize, 0), kernelSize, 1)
+
+
+def labels_to_clusters(city_area, mask, connectivity=4):
+    return city_area.cluster_ids(mask, 1, connectivity=connectivity)[0]
+
+
+def legacy_labels_to_clusters(city_area, mask, connectivity=4):
+    labels, n = city_area.label_components(mask, connectivity)
+    counts = np.bincount(labels.ravel(), minlength=n + 1)
+    keep = city_area.select_components(counts, 1)
+    lut = np.zeros(int(labels.max()) + 1, np.int32)
+    lut[keep] = np.arange(1, len(keep) + 1, dtype=np.int32)
+    return lut[labels]
+
+
+def legacy_city_area(city_area, clc, hrl, connectivity=4):
+    """``city_area`` chained from the legacy steps (the largest cluster only)"""
+    clc_res = city_area.reproject_array_to_master(legacy_urban_classes(clc[0]), clc[1], hrl[1])
+    builtup = legacy_builtup_mask(clc_res, hrl[0])
+    del clc_res
+    profile = dict(hrl[1], dtype=builtup.dtype)
+    kernelSize = neighbourhood.kernel_size(round(profile['transform'][0]))
+    c = legacy_neighbourhood_sum(builtup, kernelSize)
+    classes = city_area.urbanness_classes(c, kernelSize)
+    del c
+    ids = legacy_labels_to_clusters(city_area, classes, connectivity)
+    parts = [shapely.geometry.shape(geom) for geom, value in
+             rasterio.features.shapes(ids, mask=ids != 0, transform=profile['transform'], connectivity=connectivity)]
+    del ids
+    city_gdf = city_area.clusters_gdf([unary_union(parts)], profile['crs'].to_wkt())
+    bua = city_area.clip_array(builtup, profile, city_area.getFeatures(city_gdf))
+    return {'builtup': (builtup, profile), 'classes': (classes, profile), 'bounds': city_gdf, 'bua': bua}
+
+
+def bua_pixels(geometries, bua, transform, blockSize=1 << 20):
+    labels = rasterio.features.rasterize(((geom, n) for n, geom in enumerate(geometries, 1)), out_shape=bua.shape,
+                                         transform=transform, fill=0, dtype='uint8').ravel()
+    bua = bua.ravel()
+    counts = np.zeros(len(geometries) + 1, np.int64)
+    for start in range(0, labels.size, blockSize):
+        block = slice(start, start + blockSize)
+        counts += np.bincount(labels[block][bua[block] == 1], minlength=len(geometries) + 1)
+    return counts[1:]
+
+
+def legacy_bua_pixels(geometries, bua, transform):
+    labels = rasterio.features.rasterize(((geom, n) for n, geom in enumerate(geometries, 1)), out_shape=bua.shape,
+                                         transform=transform, fill=0, dtype='int32')
+    return np.bincount(labels[bua == 1], minlength=len(geometries) + 1)[1:]
+
+
+def grid(km, pixelSize):
+    """Pixel centres and transform of the ``pixelSize`` grid of a synthetic AOI of ``km`` around CENTRE"""
+    side = int(km * 1000 / pixelSize)
+    transform = from_origin(CENTRE[0] - km * 500., CENTRE[1] + km * 500., pixelSize, pixelSize)
+    cols, rows = np.meshgrid(np.arange(side) + 0.5, np.arange(side) + 0.5)
+    xs, ys = transform * (cols, rows)
+    return xs, ys, transform
+
+
+def synthetic_clc(xs, ys, city):
+    """CLC classes at the points ``xs``, ``ys``: urban classes in built-up areas, other classes elsewhere"""
+    ix, iy = np.floor(xs / 100).astype(np.int64), np.floor(ys / 100).astype(np.int64)
+    urban = mock_arcgis._uniform(ix, iy, 3) < 2 * mock_arcgis.density(xs, ys, city)
+    classes = CLC_URBAN[(mock_arcgis._uniform(ix, iy, 4) * len(CLC_URBAN)).astype(np.int64)]
+    other = (12 + mock_arcgis._uniform(ix, iy, 5) * 33).astype(np.uint8)
+    return np.where(urban, classes, other).astype(np.uint8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory of the raster steps on a synthetic city')
+    parser.add_argument('--km', type=float, default=20, help='side of the synthetic AOI in km')
+    parser.add_argument('--pixel-sizes', type=int, nargs='+', default=[10, 20, 30])
+    args = parser.parse_args()
+
+    city_area = pipeline.load_stage('2_City_Area')
+
+    print("{:>6} {:>12} {:<20} {:>10} {:>10} {:>7}".format('pixel', 'shape', 'step', 'MB', 'legacy MB', 'ratio'))
+    mismatches = []
+    for pixelSize in args.pixel_sizes:
+        city = (CENTRE[0], CENTRE[1], args.km)
+        xs, ys, transform = grid(args.km, pixelSize)
+        hrl, clc = mock_arcgis.imperviousness(xs, ys, city), synthetic_clc(xs, ys, city)
+        del xs, ys
+        kernelSize = neighbourhood.kernel_size(pixelSize)
+        shape = '{}x{}'.format(*hrl.shape)
+
+        clusters = city_area.urban_clusters(
+            city_area.urbanness_classes(neighbourhood.neighbourhood_sum(
+                city_area.builtup_mask(city_area.urban_classes(clc), hrl), kernelSize), kernelSize), transform)
+
+        steps = [
+            ('urban_classes', lambda: city_area.urban_classes(clc), lambda: legacy_urban_classes(clc)),
+            ('builtup_mask', lambda: city_area.builtup_mask(clc_urban, hrl),
+             lambda: legacy_builtup_mask(clc_urban, hrl)),
+            ('neighbourhood_sum', lambda: neighbourhood.neighbourhood_sum(builtup, kernelSize),
+             lambda: legacy_neighbourhood_sum(builtup, kernelSize)),
+            ('urbanness_classes', lambda: city_area.urbanness_classes(c, kernelSize), None),
+            ('label', lambda: labels_to_clusters(city_area, classes),
+             lambda: legacy_labels_to_clusters(city_area, classes)),
+            ('bua', lambda: bua_pixels(clusters, builtup, transform),
+             lambda: legacy_bua_pixels(clusters, builtup, transform)),
+        ]
+        for name, step, legacy in steps:
+            result, mb = traced(step)
+            legacyMb = None
+            if legacy is not None:
+                reference, legacyMb = traced(legacy)
+                if not np.array_equal(result, reference):
+                    mismatches.append("{n} at {p}m".format(n=name, p=pixelSize))
+                del reference
+            print("{:>5}m {:>12} {:<20} {:>10.1f} {:>10} {:>7}".format(
+                pixelSize, shape, name, mb, '-' if legacyMb is None else '{:.1f}'.format(legacyMb),
+                '-' if legacyMb is None else '{:.1f}x'.format(legacyMb / mb)))
+
+            # inputs of the next steps
+            if name == 'urban_classes':
+                clc_urban = result
+            elif name == 'builtup_mask':
+                builtup = result
+            elif name == 'neighbourhood_sum':
+                c = result
+            elif name == 'urbanness_classes':
+                classes = result
+            del result
+        del clc_urban, builtup, c, classes
+
+        # the whole in-memory step, from the CLC at 100m (its messages are not printed)
+        xs, ys, clc_transform = grid(args.km, 100)
+        clc = synthetic_clc(xs, ys, city)
+        del xs, ys
+        crs = rasterio.crs.CRS.from_epsg(3035)
+        clc_profile = {'driver': 'GTiff', 'dtype': 'uint8', 'nodata': 0, 'count': 1, 'crs': crs,
+                       'height': clc.shape[0], 'width': clc.shape[1], 'transform': clc_transform}
+        hrl_profile = dict(clc_profile, nodata=None, height=hrl.shape[0], width=hrl.shape[1], transform=transform)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result, mb = traced(city_area.city_area, (clc, clc_profile), (hrl, hrl_profile))
+        reference, legacyMb = traced(legacy_city_area, city_area, (clc, clc_profile), (hrl, hrl_profile))
+        if not (np.array_equal(result['bua'][0], reference['bua'][0]) and
+                result['bounds'].geometry[0].equals(reference['bounds'].geometry[0])):
+            mismatches.append("city_area at {p}m".format(p=pixelSize))
+        del result, reference
+        print("{:>5}m {:>12} {:<20} {:>10.1f} {:>10.1f} {:>6.1f}x".format(pixelSize, shape, 'city_area', mb, legacyMb,
+                                                                       legacyMb / mb))
+
+    for m in mismatches:
+        print("MISMATCH: {m}".format(m=m))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# ============ BENCHMARK: NEIGHBOURHOOD SUM =================
+
+# Compares the neighbourhood sum backends of neighbourhood.py on a synthetic
+# built-up mask, for the kernel sizes of 10/20/30m HRL pixels, serially and in
+# strips on several threads, and checks that they all give the serial counts.
+
+# usage: python3 benchmarks/bench_neighbourhood.py [--km 10] [--methods sat convolve] [--workers 1 4 16]
+
+# ============== IMPORTS =============================================
+import sys
+import time
+import pathlib
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import cpus
+import neighbourhood
+
+# ================= FUNCTIONS =========================================
+
+def synthetic_builtup(rows, cols, density=0.3, seed=0):
+    """Random binary built-up mask (uint8)"""
+    rng = np.random.RandomState(seed)
+    return (rng.random_sample((rows, cols)) < density).astype(np.uint8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the neighbourhood sum backends')
+    parser.add_argument('--km', type=float, default=10, help='side of the synthetic AOI in km')
+    parser.add_argument('--pixel-sizes', type=int, nargs='+', default=[10, 20, 30])
+    parser.add_argument('--methods', nargs='+', default=list(neighbourhood.METHODS))
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, cpus.workers()}),
+                        help='thread counts (1 = serial)')
+    args = parser.parse_args()
+
+    print("{:>6} {:>12} {:>7} {:>10} {:>8} {:>10}".format('pixel', 'shape', 'kernel', 'method', 'threads',
+                                                          'seconds'))
+    for pixelSize in args.pixel_sizes:
+        side = int(args.km * 1000 / pixelSize)
+        img = synthetic_builtup(side, side)
+        kernelSize = neighbourhood.kernel_size(pixelSize)
+
+        # the serial sum of the first method is the reference
+        reference = neighbourhood.neighbourhood_sum(img, kernelSize, method=args.methods[0])
+        for method in args.methods:
+            for workers in args.workers:
+                start = time.perf_counter()
+                result = neighbourhood.neighbourhood_sum(img, kernelSize, method=method, workers=workers)
+                elapsed = time.perf_counter() - start
+                print("{:>5}m {:>12} {:>7} {:>10} {:>8} {:>10.3f}".format(pixelSize, '{}x{}'.format(side, side),
+                                                                         kernelSize, method, workers, elapsed))
+                if not np.array_equal(reference, result):
+                    print("MISMATCH: {m} on {w} thread(s) differs from serial {r} at {p}m".format(
+                        m=method, w=workers, r=args.methods[0], p=pixelSize))
+                    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# ============ BENCHMARK: PIPELINE =================
+
+# Times every step of the 0->4 pipeline (pipeline.py) offline, on synthetic cities of several sizes
+# and HRL pixel sizes. For each scenario the AOI is a square of the city size, the CLC raster is a
+# synthetic 100m raster of the same city written to disk, and the HRL tiles and OSM ways are served
+# by the local stand-ins of the ArcGIS exportImage (mock_arcgis.py) and Overpass (mock_overpass.py)
+# endpoints, through ARCGIS_URL and OVERPASS_URL. The download cache is disabled, so every run
+# downloads its inputs. The stage timings come from the profile of the run (11-profile.json,
+# see profiling.py); each scenario runs in a freshly started interpreter, so the peak memory of a
+# scenario does not include the memory of the mock servers or of the previous scenarios.
+
+# The results are compared with a stored baseline (by default benchmarks/baseline_pipeline.json,
+# written with --update-baseline on the reference machine): a stage is reported as a regression when
+# it is slower or uses more memory than the baseline by more than the tolerance, and a scenario when
+# its indicator value changed. The exit status is 1 if anything regressed.
+
+# usage: python3 benchmarks/bench_pipeline.py [--sizes 5 20 50] [--pixel-sizes 10 20 30] [--repeat 3]
+#        python3 benchmarks/bench_pipeline.py --update-baseline
+
+# ============== IMPORTS =============================================
+import os
+import sys
+import json
+import shutil
+import pathlib
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import geopandas as gpd
+import shapely.geometry
+from rasterio.transform import from_origin
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+import cpus
+import mock_arcgis
+import mock_overpass
+
+# ================= FUNCTIONS =========================================
+
+CENTRE = (3760000., 2890000.)  # EPSG:3035 centre of the synthetic cities
+BASELINE = pathlib.Path(__file__).resolve().parent / 'baseline_pipeline.json'
+CLC_URBAN = np.array([1, 2, 3, 10, 11], np.uint8)
+
+
+def scenario_name(km, pixelSize):
+    return '{k:g}km_{p}m'.format(k=km, p=pixelSize)
+
+
+def synthetic_clc(path, bounds, city, pixelSize=100):
+    """Synthetic CLC raster (urban classes 1,2,3,10,11, 0 elsewhere) of the ``city`` over ``bounds``"""
+    xmin, ymin, xmax, ymax = bounds
+    width, height = int(np.ceil((xmax - xmin) / pixelSize)), int(np.ceil((ymax - ymin) / pixelSize))
+    xs = xmin + (np.arange(width) + 0.5) * pixelSize
+    ys = ymax - (np.arange(height) + 0.5) * pixelSize
+    xs, ys = np.meshgrid(xs, ys)
+    ix, iy = np.floor(xs / pixelSize).astype(np.int64), np.floor(ys / pixelSize).astype(np.int64)
+    urban = mock_arcgis._uniform(ix, iy, 3) < 2 * mock_arcgis.density(xs, ys, city)
+    classes = CLC_URBAN[(mock_arcgis._uniform(ix, iy, 4) * len(CLC_URBAN)).astype(np.int64)]
+    clc = np.where(urban, classes, 0).astype(np.uint8)
+    with rasterio.open(str(path), 'w', driver='GTiff', width=width, height=height, count=1, dtype='uint8',
+                       crs='EPSG:3035', transform=from_origin(xmin, ymax, pixelSize, pixelSize), nodata=0) as dst:
+        dst.write(clc, 1)
+
+
+def write_inputs(directory, km):
+    """AOI (square of ``km`` side around CENTRE) and synthetic CLC of the scenario in ``directory``.
+    Returns the AOI GeoDataFrame and the path of the CLC raster."""
+    half = km * 1000 / 2.
+    bounds = (CENTRE[0] - half, CENTRE[1] - half, CENTRE[0] + half, CENTRE[1] + half)
+    aoi = gpd.GeoDataFrame(geometry=[shapely.geometry.box(*bounds)], crs='epsg:3035')
+    clc_path = directory / 'clc.tif'
+    # CLC reaches 1 km beyond the AOI, like a clip of the European raster
+    synthetic_clc(clc_path, (bounds[0] - 1000, bounds[1] - 1000, bounds[2] + 1000, bounds[3] + 1000),
+                  (CENTRE[0], CENTRE[1], km))
+    return aoi, clc_path
+
+
+def run_scenario(km, pixelSize, workdir, repeat):
+    """Run the pipeline ``repeat`` times for a scenario. Returns the fastest wall time and the largest
+    peak memory of every stage, and the indicator value."""
+    import pipeline
+
+    directory = pathlib.Path(workdir) / scenario_name(km, pixelSize)
+    directory.mkdir(parents=True, exist_ok=True)
+    aoi, clc_path = write_inputs(directory, km)
+
+    stages = {}
+    indicator = None
+    for r in range(repeat):
+        volume = directory / 'run'
+        if volume.exists():
+            shutil.rmtree(str(volume))
+        volume.mkdir()
+        indicator = pipeline.run_aoi(volume, aoi, pixelSize=pixelSize, CLC_path=str(clc_path))
+        with open(str(volume / pipeline.profiling.REPORT)) as f:
+            profile = json.load(f)
+        for record in profile['stages']:
+            best = stages.setdefault(record['stage'], {'wall_s': record['wall_s'], 'cpu_s': record['cpu_s'],
+                                                       'peak_rss_mb': record['peak_rss_mb']})
+            if record['wall_s'] < best['wall_s']:
+                best.update(wall_s=record['wall_s'], cpu_s=record['cpu_s'])
+            if record['peak_rss_mb'] is not None:
+                best['peak_rss_mb'] = max(best['peak_rss_mb'] or 0, record['peak_rss_mb'])
+
+    total = sum(s['wall_s'] for name, s in stages.items() if '/' not in name)
+    return {'stages': stages, 'wall_s': round(total, 3),
+            'sdg_11_7_1': None if indicator is None else float(indicator['sdg_11_7_1'])}
+
+
+def compare(results, baseline, tolerance, minSeconds=0.1, minMb=16):
+    """List of the regressions of ``results`` against ``baseline``"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if base.get('sdg_11_7_1') is not None and result['sdg_11_7_1'] is not None and \
+                abs(result['sdg_11_7_1'] - base['sdg_11_7_1']) > 1e-9:
+            regressions.append("{n}: indicator changed from {b:.6f} to {r:.6f}".format(
+                n=name, b=base['sdg_11_7_1'], r=result['sdg_11_7_1']))
+        for stage, s in result['stages'].items():
+            b = base['stages'].get(stage)
+            if b is None:
+                continue
+            if s['wall_s'] > b['wall_s'] * (1 + tolerance) and s['wall_s'] - b['wall_s'] > minSeconds:
+                regressions.append("{n} {s}: {r:.3f}s, baseline {b:.3f}s".format(n=name, s=stage, r=s['wall_s'],
+                                                                                b=b['wall_s']))
+            if s['peak_rss_mb'] and b['peak_rss_mb'] and s['peak_rss_mb'] > b['peak_rss_mb'] * (1 + tolerance) \
+                    and s['peak_rss_mb'] - b['peak_rss_mb'] > minMb:
+                regressions.append("{n} {s}: {r:.0f} MB, baseline {b:.0f} MB".format(
+                    n=name, s=stage, r=s['peak_rss_mb'], b=b['peak_rss_mb']))
+    return regressions
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': cpus.available_cpus()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic cities with local stand-ins '
+                                                 'for the HRL and Overpass services')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[5, 20, 50], help='city sizes in km')
+    parser.add_argument('--pixel-sizes', type=int, nargs='+', default=[10, 20, 30], help='HRL pixel sizes in m')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario (the fastest is kept)')
+    parser.add_argument('--ways-per-cell', type=int, default=20, help='OSM ways per 0.01 x 0.01 degree cell')
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown / memory growth')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    parser.add_argument('--workdir', default=None, help='directory for the runs (default: a temporary one)')
+    args = parser.parse_args()
+
+    arcgis, arcgisUrl = mock_arcgis.serve((CENTRE[0], CENTRE[1], max(args.sizes)))
+    overpass, overpassUrl = mock_overpass.serve(waysPerCell=args.ways_per_cell)
+    os.environ['ARCGIS_URL'] = arcgisUrl
+    os.environ['OVERPASS_URL'] = overpassUrl
+    os.environ['GEOESSENTIAL_CACHE_MAX_MB'] = '0'
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    results = {}
+    try:
+        for km in args.sizes:
+            arcgis.city = (CENTRE[0], CENTRE[1], km)
+            for pixelSize in args.pixel_sizes:
+                name = scenario_name(km, pixelSize)
+                print("Running {n} ...".format(n=name))
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    results[name] = executor.submit(run_scenario, km, pixelSize, workdir, args.repeat).result()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        arcgis.shutdown()
+        overpass.shutdown()
+
+    print("{:<12} {:<42} {:>9} {:>9} {:>9} {:>9}".format('scenario', 'stage', 'wall (s)', 'cpu (s)', 'peak MB',
+                                                        'baseline'))
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+    for name, result in results.items():
+        for stage, s in result['stages'].items():
+            b = baseline.get(name, {}).get('stages', {}).get(stage)
+            print("{:<12} {:<42} {:>9.3f} {:>9.3f} {:>9} {:>9}".format(
+                name, stage, s['wall_s'], s['cpu_s'], '-' if s['peak_rss_mb'] is None else s['peak_rss_mb'],
+                '-' if b is None else '{:.3f}'.format(b['wall_s'])))
+        print("{:<12} {:<42} {:>9.3f}   SDG 11.7.1 = {v}".format(name, 'total', result['wall_s'],
+                                                                v=result['sdg_11_7_1']))
+
+    report = {'machine': machine(), 'scenarios': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Baseline written to {p}".format(p=args.baseline))
+        return
+
+    if not baseline:
+        print("No baseline at {p} (run with --update-baseline to store one)".format(p=args.baseline))
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION: " + r)
+    if regressions:
+        sys.exit(1)
+    print("No regressions against {p}".format(p=args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# ============ MOCK ARCGIS IMAGE SERVER =================
+
+# Local stand-in for the exportImage endpoint of the ArcGIS REST image service of the HRL
+# imperviousness layer, to run 0_Download_data.py (and the benchmarks) offline. Answers
+# exportImage requests with a synthetic GeoTIFF (uint8, EPSG:3035) of the requested bbox and
+# size. Imperviousness is drawn from a synthetic city: the share of built-up pixels falls off
+# with the distance from the city centre, and every pixel is decided by a hash of its position
+# on the 10m grid, so tiles and pixel sizes agree with each other wherever they overlap.
+
+# usage: python3 benchmarks/mock_arcgis.py [--port 8002] [--centre 3760000 2890000] [--km 20]
+#        ARCGIS_URL=http://127.0.0.1:8002 python3 0_Download_data.py
+
+# ============== IMPORTS =============================================
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+
+# ================= FUNCTIONS =========================================
+
+GRID = 10.0  # meters, pixels are decided on this grid
+
+
+def _uniform(ix, iy, salt):
+    """Deterministic uniform numbers in [0, 1) from integer grid positions (splitmix64-style hash)"""
+    h = ix.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    h ^= iy.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F) + np.uint64(salt)
+    h ^= h >> np.uint64(31)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(29)
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def density(xs, ys, city):
+    """Share of built-up pixels at the points ``xs``, ``ys`` (EPSG:3035 meters) of a synthetic city
+    ``city`` = (centre x, centre y, size in km): a dense centre, and towns around it"""
+    cx, cy, km = city
+    radius = km * 1000 / 2.
+    d = np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * (radius / 2.) ** 2))
+    # towns at 3/4 of the radius, a tenth of the size of the city
+    for angle in (0.5, 2.3, 4.1):
+        tx, ty = cx + 0.75 * radius * np.cos(angle), cy + 0.75 * radius * np.sin(angle)
+        d = np.maximum(d, 0.8 * np.exp(-((xs - tx) ** 2 + (ys - ty) ** 2) / (2 * (radius / 10.) ** 2)))
+    return d
+
+
+def imperviousness(xs, ys, city):
+    """Synthetic HRL imperviousness density (0-100) at the points ``xs``, ``ys``"""
+    ix, iy = np.floor(xs / GRID).astype(np.int64), np.floor(ys / GRID).astype(np.int64)
+    builtup = _uniform(ix, iy, 1) < 0.9 * density(xs, ys, city)
+    return np.where(builtup, 1 + (_uniform(ix, iy, 2) * 100).astype(np.int64), 0).astype(np.uint8)
+
+
+def export_image(bbox, width, height, city):
+    """GeoTIFF bytes of the synthetic imperviousness of ``bbox`` (xmin, ymin, xmax, ymax) at ``width``
+    x ``height`` pixels, sampled at the pixel centres"""
+    xmin, ymin, xmax, ymax = bbox
+    transform = from_bounds(xmin, ymin, xmax, ymax, width, height)
+    cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    xs, ys = transform * (cols, rows)
+    image = imperviousness(xs, ys, city)
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', width=width, height=height, count=1, dtype='uint8', crs='EPSG:3035',
+                          transform=transform) as dst:
+            dst.write(image, 1)
+        return memfile.read()
+
+
+class ExportImageHandler(BaseHTTPRequestHandler):
+    """Answers GET .../exportImage?bbox=...&size=...; options are set on the server object"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        with self.server.lock:
+            self.server.requests += 1
+        if not url.path.endswith('/exportImage') or 'bbox' not in params or 'size' not in params:
+            self.send_response(400)
+            self.end_headers()
+            return
+        bbox = [float(v) for v in params['bbox'][0].split(',')]
+        width, height = [int(v) for v in params['size'][0].split(',')]
+        time.sleep(self.server.delay)
+        body = export_image(bbox, width, height, self.server.city)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(city, port=0, delay=0.0):
+    """Start the mock server on a background thread for the synthetic ``city`` (centre x, centre y, km;
+    can be changed later through ``server.city``). Returns the server and the server URL."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), ExportImageHandler)
+    server.daemon_threads = True
+    server.city = city
+    server.delay = delay
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{p}'.format(p=server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the ArcGIS exportImage endpoint with a synthetic city')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--centre', type=float, nargs=2, default=[3760000, 2890000], help='EPSG:3035 x y')
+    parser.add_argument('--km', type=float, default=20, help='size of the synthetic city in km')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before each answer')
+    args = parser.parse_args()
+
+    server, url = serve((args.centre[0], args.centre[1], args.km), args.port, args.delay)
+    print("Mock ArcGIS image server at {u} (Ctrl+C to stop)".format(u=url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("{r} requests".format(r=server.requests))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
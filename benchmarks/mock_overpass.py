@@ -0,0 +1,161 @@
+# ============ MOCK OVERPASS SERVER =================
+
+# Local stand-in for the Overpass API, to run 3_OSM_Layers.py (and the benchmarks) offline.
+# Answers `[out:json]` queries with synthetic ways inside the query bbox: roads for queries
+# with "highway" and open area polygons otherwise. Ways are generated per 0.01 degree cell
+# from a fixed seed, so overlapping queries return the same ways with the same ids, and can
+# reject requests with 429 / 504 to exercise the retries of the client.
+
+# usage: python3 benchmarks/mock_overpass.py [--port 8001] [--ways-per-cell 20] [--fail-rate 0.2]
+#        OVERPASS_URL=http://127.0.0.1:8001/api/interpreter python3 3_OSM_Layers.py
+
+# ============== IMPORTS =============================================
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+# ================= FUNCTIONS =========================================
+
+CELL_DEGREES = 0.01
+MAX_EXTENT = 0.005  # ways reach at most this far (in degrees) from their cell
+
+BBOX = re.compile(r'\(\s*([-0-9.eE]+)\s*,\s*([-0-9.eE]+)\s*,\s*([-0-9.eE]+)\s*,\s*([-0-9.eE]+)\s*\)')
+
+
+def _seed(*values):
+    return int(hashlib.md5(repr(values).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def cell_ways(col, row, kind, waysPerCell, seed=0):
+    """Synthetic ways (Overpass elements) starting in grid cell (col, row)"""
+    rng = np.random.RandomState(_seed(col, row, kind, seed))
+    x0, y0 = col * CELL_DEGREES, row * CELL_DEGREES
+    elements = []
+    for k in range(waysPerCell):
+        cx, cy = x0 + rng.uniform(0, CELL_DEGREES), y0 + rng.uniform(0, CELL_DEGREES)
+        if kind == 'open':
+            r = rng.uniform(0.0002, MAX_EXTENT / 2)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 8))
+            xs, ys = cx + r * np.cos(angles), cy + 0.7 * r * np.sin(angles)
+            xs, ys = np.append(xs, xs[0]), np.append(ys, ys[0])
+            tags = {'leisure': 'park'}
+        else:
+            n = rng.randint(2, 9)
+            step = MAX_EXTENT / (n - 1)
+            xs = np.clip(cx + np.concatenate(([0], np.cumsum(rng.uniform(-step, step, n - 1)))),
+                         cx - MAX_EXTENT, cx + MAX_EXTENT)
+            ys = np.clip(cy + np.concatenate(([0], np.cumsum(rng.uniform(-step, step, n - 1)))),
+                         cy - MAX_EXTENT, cy + MAX_EXTENT)
+            tags = {'highway': 'residential'}
+            if rng.random_sample() < 0.3:
+                tags['lanes'] = str(rng.randint(1, 4))
+        elements.append({'type': 'way', 'id': _seed(col, row, kind, seed, k),
+                         'bounds': {'minlat': float(ys.min()), 'minlon': float(xs.min()),
+                                    'maxlat': float(ys.max()), 'maxlon': float(xs.max())},
+                         'geometry': [{'lat': round(float(y), 7), 'lon': round(float(x), 7)} for x, y in zip(xs, ys)],
+                         'tags': tags})
+    return elements
+
+
+def query_elements(query, waysPerCell, seed=0):
+    """Synthetic answer to an Overpass query: the ways whose bounds intersect the query bbox"""
+    south, west, north, east = [float(v) for v in BBOX.search(query).groups()]
+    kind = 'roads' if 'highway' in query else 'open'
+    elements = []
+    for row in range(int(np.floor((south - MAX_EXTENT) / CELL_DEGREES)), int(np.ceil((north + MAX_EXTENT) / CELL_DEGREES))):
+        for col in range(int(np.floor((west - MAX_EXTENT) / CELL_DEGREES)), int(np.ceil((east + MAX_EXTENT) / CELL_DEGREES))):
+            for element in cell_ways(col, row, kind, waysPerCell, seed):
+                b = element['bounds']
+                if b['minlon'] <= east and b['maxlon'] >= west and b['minlat'] <= north and b['maxlat'] >= south:
+                    elements.append(element)
+    return elements
+
+
+class OverpassHandler(BaseHTTPRequestHandler):
+    """Answers GET/POST /api/interpreter?data=<query>; options are set on the server object"""
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query).get('data', [''])[0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.answer(parse_qs(body).get('data', [''])[0])
+
+    def answer(self, query):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            busy = server.active > server.maxConcurrent
+            fail = server.rng.random_sample() < server.failRate
+        try:
+            if busy or fail:
+                server.rejected += 1
+                self.send_response(429 if busy else 504)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            if not BBOX.search(query):
+                self.send_response(400)
+                self.end_headers()
+                return
+            time.sleep(server.delay)
+            body = json.dumps({'version': 0.6, 'generator': 'mock Overpass API',
+                               'elements': query_elements(query, server.waysPerCell, server.seed)}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, waysPerCell=20, failRate=0.0, maxConcurrent=2, delay=0.0, seed=0):
+    """Start the mock server on a background thread. Returns the server and the interpreter URL."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), OverpassHandler)
+    server.daemon_threads = True
+    server.waysPerCell = waysPerCell
+    server.failRate = failRate
+    server.maxConcurrent = maxConcurrent
+    server.delay = delay
+    server.seed = seed
+    server.rng = np.random.RandomState(seed)
+    server.lock = threading.Lock()
+    server.requests = server.rejected = server.active = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{p}/api/interpreter'.format(p=server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Overpass API with synthetic ways')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ways-per-cell', type=int, default=20, help='ways per 0.01 x 0.01 degree cell')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with 504')
+    parser.add_argument('--max-concurrent', type=int, default=2, help='concurrent requests before answering 429')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before each answer')
+    args = parser.parse_args()
+
+    server, url = serve(args.port, args.ways_per_cell, args.fail_rate, args.max_concurrent, args.delay)
+    print("Mock Overpass API at {u} (Ctrl+C to stop)".format(u=url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("{r} requests, {x} rejected".format(r=server.requests, x=server.rejected))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
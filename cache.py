@@ -0,0 +1,141 @@
+# ============ DOWNLOAD CACHE =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Content-addressed on-disk cache for remote inputs (HRL tiles, CLC GeoTIFF, Overpass responses).
+# Entries are keyed on the request parameters, evicted least-recently-used when the cache grows
+# over its size cap, and optionally expired after a time-to-live.
+#
+# Environment variables:
+#   GEOESSENTIAL_CACHE_DIR      cache directory (default ~/.cache/geoessential)
+#   GEOESSENTIAL_CACHE_MAX_MB   size cap in MB, 0 disables the cache (default 4096)
+#   GEOESSENTIAL_CACHE_TTL      time-to-live of entries in seconds (default: no expiry)
+
+# ============== IMPORTS =============================================
+import os
+import json
+import time
+import hashlib
+import pathlib
+import tempfile
+import contextlib
+
+# ================= FUNCTIONS =========================================
+
+class DiskCache:
+    """Size-capped LRU cache of files, addressed by a hash of the request parameters.
+    The modification time of an entry is its creation time (used for the TTL) and the
+    access time is refreshed on every hit (used for the LRU order)."""
+
+    def __init__(self, directory, maxBytes, ttl=None):
+        self.directory = pathlib.Path(directory)
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.maxBytes > 0
+
+    @staticmethod
+    def key(**params):
+        """Hash the request parameters (service, bbox, pixel size, query text, ...) into a cache key"""
+        canonical = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        """Return the path of a cached entry, or None on a miss or an expired entry"""
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            self._remove(path)
+            return None
+        os.utime(str(path), (now, stat.st_mtime))  # mark as recently used
+        return path
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        """Context manager yielding a binary file to stream an entry into.
+        The entry only becomes visible once the block exits without error."""
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(tmp, str(path))
+        except BaseException:
+            self._remove(pathlib.Path(tmp))
+            raise
+        self.evict(keep=path)
+
+    def put(self, key, data):
+        """Store ``data`` (bytes) and return the entry path"""
+        with self.writer(key) as f:
+            f.write(data)
+        return self.path(key)
+
+    def fetch(self, key, download):
+        """Return the cached bytes for ``key``, calling ``download()`` and storing its result on a miss"""
+        path = self.get(key)
+        if path is not None:
+            try:
+                with open(str(path), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:  # evicted by a concurrent process since get(), a miss
+                pass
+        data = download()
+        if self.enabled:
+            self.put(key, data)
+        return data
+
+    def evict(self, keep=None):
+        """Drop expired entries, then least-recently-used entries until the cache fits its size cap.
+        The entry at ``keep`` (the one just written, which the caller is about to use) is never dropped,
+        even if it is larger than the cap on its own; a later eviction drops it."""
+        entries = []
+        now = time.time()
+        for path in self.directory.glob('*/*'):
+            if path.name.startswith('.tmp-'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by a concurrent writer
+                continue
+            if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                self._remove(path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for atime, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.maxBytes:
+                break
+            if path == keep:
+                continue
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def default_cache():
+    """Cache configured from the GEOESSENTIAL_CACHE_* environment variables"""
+    directory = os.environ.get('GEOESSENTIAL_CACHE_DIR',
+                               str(pathlib.Path.home() / '.cache' / 'geoessential'))
+    maxBytes = int(float(os.environ.get('GEOESSENTIAL_CACHE_MAX_MB', 4096)) * 1024 * 1024)
+    ttl = os.environ.get('GEOESSENTIAL_CACHE_TTL')
+    return DiskCache(directory, maxBytes, float(ttl) if ttl else None)
@@ -0,0 +1,53 @@
+# ============ CPUS =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Number of CPUs the scripts may use, for the worker processes of the dissolve, the threads of the
+# neighbourhood sum and the cities processed in parallel by batch.py. os.cpu_count() is the number of
+# CPUs of the host: inside a container limited with docker --cpus (e.g. the cpu_units of the VLab
+# workflow) on a large host, it starts far more workers than the container may run, each with its own
+# memory. The CPU affinity of the process, capped by the CPU quota of its cgroup, is used instead;
+# GEOESSENTIAL_WORKERS overrides it.
+
+# References:
+# https://www.kernel.org/doc/html/latest/admin-guide/cgroup-v2.html#cpu-interface-files
+
+# ============== IMPORTS =============================================
+import os
+import math
+
+# ================= FUNCTIONS =========================================
+
+def _cgroup_cpu_quota():
+    """CPU quota of the cgroup of the process (docker --cpus) in CPUs, or None if there is none"""
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" without quota
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (IOError, OSError, ValueError):
+        try:
+            # cgroup v1: -1 without quota
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as g:
+                quota, period = f.read().strip(), g.read().strip()
+        except (IOError, OSError):
+            return None
+    if quota in ('max', '-1'):
+        return None
+    return int(quota) / float(period)
+
+
+def available_cpus():
+    """CPUs the process may use: its CPU affinity, capped by the CPU quota of its cgroup"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = max(1, min(cpus, int(math.ceil(quota))))
+    return cpus
+
+
+def workers():
+    """Number of workers of a parallel step (GEOESSENTIAL_WORKERS, or the available CPUs)"""
+    return int(os.environ.get('GEOESSENTIAL_WORKERS', 0)) or available_cpus()
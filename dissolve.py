@@ -0,0 +1,113 @@
+# ============ DISSOLVE =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Union (dissolve) and difference of large sets of polygons, such as the OSM open areas and the
+# buffered road network of a city. Geometries are partitioned spatially (sort-tile-recursive on the
+# centres of their bounding boxes), each partition is unioned in a separate process and the partial
+# results, far fewer and with their internal boundaries already dissolved, are merged with one union.
+
+# References:
+# https://en.wikipedia.org/wiki/R-tree#Packing
+# https://shapely.readthedocs.io/en/stable/manual.html#shapely.ops.unary_union
+
+# ============== IMPORTS =============================================
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely.geometry
+from shapely.ops import unary_union
+
+import cpus
+
+# ================= FUNCTIONS =========================================
+
+def _union(geometries):
+    return unary_union(geometries)
+
+
+def _difference(args):
+    geometries, others = args
+    return unary_union(geometries).difference(unary_union(others))
+
+
+def polygons(geometry):
+    """List of the polygons of a Polygon, MultiPolygon or GeometryCollection"""
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == 'Polygon':
+        return [geometry]
+    if geometry.geom_type in ('MultiPolygon', 'GeometryCollection'):
+        return [p for g in geometry.geoms for p in polygons(g)]
+    return []
+
+
+def bounds_array(geometries):
+    """(n, 4) array with the (minx, miny, maxx, maxy) bounds of the geometries"""
+    return np.array([g.bounds for g in geometries], dtype=np.float64).reshape(-1, 4)
+
+
+def str_partitions(geometries, partitionSize):
+    """Split ``geometries`` in spatially compact groups of at most ``partitionSize`` geometries
+    (sort-tile-recursive packing)"""
+    n = len(geometries)
+    if n <= partitionSize:
+        return [list(geometries)]
+
+    bounds = bounds_array(geometries)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    nSlices = int(math.ceil(math.sqrt(math.ceil(n / partitionSize))))
+    sliceSize = int(math.ceil(n / nSlices))
+
+    partitions = []
+    byX = np.argsort(cx, kind='stable')
+    for start in range(0, n, sliceSize):
+        columns = byX[start:start + sliceSize]
+        columns = columns[np.argsort(cy[columns], kind='stable')]
+        for chunk in range(0, len(columns), partitionSize):
+            partitions.append([geometries[i] for i in columns[chunk:chunk + partitionSize]])
+    return partitions
+
+
+def dissolve(geometries, maxWorkers=None, partitionSize=2000):
+    """Union of ``geometries``. Small inputs (up to ``partitionSize`` geometries) or a single worker
+    use one ``unary_union``; larger inputs are partitioned and unioned on ``maxWorkers`` processes."""
+    geometries = [g for g in geometries if g is not None and not g.is_empty]
+    maxWorkers = maxWorkers or cpus.workers()
+    if len(geometries) <= partitionSize or maxWorkers <= 1:
+        return unary_union(geometries)
+
+    parts = str_partitions(geometries, partitionSize)
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        parts = list(executor.map(_union, parts))
+    return unary_union(parts)
+
+
+def difference(geometry, other, maxWorkers=None, partitionSize=2000):
+    """``geometry`` minus ``other`` for (multi)polygons with many parts. The polygons of ``geometry``
+    are partitioned and each partition only subtracts the polygons of ``other`` that overlap its
+    bounding box. The polygons of a dissolved geometry do not overlap, so the partial differences
+    are collected without another union."""
+    parts = polygons(geometry)
+    maxWorkers = maxWorkers or cpus.workers()
+    if len(parts) <= partitionSize or maxWorkers <= 1:
+        return geometry.difference(other)
+
+    others = polygons(other)
+    otherBounds = bounds_array(others)
+
+    tasks = []
+    for partition in str_partitions(parts, partitionSize):
+        b = bounds_array(partition)
+        minx, miny = b[:, 0].min(), b[:, 1].min()
+        maxx, maxy = b[:, 2].max(), b[:, 3].max()
+        overlap = np.flatnonzero((otherBounds[:, 0] <= maxx) & (otherBounds[:, 2] >= minx) &
+                                 (otherBounds[:, 1] <= maxy) & (otherBounds[:, 3] >= miny))
+        tasks.append((partition, [others[i] for i in overlap]))
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        results = list(executor.map(_difference, tasks))
+    return shapely.geometry.MultiPolygon([p for r in results for p in polygons(r)])
@@ -1,17 +1,12 @@
 #!/usr/bin/env bash
 
-unzip aoi.zip
+# -o: a rerun in the same directory overwrites the AOI without asking (unchanged content is not reprocessed)
+unzip -o aoi.zip
 
 # ls -l
 
-python3 0_Download_data.py
-
-python3 1_CLC_Clip.py
-
-# ls -l
-
-python3 2_City_Area.py
-
-python3 3_OSM_Layers.py
-
-python3 4_Index_calculation.py
+# run 0_Download_data.py ... 4_Index_calculation.py as a resumable workflow: stages whose inputs did not change
+# since their last successful run are skipped, so a rerun after a failure resumes from the failed stage
+# (python3 pipeline.py runs all steps in one process instead, keeping intermediate results in memory)
+# (python3 runner.py --refresh-osm only queries OSM again and recalculates the indicator, see README)
+python3 runner.py
@@ -0,0 +1,140 @@
+# ============ NEIGHBOURHOOD SUM =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Sum of built-up pixels in the square 1 km2 neighbourhood of every pixel (UN urban-ness rule).
+# Two interchangeable backends give identical counts:
+#   'convolve'  scipy.ndimage.convolve with a kernel of ones, O(N*k^2)
+#   'sat'       separable cumulative sums (summed-area table), O(N)
+# Either backend can run on several threads: the image is split in horizontal strips, each read with
+# halos of the kernel reach, and the strips are summed concurrently (numpy's and scipy's loops release
+# the GIL). The number of threads is GEOESSENTIAL_WORKERS if set (e.g. to the cpu_units of the VLab
+# workflow), otherwise the number of CPUs available to the process (see cpus.py).
+
+# References:
+# https://en.wikipedia.org/wiki/Summed-area_table
+
+# ============== IMPORTS =============================================
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import convolve
+
+METHODS = ('sat', 'convolve')
+
+# ================= FUNCTIONS =========================================
+
+def kernel_size(pixelSize):
+    """Side of the square kernel (in pixels) with the area of a 1 km2 circle"""
+    # the kernel is always a square so with basic trigonometry we can find the size of the kernel
+    # A = πr^2 and r^2 + r^2 = a^2
+    r = math.sqrt(1/math.pi) # km
+    aKm = math.sqrt(math.pow(r,2)+math.pow(r,2)) # km
+    a = aKm * 1000 # m
+    # eg. 1km is 50 pixels in the 20m-pixel size of HRL
+    return int(a/pixelSize)
+
+
+def kernel_reach(kernelSize):
+    """Pixels (before, after) the centre covered by the kernel along each axis.
+    For even kernel sizes scipy's convolve puts the extra pixel after the centre."""
+    return (kernelSize - 1) // 2, kernelSize // 2
+
+
+def count_dtype(kernelSize):
+    """Smallest unsigned dtype holding the neighbourhood sums of a binary image: uint16 if the
+    kernel area fits (kernels up to 255 pixels, i.e. HRL pixels of 4m and more), else uint32"""
+    return np.uint16 if kernelSize * kernelSize <= np.iinfo(np.uint16).max else np.uint32
+
+
+def _box_sum_axis(a, kernelSize, axis, dtype=np.uint32, out=None):
+    """Moving sum along ``axis`` with zeros outside the array, from one cumulative sum.
+    Unsigned arithmetic wraps around, so the differences are exact as long as the
+    window sums fit in the dtype (even if the running cumulative sum does not).
+    The sums are written to ``out`` (may be ``a`` itself) or to a new array of ``dtype``."""
+    before, after = kernel_reach(kernelSize)
+    n = a.shape[axis]
+
+    shape = list(a.shape)
+    shape[axis] = n + 1
+    cs = np.zeros(shape, dtype=dtype)
+    body = [slice(None)] * a.ndim
+    body[axis] = slice(1, None)
+    np.cumsum(a, axis=axis, dtype=dtype, out=cs[tuple(body)])
+
+    # out[i] = cs[min(i + after + 1, n)] - cs[max(i - before, 0)], with slices instead of index arrays
+    if out is None:
+        out = np.empty(a.shape, dtype=dtype)
+    cs, sums = np.moveaxis(cs, axis, 0), np.moveaxis(out, axis, 0)
+    m = max(0, n - after - 1)
+    sums[:m] = cs[after + 1:n]
+    sums[m:] = cs[n]
+    if before < n:
+        sums[before:] -= cs[:n - before]
+    return out
+
+
+def neighbourhood_sum(img, kernelSize, method='sat', workers=1):
+    """Sum of ``img`` over the ``kernelSize`` x ``kernelSize`` neighbourhood of every pixel,
+    with zeros outside the image. Equal to
+    ``convolve(img.astype(np.uint32), np.ones((kernelSize, kernelSize), np.uint32), mode='constant')``
+    with either ``method`` and any number of ``workers`` (threads), for a binary ``img``.
+    Returns an array of ``count_dtype(kernelSize)``."""
+    if method not in METHODS:
+        raise ValueError("Unknown neighbourhood method '{m}', use one of {ms}".format(m=method, ms=METHODS))
+    # strips of at least 4 kernels, so the halos add at most half of the work
+    strips = min(workers, img.shape[0] // (4 * kernelSize))
+    if strips > 1:
+        return _neighbourhood_sum_strips(img, kernelSize, method, strips)
+
+    dtype = count_dtype(kernelSize)
+    if method == 'convolve':
+        kernel = np.ones((kernelSize,kernelSize),dtype)
+        return convolve(img.astype(dtype), kernel, mode='constant')
+    elif method == 'sat':
+        # the column sums are overwritten with the row sums (one full-size array of counts)
+        sums = _box_sum_axis(img, kernelSize, 0, dtype)
+        return _box_sum_axis(sums, kernelSize, 1, dtype, out=sums)
+
+
+def _neighbourhood_sum_strips(img, kernelSize, method, strips):
+    """``neighbourhood_sum`` of ``img`` in ``strips`` horizontal strips (with halos) on as many threads"""
+    out = np.empty(img.shape, dtype=count_dtype(kernelSize))
+    blockRows = int(math.ceil(img.shape[0] / float(strips)))
+
+    def strip(block):
+        row, rows, readRow, readRows = block
+        if method == 'convolve':
+            sums = neighbourhood_sum(img[readRow:readRow + readRows], kernelSize, method)
+            out[row:row + rows] = sums[row - readRow:row - readRow + rows]
+        else:
+            # only the column sums need the halos, the row sums are written straight into the strip of ``out``
+            cols = _box_sum_axis(img[readRow:readRow + readRows], kernelSize, 0, out.dtype)
+            _box_sum_axis(cols[row - readRow:row - readRow + rows], kernelSize, 1, out.dtype, out=out[row:row + rows])
+
+    with ThreadPoolExecutor(max_workers=strips) as executor:
+        list(executor.map(strip, row_blocks(img.shape[0], blockRows, kernel_reach(kernelSize))))
+    return out
+
+
+def row_blocks(height, blockRows, halo=(0, 0)):
+    """Split ``height`` rows into blocks of ``blockRows`` rows, each read with ``halo``
+    (before, after) extra rows of overlap, clipped at the raster edges.
+    Yields (row, rows, readRow, readRows): the block to write and the rows to read for it."""
+    before, after = halo
+    for row in range(0, height, blockRows):
+        rows = min(blockRows, height - row)
+        readRow = max(0, row - before)
+        readEnd = min(height, row + rows + after)
+        yield row, rows, readRow, readEnd - readRow
+
+
+def neighbourhood_sum_blocks(read, height, kernelSize, blockRows, method='sat', workers=1):
+    """Neighbourhood sum computed block by block. ``read(row, rows)`` returns the rows
+    ``row:row+rows`` of the full-width image; blocks are read with halos of the kernel reach,
+    so the result equals ``neighbourhood_sum`` of the whole image.
+    Yields (row, sums) for consecutive blocks of ``blockRows`` rows."""
+    for row, rows, readRow, readRows in row_blocks(height, blockRows, kernel_reach(kernelSize)):
+        sums = neighbourhood_sum(read(readRow, readRows), kernelSize, method, workers)
+        yield row, sums[row - readRow:row - readRow + rows]
@@ -0,0 +1,168 @@
+# ============ OSM PBF SOURCE =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Offline alternative to the Overpass API: reads the open areas and roads of 3_OSM_Layers.py
+# from a local .osm.pbf extract (e.g. a Geofabrik country file). The extract is scanned once
+# with pyosmium and the ways with the same tags as the Overpass queries are stored in a
+# GeoPackage index (layers 'open_areas' and 'roads', with an R-tree spatial index), from
+# which the ways of each AOI bbox are read without network round-trips.
+
+# usage (prebuild the index): python3 osm_pbf.py greece-latest.osm.pbf [greece-latest.gpkg]
+
+# References:
+# https://docs.osmcode.org/pyosmium/latest/
+# https://download.geofabrik.de/
+
+# ============== IMPORTS =============================================
+import os
+import sys
+import pathlib
+
+import numpy as np
+import geopandas as gpd
+import shapely.geometry
+
+try:
+    import osmium
+except ImportError:  # only needed to build the index
+    osmium = None
+
+# ================= FUNCTIONS =========================================
+
+# same tags as the Overpass queries of 3_OSM_Layers.py
+OPEN_AREA_TAGS = {"natural": {"shingle", "sand", "beach"},
+                  "leisure": {"park", "playground", "nature_reserve"},
+                  "place": {"square"},
+                  "landuse": {"recreation_ground", "cemetery"}}
+
+ROAD_TAGS = {"highway": {"primary", "secondary", "tertiary", "unclassified", "residential", "primary_link",
+                         "secondary_link", "tertiary_link", "living_street", "service", "pedestrian", "road",
+                         "corridor", "footway", "steps", "path"},
+             "traffic_calming": {"island"},
+             "cycleway": {"lane", "track"}}
+
+# tags kept in the index (the road width is computed from 'lanes')
+ROAD_COLUMNS = sorted(ROAD_TAGS) + ['lanes']
+
+
+def matches(tags, tagSets):
+    """True if any of the ``tags`` has one of the values of ``tagSets`` ({key: {values}})"""
+    return any(tags.get(key) in values for key, values in tagSets.items())
+
+
+def index_path(pbfPath):
+    """Default path of the GeoPackage index of a PBF extract (next to it)"""
+    name = pathlib.Path(pbfPath).name
+    for suffix in ('.osm.pbf', '.pbf'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return pathlib.Path(pbfPath).parent / (name + '.gpkg')
+
+
+if osmium is not None:
+    class WayCollector(osmium.SimpleHandler):
+        """Collects the open area polygons and road lines of a PBF extract, in batches of ``batchSize``"""
+
+        def __init__(self, flush, batchSize=100000):
+            super(WayCollector, self).__init__()
+            self.flush = flush
+            self.batchSize = batchSize
+            self.open_areas = []
+            self.roads = []
+
+        def way(self, w):
+            isOpenArea = matches(w.tags, OPEN_AREA_TAGS)
+            isRoad = matches(w.tags, ROAD_TAGS)
+            if not (isOpenArea or isRoad):
+                return
+            try:
+                coords = [(n.lon, n.lat) for n in w.nodes]
+            except osmium.InvalidLocationError:  # nodes outside the extract
+                return
+            if isOpenArea and len(coords) >= 3:
+                self.open_areas.append({'osm_id': w.id, 'geometry': shapely.geometry.Polygon(coords)})
+            if isRoad and len(coords) >= 2:
+                row = {'osm_id': w.id, 'geometry': shapely.geometry.LineString(coords)}
+                for key in ROAD_COLUMNS:
+                    row[key] = w.tags.get(key)
+                self.roads.append(row)
+            if len(self.open_areas) + len(self.roads) >= self.batchSize:
+                self.flush(self)
+
+
+def build_index(pbfPath, indexPath=None, batchSize=100000):
+    """Scan the PBF extract once and write the matching ways to a GeoPackage (EPSG:4326).
+    Returns the path of the index."""
+    if osmium is None:
+        raise ImportError("pyosmium is required to read .osm.pbf files (pip3 install osmium)")
+    indexPath = pathlib.Path(indexPath or index_path(pbfPath))
+    tmpPath = indexPath.with_name('.tmp-' + indexPath.name)
+    if tmpPath.exists():
+        tmpPath.unlink()
+
+    written = {'open_areas': False, 'roads': False}
+
+    def flush(collector):
+        for layer in ('open_areas', 'roads'):
+            rows = getattr(collector, layer)
+            if not rows:
+                continue
+            gdf = gpd.GeoDataFrame(rows, geometry='geometry', crs='epsg:4326')
+            gdf.to_file(str(tmpPath), layer=layer, driver='GPKG', mode='a' if written[layer] else 'w')
+            written[layer] = True
+            del rows[:]
+
+    print("Indexing OSM open areas and roads of {p} ...".format(p=pbfPath))
+    collector = WayCollector(flush, batchSize)
+    # node locations of large extracts don't fit a dense in-memory index
+    collector.apply_file(str(pbfPath), locations=True, idx='flex_mem')
+    flush(collector)
+
+    # layers without any way are written empty, so queries always find them
+    for layer in ('open_areas', 'roads'):
+        if not written[layer]:
+            columns = ['osm_id'] + (ROAD_COLUMNS if layer == 'roads' else [])
+            gdf = gpd.GeoDataFrame({c: [] for c in columns}, geometry=gpd.GeoSeries([]), crs='epsg:4326')
+            gdf.to_file(str(tmpPath), layer=layer, driver='GPKG')
+    os.replace(str(tmpPath), str(indexPath))
+    print("done.")
+    return indexPath
+
+
+def open_index(pbfPath, indexPath=None):
+    """Path of the index of the PBF extract, (re)built if missing or older than the extract"""
+    indexPath = pathlib.Path(indexPath or index_path(pbfPath))
+    if not indexPath.exists() or indexPath.stat().st_mtime < pathlib.Path(pbfPath).stat().st_mtime:
+        build_index(pbfPath, indexPath)
+    return indexPath
+
+
+def pbf_ways(indexPath, layer, bbox, withIds=False):
+    """Yield the (tags, coordinates) of the ways of ``layer`` ('open_areas' or 'roads') in the index
+    whose bounds intersect the lon/lat ``bbox``, with the (lon, lat) coordinates as a (n, 2) array
+    (the (id, tags, coordinates) ``withIds``)"""
+    ways = gpd.read_file(str(indexPath), layer=layer, bbox=tuple(bbox))
+    columns = [c for c in ROAD_COLUMNS if c in ways.columns]
+    for row in ways.itertuples(index=False):
+        geom = row.geometry
+        if geom is None:
+            continue
+        if geom.geom_type == 'Polygon':
+            coords = np.asarray(geom.exterior.coords, dtype=np.float64)
+        else:
+            coords = np.asarray(geom.coords, dtype=np.float64)
+        tags = {c: getattr(row, c) for c in columns if isinstance(getattr(row, c), str)}
+        yield (('way', row.osm_id), tags, coords) if withIds else (tags, coords)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python3 osm_pbf.py <extract.osm.pbf> [index.gpkg]")
+        sys.exit(1)
+    build_index(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# ============ OSM GEOMETRY STORE =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Per-city store of the geometries of an OSM layer (the open area polygons, the buffered roads), for
+# refreshing the layer of a city when OSM changes without rebuilding it. Every way is kept with a
+# digest of its tags and coordinates and the cell of a fixed grid that holds the centre of its bounds;
+# every cell keeps the union of its ways. On a refresh, the ways of the current OSM data are compared
+# with the stored ones: only the ways added or changed are turned into geometries again, and only the
+# cells of added, changed or removed ways are unioned again. The layer is the union of the cell
+# unions, which are far fewer than the ways and have their internal boundaries already dissolved.
+# A store written with other settings (e.g. another cell size) is discarded and rebuilt.
+
+# usage: OSM_STORE=osm-store python3 3_OSM_Layers.py
+
+# ============== IMPORTS =============================================
+import os
+import json
+import math
+import pickle
+import hashlib
+import pathlib
+
+import shapely.wkb
+
+import dissolve
+
+# ================= FUNCTIONS =========================================
+
+# bump when the geometries built from the ways change, so older stores are rebuilt
+VERSION = 1
+
+
+def store_path(storeDir, layer):
+    return pathlib.Path(storeDir) / (layer + '.pickle')
+
+
+def load(storeDir, layer, cellSize):
+    """Store of ``layer`` in ``storeDir``, or an empty store if there is none or it was written with
+    another ``cellSize`` (in the units of the CRS of the layer)"""
+    settings = {'version': VERSION, 'cellSize': cellSize}
+    try:
+        with open(str(store_path(storeDir, layer)), 'rb') as f:
+            store = pickle.load(f)
+        if store.get('settings') == settings:
+            return store
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        pass
+    # ways: {way id: (digest, cell, WKB of its geometry)}, cells: {cell: WKB of the union of its ways}
+    return {'settings': settings, 'ways': {}, 'cells': {}}
+
+
+def save(storeDir, layer, store):
+    pathlib.Path(storeDir).mkdir(parents=True, exist_ok=True)
+    path = store_path(storeDir, layer)
+    tmp = pathlib.Path(str(path) + '.tmp')
+    with open(str(tmp), 'wb') as f:
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(str(tmp), str(path))
+
+
+def way_digest(tags, coords):
+    """Digest of the ``tags`` and the coordinates array ``coords`` of a way"""
+    sha = hashlib.sha1(json.dumps(sorted(tags.items())).encode('utf-8'))
+    sha.update(coords.tobytes())
+    return sha.hexdigest()
+
+
+def cell(geometry, cellSize):
+    """Cell of the grid of ``cellSize`` holding the centre of the bounds of ``geometry``"""
+    minx, miny, maxx, maxy = geometry.bounds
+    return (int(math.floor((minx + maxx) / 2 / cellSize)), int(math.floor((miny + maxy) / 2 / cellSize)))
+
+
+def changes(store, ways):
+    """Compare the (id, tags, coordinates) ``ways`` of the current OSM data with the ``store``.
+    Returns the list of the (id, digest, tags, coordinates) of the ways added or changed and the list
+    of the ids of the stored ways that are gone."""
+    stored = store['ways']
+    seen = set()
+    changed = []
+    for wayId, tags, coords in ways:
+        if wayId in seen:
+            continue
+        seen.add(wayId)
+        digest = way_digest(tags, coords)
+        if wayId not in stored or stored[wayId][0] != digest:
+            changed.append((wayId, digest, tags, coords))
+    removed = [wayId for wayId in stored if wayId not in seen]
+    return changed, removed
+
+
+def apply(store, changed, geometries, removed):
+    """Update the ``store`` with the ``geometries`` of the ``changed`` ways and without the ``removed`` ways
+    (see ``changes``), union again the cells they fall in and return the union of all cells"""
+    ways, cells = store['ways'], store['cells']
+    cellSize = store['settings']['cellSize']
+
+    touched = set()
+    for wayId in removed:
+        touched.add(ways.pop(wayId)[1])
+    for (wayId, digest, tags, coords), geometry in zip(changed, geometries):
+        if wayId in ways:
+            touched.add(ways[wayId][1])
+        key = cell(geometry, cellSize)
+        touched.add(key)
+        ways[wayId] = (digest, key, geometry.wkb)
+
+    members = {key: [] for key in touched}
+    for digest, key, wkb in ways.values():
+        if key in members:
+            members[key].append(shapely.wkb.loads(wkb))
+    for key, geometries in members.items():
+        union = dissolve.dissolve(geometries) if geometries else None
+        if union is None or union.is_empty:
+            cells.pop(key, None)
+        else:
+            cells[key] = union.wkb
+
+    print("{c} way(s) added or changed, {r} removed: {t} of {n} cell(s) unioned again".format(
+        c=len(changed), r=len(removed), t=len(touched), n=len(cells)))
+    return dissolve.dissolve([shapely.wkb.loads(wkb) for wkb in cells.values()])
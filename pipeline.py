@@ -0,0 +1,160 @@
+# ============ 11.7.1 PIPELINE =================
+
+# script for 11.7.1 indicator
+
+# This script runs the steps of 0_Download_data.py ... 4_Index_calculation.py in a single process,
+# passing the intermediate rasters and geometries between them in memory. Only the declared outputs
+# of the VLab workflow (VLab/iodescription.json) are written to disk, plus 11-profile.json with the
+# time, memory and I/O used by each step (see profiling.py), and the urban clusters (7-bounds.shp)
+# and their built-up area (8-URBAN_CLUSTER_BUA.json) for refreshing the indicator when only OSM
+# changed: with OSM_REFRESH set, only steps 3 and 4 run again (see refresh_osm).
+
+# ============== IMPORTS =============================================
+import os
+import pathlib
+import importlib
+import sys
+
+import rasterio
+import geopandas as gpd
+
+import profiling
+import urbanness_tiles
+
+# ================= FUNCTIONS =========================================
+
+def load_stage(name):
+    """Import a step script (their names start with a digit, so they can't be imported with an import statement)"""
+    return importlib.import_module(name)
+
+
+def run_aoi(volume, aoi, pixelSize=10, maxWorkers=4, neighbourhoodMethod='sat', CLC_path='', OSM_pbf='',
+            minClusterAreaKm2=None, urbannessTiles='', osmStore=''):
+    """Run all steps for the ``aoi`` GeoDataFrame, writing the outputs to ``volume``.
+    With ``urbannessTiles`` (see urbanness_tiles.py) the built-up mask and the urban-ness classes are read
+    from the tiles instead of being computed from HRL and CLC (steps 0 and 1 are skipped).
+    With ``osmStore`` (a directory in ``volume``), the OSM geometries are kept there for refreshes.
+    Returns the dict of areas and indicator value, or None if the AOI is outside the CLC extent.
+    The profile of the steps is written to ``volume`` (also if a step fails)."""
+
+    download = load_stage('0_Download_data')
+    clc_clip = load_stage('1_CLC_Clip')
+    city_area = load_stage('2_City_Area')
+    osm = load_stage('3_OSM_Layers')
+    index = load_stage('4_Index_calculation')
+
+    profiling.reset()
+    try:
+        # steps 0 and 1 are not needed with the urban-ness tiles
+        if not urbannessTiles:
+            # ---------- 0. HRL ----------
+            with profiling.stage('0_Download_data'):
+                hrl = download.download_hrl(aoi, pixelSize, maxWorkers)
+
+            # ---------- 1. CLC ----------
+            with profiling.stage('1_CLC_Clip'):
+                clc = clc_clip.clip_clc(aoi, clc_clip.clc_source(volume, 'CLC2018_1,2,3,10,11.tif', CLC_path))
+            if clc is None:
+                return None
+
+        # ---------- 2. City area ----------
+        with profiling.stage('2_City_Area'):
+            if urbannessTiles:
+                with profiling.stage('read_tiles'):
+                    builtup, classes, profile = urbanness_tiles.read_aoi(urbannessTiles, aoi)
+                city = city_area.urban_city(builtup, classes, profile, minClusterAreaKm2)
+                del builtup, classes
+            else:
+                city = city_area.city_area(clc, hrl, neighbourhoodMethod, minClusterAreaKm2)
+                del clc, hrl
+
+            out_img, out_meta = city['bua']
+            with rasterio.open(str(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')), "w", **out_meta) as dest:
+                dest.write_band(1, out_img)
+            # the urban clusters, for refreshes (their built-up area is kept by step 4)
+            city['bounds'].to_file(str(volume / pathlib.Path('7-bounds.shp')))
+
+        # ---------- 3. OSM ----------
+        with profiling.stage('3_OSM_Layers'):
+            open_areas, roads = osm.osm_layers(city['bounds'], OSM_pbf, str(volume / osmStore) if osmStore else '')
+
+        # ---------- 4. Index ----------
+        # the 1m OSM rasters (9-osm_open_areas.tif, 10-osm_roads.tif) are declared outputs of the workflow
+        with profiling.stage('4_Index_calculation'):
+            roads_clean, indicator = index.index_calculation(volume, city['bounds'], open_areas, roads, city['bua'])
+        return indicator
+    finally:
+        profiling.report(volume / profiling.REPORT, pixelSize=pixelSize, neighbourhoodMethod=neighbourhoodMethod)
+
+
+def refresh_osm(volume, OSM_pbf='', osmStore=''):
+    """Run steps 3 and 4 again with the current OSM data, reusing the urban clusters (7-bounds.shp), the
+    built-up area raster (8-URBAN_CLUSTER_BUA.tif) and the built-up area of the clusters of a previous run
+    in ``volume``. With ``osmStore``, only the ways changed since the previous run are processed.
+    Returns the dict of areas and indicator value."""
+
+    osm = load_stage('3_OSM_Layers')
+    index = load_stage('4_Index_calculation')
+
+    profiling.reset()
+    try:
+        bounds = gpd.read_file(str(volume / pathlib.Path('7-bounds.shp')))
+        # the raster is only read if the built-up area of the clusters was not kept (or is outdated)
+        bua_clusters = index.load_bua(volume, len(bounds))
+        urb_bua = None
+        if bua_clusters is None:
+            urb_bua = index.raster2array(str(volume / pathlib.Path('8-URBAN_CLUSTER_BUA.tif')))
+
+        # ---------- 3. OSM ----------
+        with profiling.stage('3_OSM_Layers'):
+            open_areas, roads = osm.osm_layers(bounds, OSM_pbf, str(volume / osmStore) if osmStore else '',
+                                               refresh=True)
+
+        # ---------- 4. Index ----------
+        with profiling.stage('4_Index_calculation'):
+            roads_clean, indicator = index.index_calculation(volume, bounds, open_areas, roads, urb_bua,
+                                                             bua_clusters=bua_clusters)
+        return indicator
+    finally:
+        profiling.report(volume / profiling.REPORT, refresh='osm')
+
+
+def run(volume, shpName='aoi.shp', pixelSize=10, maxWorkers=4, neighbourhoodMethod='sat', CLC_path='', OSM_pbf='',
+        minClusterAreaKm2=None, urbannessTiles='', osmStore=''):
+    """Run all steps for the AOI shapefile ``shpName`` in ``volume``"""
+    aoi = gpd.read_file(str(volume / pathlib.Path(shpName)))
+    if run_aoi(volume, aoi, pixelSize, maxWorkers, neighbourhoodMethod, CLC_path, OSM_pbf, minClusterAreaKm2,
+               urbannessTiles, osmStore) is None:
+        sys.exit(1)
+
+
+def main():
+
+    # ================= SETTINGS =========================================
+    # specify directory (volume conected via docker)
+    directory = ''
+    # specify AOI in the form of a shapefile
+    shpName = 'aoi.shp'
+    # optional local CLC source and OSM extract (see 1_CLC_Clip.py and 3_OSM_Layers.py)
+    CLC_path = os.environ.get('CLC_PATH', '')
+    OSM_pbf = os.environ.get('OSM_PBF', '')
+    # keep every urban cluster of at least this area in km2 (None = only the largest cluster in the AOI)
+    minClusterAreaKm2 = None
+    # precomputed urban-ness tiles (VRT built by urbanness_tiles.py), instead of HRL and CLC
+    urbannessTiles = os.environ.get('URBANNESS_TILES', '')
+    # directory (in the working directory) for the OSM geometries of the city, so a refresh only processes
+    # the ways changed since the previous run (see osm_store.py)
+    osmStore = os.environ.get('OSM_STORE', '')
+    # only refresh the OSM layers and the indicator, keeping the urban clusters of the previous run
+    osmRefresh = load_stage('3_OSM_Layers').refresh_requested()
+
+    # ================= MAIN PROGRAM ======================================
+    if osmRefresh:
+        refresh_osm(pathlib.Path(directory), OSM_pbf, osmStore)
+    else:
+        run(pathlib.Path(directory), shpName, CLC_path=CLC_path, OSM_pbf=OSM_pbf,
+            minClusterAreaKm2=minClusterAreaKm2, urbannessTiles=urbannessTiles, osmStore=osmStore)
+
+
+if __name__ == '__main__':
+    main()
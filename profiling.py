@@ -0,0 +1,168 @@
+# ============ PROFILING =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Per-stage telemetry of the pipeline: wall time, CPU time (including finished child processes),
+# peak resident memory, bytes read and written and bytes downloaded by every stage entered with
+# ``stage(name)``. Stages nest (the names of nested stages are joined with '/'), and ``report(path)``
+# writes the records as JSON (11-profile.json next to 11-results.txt), to see which stage blows up
+# for which city and to size the memory of the VLab workflow. pipeline.py profiles each step of a run;
+# the step scripts run on their own (one by one, or concurrently by runner.py) replace their own
+# records in the same report (see ``script``).
+
+# Memory and I/O counters are read from /proc/self (Linux); elsewhere they are reported as null.
+# Stages are entered from the main thread; downloads can be counted from any thread.
+
+# References:
+# https://www.kernel.org/doc/html/latest/filesystems/proc.html
+
+# ============== IMPORTS =============================================
+import os
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+# ================= FUNCTIONS =========================================
+
+# report next to 11-results.txt
+REPORT = '11-profile.json'
+
+_lock = threading.Lock()
+_downloaded = [0]
+_records = []
+_stack = []
+
+
+def add_downloaded(n):
+    """Count ``n`` bytes downloaded from the network (not read from the download cache)"""
+    with _lock:
+        _downloaded[0] += n
+
+
+def _cpu():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _io():
+    """I/O counters of the process: rchar/wchar (all reads and writes, also from the page cache and
+    sockets) and read_bytes/write_bytes (storage), or {} if /proc/self/io is not available"""
+    try:
+        with open('/proc/self/io') as f:
+            return {k.strip(): int(v) for k, v in (line.split(':') for line in f if ':' in line)}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _peak_rss_kb():
+    """Peak resident set size (VmHWM) in kB since the last ``_reset_peak``, or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak():
+    """Reset the peak RSS to the current RSS (Linux >= 4.0; the peak stays the process peak otherwise)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _delta(end, start, key):
+    if key in end and key in start:
+        return end[key] - start[key]
+    return None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Record the resources used by the code in the ``with`` block as stage ``name``"""
+    # pass the peak so far to the enclosing stages before resetting it for this stage
+    peak = _peak_rss_kb() or 0
+    for s in _stack:
+        s['peak'] = max(s['peak'], peak)
+    _reset_peak()
+
+    record = {'stage': '/'.join([s['record']['stage'] for s in _stack[-1:]] + [name]), 'status': 'running'}
+    _records.append(record)
+    entry = {'record': record, 'peak': 0}
+    _stack.append(entry)
+
+    wall, cpu, io, downloaded = time.perf_counter(), _cpu(), _io(), _downloaded[0]
+    try:
+        yield
+        record['status'] = 'ok'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        end = _io()
+        peak = max(entry['peak'], _peak_rss_kb() or 0)
+        _stack.pop()
+        for s in _stack:
+            s['peak'] = max(s['peak'], peak)
+        record.update({'wall_s': round(time.perf_counter() - wall, 3),
+                       'cpu_s': round(_cpu() - cpu, 3),
+                       'peak_rss_mb': round(peak / 1024., 1) if peak else None,
+                       'read_bytes': _delta(end, io, 'rchar'),
+                       'write_bytes': _delta(end, io, 'wchar'),
+                       'disk_read_bytes': _delta(end, io, 'read_bytes'),
+                       'disk_write_bytes': _delta(end, io, 'write_bytes'),
+                       'downloaded_bytes': _downloaded[0] - downloaded})
+
+
+def records():
+    """The stage records so far, in the order the stages were entered"""
+    return list(_records)
+
+
+def reset():
+    """Forget the records (e.g. before the next AOI of a batch, in the same process)"""
+    del _records[:]
+
+
+def report(path, append=False, **info):
+    """Write the stage records and their peak RSS (plus ``info``) as JSON to ``path``.
+    With ``append``, the records are merged into the report, replacing the records of the same
+    top-level stages (the report is locked while it is updated)."""
+    with open(str(path), 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read() if append else ''
+        data = json.loads(text) if text.strip() else {}
+        data.update(info)
+        new = records()
+        replaced = {r['stage'].split('/')[0] for r in new}
+        stages = [r for r in data.get('stages', []) if r['stage'].split('/')[0] not in replaced] + new
+        peaks = [r['peak_rss_mb'] for r in stages if r.get('peak_rss_mb') is not None]
+        data.update({'peak_rss_mb': max(peaks) if peaks else None, 'stages': stages})
+        f.seek(0)
+        f.truncate()
+        json.dump(data, f, indent=2)
+    return path
+
+
+@contextlib.contextmanager
+def script(name, path=REPORT, append=True):
+    """Profile a step script run on its own as stage ``name`` and add it to the report at ``path``
+    (or start a new report with ``append=False``)"""
+    reset()
+    try:
+        with stage(name):
+            yield
+    finally:
+        report(path, append)
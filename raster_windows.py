@@ -0,0 +1,33 @@
+# ============ RASTER WINDOWS =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Window of a raster grid covering a set of shapes, for reading or clipping only the AOI of a raster
+# (CLC, HRL, the urban-ness tiles, the OSM layers) instead of masking the whole raster. The window is
+# the one rasterio.mask.mask(crop=True) crops to: its first pixel is the floor and its last pixel the
+# ceiling of the bounds of the shapes in pixel coordinates, so every pixel the AOI touches is kept when
+# the bounds don't fall on the grid (rounding the offsets and the lengths separately can end the window
+# one pixel short of the AOI).
+
+# References:
+# https://rasterio.readthedocs.io/en/latest/api/rasterio.features.html#rasterio.features.geometry_window
+
+# ============== IMPORTS =============================================
+import math
+
+import rasterio.features
+from rasterio.windows import Window
+
+# ================= FUNCTIONS =========================================
+
+def aoi_window(shapes, transform, width, height):
+    """Window of the grid of ``transform`` (``width`` x ``height`` pixels) covering the bounds of the
+    GeoJSON-like ``shapes``, as rasterio.features.geometry_window computes it, limited to the grid.
+    Raises rasterio.errors.WindowError if the shapes are outside the grid."""
+    extents = [rasterio.features.bounds(shape, transform=~transform) for shape in shapes]
+    cols = [x for left, bottom, right, top in extents for x in (left, right)]
+    rows = [y for left, bottom, right, top in extents for y in (top, bottom)]
+    col_start, col_stop = int(math.floor(min(cols))), int(math.ceil(max(cols)))
+    row_start, row_stop = int(math.floor(min(rows))), int(math.ceil(max(rows)))
+    window = Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0))
+    return window.intersection(Window(0, 0, width, height))
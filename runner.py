@@ -0,0 +1,243 @@
+# ============ 11.7.1 RUNNER =================
+
+# script for 11.7.1 indicator
+
+# This script runs the step scripts 0_Download_data.py ... 4_Index_calculation.py as a resumable,
+# dependency-aware workflow. Each stage declares the files it reads and writes in the working
+# directory, and starts as soon as the stages writing its inputs are done, so independent stages
+# run concurrently (the HRL download and the CLC clip only need the AOI).
+# A stage is skipped when its outputs exist and its inputs are unchanged since its last successful
+# run: same size and modification time, or else same content (sha256). The hashes are recorded in
+# runner-state.json, together with the hashes of the code of the stage and the environment
+# variables it reads. After a failure (e.g. an Overpass timeout) the next run skips the stages
+# that completed and resumes from the failed stage.
+# OSM data changes while its inputs do not, so --refresh-osm runs 3_OSM_Layers.py again (and
+# 4_Index_calculation.py if the OSM layers changed), keeping the urban clusters and the built-up area
+# of the previous run; with OSM_STORE, only the ways changed since then are processed (see osm_store.py).
+
+# usage: python3 runner.py [--directory .] [--workers 2] [--force] [--refresh-osm]
+
+# ============== IMPORTS =============================================
+import os
+import sys
+import json
+import hashlib
+import pathlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ================= FUNCTIONS =========================================
+
+SCRIPTS = pathlib.Path(__file__).resolve().parent
+
+STATE = 'runner-state.json'
+
+# files read and written by each step in the working directory, the code whose changes invalidate its
+# outputs and the environment variables it reads
+STAGES = [
+    {'name': '0_Download_data', 'inputs': ['aoi.shp'], 'outputs': ['1-HRL_AOI.tif'],
+     'code': ['0_Download_data.py', 'sidecar.py'], 'env': ['ARCGIS_URL']},
+    {'name': '1_CLC_Clip', 'inputs': ['aoi.shp'], 'outputs': ['2-CLC_AOI.tif'],
+     'code': ['1_CLC_Clip.py', 'raster_windows.py', 'sidecar.py'], 'env': ['CLC_PATH']},
+    {'name': '2_City_Area', 'inputs': ['1-HRL_AOI.tif', '2-CLC_AOI.tif'],
+     'outputs': ['4-CLC_HRL_AOI_urban.tif', '5-thres.tif', '7-bounds.shp', '8-URBAN_CLUSTER_BUA.tif'],
+     'code': ['2_City_Area.py', 'neighbourhood.py', 'cpus.py', 'urbanness_tiles.py', 'raster_windows.py',
+              'sidecar.py'], 'env': ['URBANNESS_TILES', 'GEOESSENTIAL_BLOCK_ROWS']},
+    {'name': '3_OSM_Layers', 'inputs': ['7-bounds.shp'], 'outputs': ['9-osm_open_areas.shp', '10-osm_roads.shp'],
+     'code': ['3_OSM_Layers.py', 'dissolve.py', 'cpus.py', 'osm_pbf.py', 'osm_store.py'],
+     'env': ['OSM_PBF', 'OVERPASS_URL', 'OSM_STORE']},
+    {'name': '4_Index_calculation',
+     'inputs': ['7-bounds.shp', '8-URBAN_CLUSTER_BUA.tif', '9-osm_open_areas.shp', '10-osm_roads.shp'],
+     'outputs': ['9-osm_open_areas.tif', '10-osm_roads.tif', '11-results.txt'],
+     'code': ['4_Index_calculation.py', 'dissolve.py', 'cpus.py', 'raster_windows.py', 'sidecar.py'], 'env': []},
+]
+
+# stages not needed when 2_City_Area.py reads the urban-ness tiles (URBANNESS_TILES, see urbanness_tiles.py)
+TILED_SKIP = ('0_Download_data', '1_CLC_Clip')
+
+# stages run by an OSM refresh (3_OSM_Layers.py always runs, as its inputs don't show the changes of OSM)
+OSM_STAGES = ('3_OSM_Layers', '4_Index_calculation')
+
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+_lock = threading.Lock()
+
+
+def say(name, line):
+    with _lock:
+        print("[{n}] {l}".format(n=name, l=line.rstrip('\n')), flush=True)
+
+
+def files(volume, name):
+    """Paths of the file ``name`` in ``volume``, with the sidecar files of a shapefile"""
+    path = volume / name
+    if path.suffix != '.shp':
+        return [path]
+    return [p for p in (path.with_suffix(s) for s in SHAPEFILE_PARTS) if p.exists()]
+
+
+def file_hash(paths):
+    sha = hashlib.sha256()
+    for path in paths:
+        sha.update(path.name.encode('utf-8'))
+        with open(str(path), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_stat(paths):
+    return [[p.name, p.stat().st_size, p.stat().st_mtime_ns] for p in paths]
+
+
+def fingerprint(volume, stage, previous=None):
+    """Stat and content hash of the inputs of ``stage``, hashes of its code and values of its environment
+    variables. Inputs with the same stat as in the ``previous`` fingerprint are not hashed again."""
+    previous = previous or {}
+    inputs = {}
+    for name in stage['inputs']:
+        paths = files(volume, name)
+        stat = file_stat(paths)
+        old = previous.get('inputs', {}).get(name)
+        if old is not None and old['stat'] == stat:
+            inputs[name] = old
+        else:
+            inputs[name] = {'stat': stat, 'sha256': file_hash(paths)}
+    return {'inputs': inputs,
+            'code': {name: file_hash([SCRIPTS / name]) for name in stage['code']},
+            'env': {key: os.environ.get(key, '') for key in stage['env']}}
+
+
+def up_to_date(volume, stage, previous):
+    """True if the outputs of ``stage`` exist and its inputs, code and environment are the same as
+    in the fingerprint ``previous`` of its last successful run"""
+    if previous is None or not all((volume / name).exists() for name in stage['outputs']):
+        return False
+    current = fingerprint(volume, stage, previous)
+    return (current['code'] == previous['code'] and current['env'] == previous['env'] and
+            all(current['inputs'][name]['sha256'] == previous['inputs'][name]['sha256'] for name in stage['inputs']))
+
+
+def active_stages(stages=STAGES, refreshOsm=False):
+    """The ``stages`` to run: with the urban-ness tiles, 2_City_Area.py only reads the AOI (and the tiles),
+    and an OSM refresh (``refreshOsm``) only runs the OSM_STAGES"""
+    if refreshOsm:
+        return [stage for stage in stages if stage['name'] in OSM_STAGES]
+    if not os.environ.get('URBANNESS_TILES', ''):
+        return stages
+    return [dict(stage, inputs=['aoi.shp']) if stage['name'] == '2_City_Area' else stage
+            for stage in stages if stage['name'] not in TILED_SKIP]
+
+
+def load_state(volume):
+    try:
+        with open(str(volume / STATE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_state(volume, state):
+    tmp = volume / (STATE + '.tmp')
+    with open(str(tmp), 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(str(tmp), str(volume / STATE))
+
+
+def run_stage(volume, stage, state, force=False):
+    """Run the script of ``stage`` in ``volume`` unless it is up to date. Returns True if it ran."""
+    name = stage['name']
+    with _lock:
+        previous = state.get(name)
+    if not force and up_to_date(volume, stage, previous):
+        say(name, "up to date, skipped")
+        return False
+
+    missing = [n for n in stage['inputs'] if not (volume / n).exists()]
+    if missing:
+        raise RuntimeError("missing input(s) {m}".format(m=', '.join(missing)))
+
+    with _lock:
+        state.pop(name, None)
+        save_state(volume, state)
+
+    process = subprocess.Popen([sys.executable, str(SCRIPTS / (name + '.py'))], cwd=str(volume),
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in process.stdout:
+        say(name, line)
+    if process.wait() != 0:
+        raise RuntimeError("exit status {c}".format(c=process.returncode))
+
+    missing = [n for n in stage['outputs'] if not (volume / n).exists()]
+    if missing:
+        raise RuntimeError("output(s) {m} not written".format(m=', '.join(missing)))
+
+    # the inputs are fingerprinted after the run (4_Index_calculation.py rewrites 10-osm_roads.shp)
+    current = fingerprint(volume, stage)
+    with _lock:
+        state[name] = current
+        save_state(volume, state)
+    return True
+
+
+def run(volume, stages=STAGES, maxWorkers=2, force=False, rerun=()):
+    """Run the ``stages`` in ``volume`` in dependency order, concurrently where possible (the stages named
+    in ``rerun`` even if up to date). Returns the names of the stages that failed or could not run because
+    a stage before them failed."""
+    state = load_state(volume)
+    producers = {output: stage['name'] for stage in stages for output in stage['outputs']}
+    needs = {stage['name']: {producers[i] for i in stage['inputs'] if i in producers} for stage in stages}
+
+    pending = list(stages)
+    done = set()
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if needs[stage['name']] & set(failed):
+                    pending.remove(stage)
+                    failed.append(stage['name'])
+                    say(stage['name'], "not run, a stage before it failed")
+                elif needs[stage['name']] <= done:
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, volume, stage, state,
+                                            force or stage['name'] in rerun)] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage['name'])
+                except Exception as e:
+                    say(stage['name'], "FAILED: {e}".format(e=e))
+                    failed.append(stage['name'])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the 11.7.1 steps as a resumable workflow')
+    parser.add_argument('--directory', default='.', help='working directory with aoi.shp')
+    parser.add_argument('--workers', type=int, default=2, help='stages run concurrently')
+    parser.add_argument('--force', action='store_true', help='run all stages, even if up to date')
+    parser.add_argument('--refresh-osm', action='store_true',
+                        help='only query OSM again and recalculate the indicator, keeping the urban clusters')
+    args = parser.parse_args()
+
+    if args.refresh_osm:
+        # 3_OSM_Layers.py queries Overpass again instead of reading the download cache
+        os.environ['OSM_REFRESH'] = '1'
+
+    failed = run(pathlib.Path(args.directory), active_stages(refreshOsm=args.refresh_osm), maxWorkers=args.workers,
+                 force=args.force, rerun=('3_OSM_Layers',) if args.refresh_osm else ())
+    if failed:
+        print("Failed: {f} (run again to resume)".format(f=', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
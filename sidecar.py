@@ -0,0 +1,70 @@
+# ============ NPY SIDECARS =================
+
+# shared module for 11.7.1 indicator scripts
+
+# The single-band rasters that a step script writes for the next one (1-HRL_AOI.tif, 2-CLC_AOI.tif,
+# 8-URBAN_CLUSTER_BUA.tif), and 4-CLC_HRL_AOI_urban.tif that the block mode of 2_City_Area.py reads
+# back, get a copy of their band in .npy format next to them
+# (e.g. 8-URBAN_CLUSTER_BUA.tif.npy). The next script maps it with np.load(mmap_mode='r') instead of
+# reading the GeoTIFF: the band is not copied, its pages are read when they are accessed, and
+# concurrent jobs on the same node share them through the page cache. The GeoTIFF stays the output
+# and the source of the georeferencing; a sidecar older than its GeoTIFF, or with another shape or
+# dtype than its band, is ignored (e.g. after the GeoTIFF was replaced by a tool that does not know
+# about sidecars).
+
+# References:
+# https://numpy.org/doc/stable/reference/generated/numpy.lib.format.open_memmap.html
+
+# ============== IMPORTS =============================================
+import os
+import pathlib
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# ================= FUNCTIONS =========================================
+
+SUFFIX = '.npy'
+
+
+def path(raster_path):
+    """Path of the sidecar of ``raster_path``"""
+    return pathlib.Path(str(raster_path) + SUFFIX)
+
+
+def save(raster_path, array):
+    """Write ``array`` (the band just written to ``raster_path``) as the sidecar of ``raster_path``"""
+    tmp = pathlib.Path(str(path(raster_path)) + '.tmp')
+    with open(str(tmp), 'wb') as f:
+        np.save(f, array)
+    os.replace(str(tmp), str(path(raster_path)))
+
+
+def save_from_raster(raster_path, blockRows=1024):
+    """Write the sidecar of ``raster_path`` from band 1 of the raster, ``blockRows`` rows at a time
+    (for rasters written block by block, that are never in memory as a whole)"""
+    tmp = pathlib.Path(str(path(raster_path)) + '.tmp')
+    with rasterio.open(str(raster_path)) as src:
+        out = np.lib.format.open_memmap(str(tmp), mode='w+', dtype=src.dtypes[0], shape=(src.height, src.width))
+        for row in range(0, src.height, blockRows):
+            rows = min(blockRows, src.height - row)
+            out[row:row + rows] = src.read(1, window=Window(0, row, src.width, rows))
+        out.flush()
+        del out
+    os.replace(str(tmp), str(path(raster_path)))
+
+
+def load(raster_path, shape, dtype):
+    """Read-only memory map of the sidecar of ``raster_path``, or None if there is no sidecar, it is older
+    than the raster or it does not have the ``shape`` and ``dtype`` of the band"""
+    sidecar = path(raster_path)
+    try:
+        if os.stat(str(sidecar)).st_mtime_ns < os.stat(str(raster_path)).st_mtime_ns:
+            return None
+        array = np.load(str(sidecar), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+        return None
+    return array
@@ -0,0 +1,102 @@
+# ============ TESTS: DOWNLOAD CACHE =================
+
+# Expiry (TTL), least-recently-used eviction and size cap of the download cache (cache.py), and the
+# CLC image of 1_CLC_Clip.py, that must exist after it was written to the cache.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import os
+import sys
+import time
+import pathlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import cache
+
+# ================= TESTS =========================================
+
+
+def age(path, seconds):
+    """Set the access and modification times of ``path`` ``seconds`` in the past"""
+    t = time.time() - seconds
+    os.utime(str(path), (t, t))
+
+
+def test_hit_and_miss(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 1000)
+    key = c.key(url='a')
+    assert c.get(key) is None
+    path = c.put(key, b'data')
+    assert c.get(key) == path
+    assert c.fetch(key, lambda: pytest.fail("downloaded again")) == b'data'
+    assert c.fetch(c.key(url='b'), lambda: b'new') == b'new'
+    assert c.get(c.key(url='b')) is not None
+
+
+def test_disabled(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 0)
+    assert c.fetch(c.key(url='a'), lambda: b'data') == b'data'
+    assert c.get(c.key(url='a')) is None
+
+
+def test_expired_entries_are_misses(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 1000, ttl=60)
+    old, new = c.key(url='old'), c.key(url='new')
+    age(c.put(old, b'old'), 120)
+    c.put(new, b'new')
+    assert c.get(old) is None
+    assert not c.path(old).exists()
+    assert c.get(new) is not None
+
+
+def test_least_recently_used_entries_are_evicted_over_the_cap(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 35)
+    keys = [c.key(url=str(i)) for i in range(3)]
+    for i, key in enumerate(keys):
+        age(c.put(key, b'x' * 10), 100 - i)
+    # a hit makes the oldest entry the most recently used
+    assert c.get(keys[0]) is not None
+    c.put(c.key(url='3'), b'x' * 10)
+    assert [c.path(key).exists() for key in keys] == [True, False, True]
+    assert sum(p.stat().st_size for p in tmp_path.glob('*/*')) <= 35
+
+
+def test_entry_larger_than_the_cap_survives_its_write(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 10)
+    small = c.put(c.key(url='small'), b'x' * 5)
+    large = c.put(c.key(url='large'), b'x' * 100)
+    assert large.exists()
+    assert not small.exists()
+    # dropped by the next write
+    c.put(c.key(url='next'), b'x' * 5)
+    assert not large.exists()
+
+
+def test_failed_write_leaves_no_entry(tmp_path):
+    c = cache.DiskCache(str(tmp_path), 1000)
+    key = c.key(url='a')
+    with pytest.raises(RuntimeError):
+        with c.writer(key) as f:
+            f.write(b'partial')
+            raise RuntimeError("download failed")
+    assert c.get(key) is None
+    assert list(tmp_path.glob('*/*')) == []
+
+
+def test_clc_source_returns_an_existing_file(tmp_path, monkeypatch):
+    clc_clip = importlib.import_module('1_CLC_Clip')
+    monkeypatch.setattr(clc_clip, 'download_to_file', lambda url, f: f.write(b'x' * 100))
+    monkeypatch.setenv('GEOESSENTIAL_CACHE_DIR', str(tmp_path / 'cache'))
+    # the image is larger than the cap of the cache
+    monkeypatch.setenv('GEOESSENTIAL_CACHE_MAX_MB', str(10 / (1024. * 1024.)))
+    assert pathlib.Path(clc_clip.clc_source(tmp_path, 'clc.tif')).exists()
+    # cache entry evicted as soon as it is written (by a concurrent process)
+    monkeypatch.setenv('GEOESSENTIAL_CACHE_DIR', str(tmp_path / 'other'))
+    monkeypatch.setattr(cache.DiskCache, 'evict', lambda self, keep=None: self._remove(keep))
+    path = clc_clip.clc_source(tmp_path, 'clc.tif')
+    assert path == str(tmp_path / 'clc.tif')
+    assert pathlib.Path(path).exists()
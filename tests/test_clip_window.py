@@ -0,0 +1,80 @@
+# ============ TESTS: AOI WINDOWS =================
+
+# Clipping a raster to the window of an AOI (1_CLC_Clip.py) against rasterio.mask.mask(crop=True),
+# with AOIs whose bounds don't fall on the grid of the raster.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import sys
+import pathlib
+import importlib
+
+import numpy as np
+import pytest
+import rasterio
+import rasterio.mask
+from rasterio.transform import from_origin
+import shapely.geometry
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+clc_clip = importlib.import_module('1_CLC_Clip')
+
+# ================= TESTS =========================================
+
+# 100 m grid, as CLC
+TRANSFORM = from_origin(4000000, 3000000, 100, 100)
+WIDTH, HEIGHT = 60, 50
+
+
+@pytest.fixture
+def raster(tmp_path):
+    path = tmp_path / 'clc.tif'
+    profile = {'driver': 'GTiff', 'dtype': 'uint8', 'nodata': 0, 'count': 1, 'crs': 'EPSG:3035',
+               'width': WIDTH, 'height': HEIGHT, 'transform': TRANSFORM}
+    with rasterio.open(str(path), 'w', **profile) as dst:
+        dst.write_band(1, np.random.RandomState(0).randint(1, 45, (HEIGHT, WIDTH)).astype(np.uint8))
+    with rasterio.open(str(path)) as src:
+        yield src
+
+
+def aois(n=50):
+    """Random polygons off the grid, some of them partly outside the raster (none entirely)"""
+    rng = np.random.RandomState(1)
+    for i in range(n):
+        x, y = TRANSFORM * (rng.uniform(-3, WIDTH - 3), rng.uniform(-3, HEIGHT - 3))
+        w, h = rng.uniform(400, 2000, 2)
+        yield [shapely.geometry.mapping(shapely.geometry.box(x, y - h, x + w, y).buffer(rng.uniform(0, 300)))]
+
+
+def test_clip_window_equals_mask(raster):
+    for shapes in aois():
+        out_img, out_transform = clc_clip.clip_window(raster, shapes)
+        reference, reference_transform = rasterio.mask.mask(raster, shapes, crop=True)
+        assert out_transform == reference_transform
+        assert out_img.shape == reference.shape
+        assert np.array_equal(out_img, reference)
+
+
+def test_clip_array_equals_mask(raster):
+    # 2_City_Area.py needs the GDAL bindings (gdal, ogr, osr)
+    pytest.importorskip('gdal')
+    city_area = importlib.import_module('2_City_Area')
+    array = raster.read(1)
+    for shapes in aois():
+        out_img, out_profile = city_area.clip_array(array, raster.profile, shapes)
+        reference, reference_transform = rasterio.mask.mask(raster, shapes, crop=True)
+        assert out_profile['transform'] == reference_transform
+        assert np.array_equal(out_img, reference[0])
+
+
+def test_clip_blocks_equals_mask(raster, tmp_path):
+    pytest.importorskip('gdal')
+    city_area = importlib.import_module('2_City_Area')
+    for shapes in aois(10):
+        city_area.clip_blocks(raster.name, str(tmp_path / 'clip.tif'), shapes, 7)
+        reference, reference_transform = rasterio.mask.mask(raster, shapes, crop=True)
+        with rasterio.open(str(tmp_path / 'clip.tif')) as src:
+            assert src.transform == reference_transform
+            assert np.array_equal(src.read(), reference)
@@ -0,0 +1,75 @@
+# ============ TESTS: DISSOLVE =================
+
+# Partitioned union and difference of dissolve.py (sort-tile-recursive partitions unioned on several
+# processes) against a single shapely unary_union / difference, on overlapping polygons that cross the
+# borders of the partitions.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import sys
+import pathlib
+
+import numpy as np
+import pytest
+import shapely.affinity
+import shapely.geometry
+from shapely.ops import unary_union
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import dissolve
+
+# ================= TESTS =========================================
+
+PARTITION_SIZE = 25
+
+
+def shapes(n, seed, scale=1.0):
+    """``n`` overlapping discs and rotated rectangles in a 100 x 100 square, large enough to overlap the
+    shapes of neighbouring partitions (and some of them the whole square), with sizes multiplied by ``scale``"""
+    rng = np.random.RandomState(seed)
+    geometries = []
+    for i in range(n):
+        x, y = rng.uniform(0, 100, 2)
+        if i % 2:
+            geometries.append(shapely.geometry.Point(x, y).buffer(scale * rng.uniform(1, 6)))
+        else:
+            w, h = scale * rng.uniform(0.5, 4), scale * rng.uniform(2, 40 if i % 10 == 0 else 8)
+            box = shapely.geometry.box(x - w, y - h, x + w, y + h)
+            geometries.append(shapely.affinity.rotate(box, rng.uniform(0, 180)))
+    return geometries
+
+
+def assert_same(geometry, expected):
+    assert geometry.is_valid
+    assert geometry.area == pytest.approx(expected.area, rel=1e-9)
+    assert geometry.symmetric_difference(expected).area == pytest.approx(0, abs=1e-6 * expected.area)
+
+
+def test_partitions_cross_each_other():
+    geometries = shapes(400, 0)
+    partitions = dissolve.str_partitions(geometries, PARTITION_SIZE)
+    assert len(partitions) > 4
+    assert sorted(id(g) for p in partitions for g in p) == sorted(id(g) for g in geometries)
+    # the unions of neighbouring partitions overlap, their internal boundaries are merged by the last union
+    unions = [unary_union(p) for p in partitions]
+    assert any(a.intersection(b).area > 0 for i, a in enumerate(unions) for b in unions[i + 1:])
+
+
+@pytest.mark.parametrize('seed, scale', [(0, 1.0), (1, 1.0), (2, 0.3)])
+def test_dissolve_equals_unary_union(seed, scale):
+    geometries = shapes(400, seed, scale)
+    dissolved = dissolve.dissolve(geometries, maxWorkers=3, partitionSize=PARTITION_SIZE)
+    assert_same(dissolved, unary_union(geometries))
+    # the same union on one worker
+    assert_same(dissolve.dissolve(geometries, maxWorkers=1, partitionSize=PARTITION_SIZE), dissolved)
+
+
+def test_difference_equals_shapely_difference():
+    # sparse shapes, dissolved in many polygons
+    geometry = unary_union(shapes(400, 2, 0.3))
+    other = unary_union(shapes(200, 3, 0.5))
+    # enough polygons to be partitioned
+    assert len(dissolve.polygons(geometry)) > PARTITION_SIZE
+    difference = dissolve.difference(geometry, other, maxWorkers=3, partitionSize=PARTITION_SIZE)
+    assert_same(difference, geometry.difference(other))
@@ -0,0 +1,116 @@
+# ============ TESTS: BLOCK LABELLING =================
+
+# Connected components of 2_City_Area.py labelled in blocks of rows (label_blocks, cluster_id_blocks,
+# cluster_ids) against scipy.ndimage.label of the whole mask, on random masks whose components cross
+# the block borders. Skipped without the GDAL bindings (gdal, ogr, osr) that 2_City_Area.py imports.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import sys
+import pathlib
+import importlib
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import neighbourhood
+
+# ================= TESTS =========================================
+
+HEIGHT, WIDTH = 60, 47
+# a single row, blocks not dividing the height, and the whole mask in one block
+BLOCK_ROWS = [1, 3, 7, 25, HEIGHT]
+
+
+@pytest.fixture(scope='module')
+def city_area():
+    pytest.importorskip('gdal')
+    return importlib.import_module('2_City_Area')
+
+
+def masks():
+    """Random masks around the percolation threshold (components of every size, many of them crossing
+    the block borders), a mask of vertical stripes and a single component winding over all blocks"""
+    rng = np.random.RandomState(0)
+    for density in (0.3, 0.5, 0.6):
+        yield (rng.random_sample((HEIGHT, WIDTH)) < density).astype(np.uint8)
+    stripes = np.zeros((HEIGHT, WIDTH), np.uint8)
+    stripes[:, ::2] = 1
+    yield stripes
+    snake = stripes.copy()
+    snake[0, 1::4] = 1
+    snake[-1, 3::4] = 1
+    yield snake
+
+
+def reference(mask, connectivity):
+    structure = ndimage.generate_binary_structure(2, 1 if connectivity == 4 else 2)
+    return ndimage.label(mask, structure=structure)
+
+
+def block_labels(city_area, mask, blockRows, connectivity):
+    """Components of ``label_blocks`` as a raster of root labels, and their pixel counts"""
+    read = lambda row, rows: mask[row:row + rows]
+    offsets, roots, counts = city_area.label_blocks(read, HEIGHT, blockRows, connectivity)
+    labels = np.empty(mask.shape, np.int64)
+    for (row, rows, _, _), offset in zip(neighbourhood.row_blocks(HEIGHT, blockRows), offsets):
+        block, n = city_area.label_components(read(row, rows), connectivity)
+        block[block > 0] += offset
+        labels[row:row + rows] = roots[block]
+    return labels, counts
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('blockRows', BLOCK_ROWS)
+def test_label_blocks_equals_label(city_area, blockRows, connectivity):
+    for mask in masks():
+        expected, n = reference(mask, connectivity)
+        labels, counts = block_labels(city_area, mask, blockRows, connectivity)
+        assert np.array_equal(labels > 0, expected > 0)
+        # the same components: every component of ndimage.label is a single component of the blocks
+        pairs = np.unique(np.column_stack((expected[mask > 0], labels[mask > 0])), axis=0)
+        assert len(pairs) == n == len(np.unique(labels[mask > 0]))
+        # pixel counts indexed by the root labels
+        roots, pixels = np.unique(labels[mask > 0], return_counts=True)
+        assert np.array_equal(counts[roots], pixels)
+        assert counts.sum() == mask.sum()
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('blockRows', BLOCK_ROWS)
+def test_cluster_id_blocks_equals_label(city_area, blockRows, connectivity):
+    for mask in masks():
+        expected, n = reference(mask, connectivity)
+        sizes = np.bincount(expected.ravel())
+        read = lambda row, rows: mask[row:row + rows]
+        offsets, roots, counts = city_area.label_blocks(read, HEIGHT, blockRows, connectivity)
+        # clusters of at least 5 pixels of 1 m2
+        keep = city_area.select_components(counts, 1, 5e-6)
+        ids = np.concatenate([numbers for row, numbers in
+                              city_area.cluster_id_blocks(read, HEIGHT, blockRows, offsets, roots, keep, connectivity)])
+        assert ids.shape == mask.shape
+        if (sizes[1:] >= 5).any():
+            assert np.array_equal(ids > 0, (sizes[expected] >= 5) & (expected > 0))
+        # each cluster number is one component of ndimage.label, largest first
+        areas = []
+        for number in range(1, len(keep) + 1):
+            components = np.unique(expected[ids == number])
+            assert len(components) == 1
+            areas.append(sizes[components[0]])
+        assert areas == sorted(areas, reverse=True)
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+def test_cluster_ids_keeps_the_largest_component(city_area, connectivity):
+    for mask in masks():
+        expected, n = reference(mask, connectivity)
+        sizes = np.bincount(expected.ravel())
+        sizes[0] = 0
+        # blocks of 3 rows
+        ids, keep = city_area.cluster_ids(mask, 1, connectivity=connectivity, blockPixels=3 * WIDTH)
+        assert len(keep) == 1
+        assert (ids > 0).sum() == sizes.max()
+        assert len(np.unique(expected[ids > 0])) == 1
@@ -0,0 +1,62 @@
+# ============ TESTS: NEIGHBOURHOOD SUM =================
+
+# Neighbourhood sums of neighbourhood.py (both backends, split in strips on several threads, and computed
+# in blocks of rows) against scipy.ndimage.convolve of the whole image with a kernel of ones.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import sys
+import pathlib
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import neighbourhood
+
+# ================= TESTS =========================================
+
+# odd kernel sizes, and an even one (its extra pixel is after the centre)
+KERNELS = [1, 3, 5, 7, 11, 4]
+
+
+@pytest.fixture
+def img():
+    # a size that is not a multiple of the strips and blocks, built-up pixels along the borders too
+    return (np.random.RandomState(0).random_sample((97, 83)) < 0.4).astype(np.uint8)
+
+
+def reference(img, kernelSize):
+    kernel = np.ones((kernelSize, kernelSize), np.uint32)
+    return ndimage.convolve(img.astype(np.uint32), kernel, mode='constant')
+
+
+@pytest.mark.parametrize('kernelSize', KERNELS)
+@pytest.mark.parametrize('method', neighbourhood.METHODS)
+def test_neighbourhood_sum_equals_convolve(img, kernelSize, method):
+    sums = neighbourhood.neighbourhood_sum(img, kernelSize, method)
+    assert sums.dtype == neighbourhood.count_dtype(kernelSize)
+    np.testing.assert_array_equal(sums, reference(img, kernelSize))
+
+
+@pytest.mark.parametrize('kernelSize', [3, 5, 7])
+@pytest.mark.parametrize('method', neighbourhood.METHODS)
+@pytest.mark.parametrize('workers', [2, 3])
+def test_strips_equal_convolve(img, kernelSize, method, workers):
+    # the image is split in ``workers`` strips (at least 4 kernels high each)
+    assert min(workers, img.shape[0] // (4 * kernelSize)) == workers
+    sums = neighbourhood.neighbourhood_sum(img, kernelSize, method, workers)
+    np.testing.assert_array_equal(sums, reference(img, kernelSize))
+
+
+@pytest.mark.parametrize('kernelSize', KERNELS)
+@pytest.mark.parametrize('method', neighbourhood.METHODS)
+@pytest.mark.parametrize('blockRows', [1, 2, 10, 96, 200])
+def test_blocks_equal_convolve(img, kernelSize, method, blockRows):
+    # blocks shorter than the kernel reach, not dividing the height, and a single block
+    blocks = list(neighbourhood.neighbourhood_sum_blocks(lambda row, rows: img[row:row + rows], img.shape[0],
+                                                         kernelSize, blockRows, method, workers=2))
+    assert [row for row, sums in blocks] == list(range(0, img.shape[0], blockRows))
+    np.testing.assert_array_equal(np.concatenate([sums for row, sums in blocks]), reference(img, kernelSize))
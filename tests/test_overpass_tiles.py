@@ -0,0 +1,119 @@
+# ============ TESTS: OVERPASS TILES =================
+
+# Tiled Overpass queries of 3_OSM_Layers.py against the mock Overpass server
+# (benchmarks/mock_overpass.py) rejecting part of the requests with 429 / 504.
+
+# usage: python3 -m pytest tests
+
+# ============== IMPORTS =============================================
+import sys
+import pathlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / 'benchmarks'))
+import cache
+import mock_overpass
+
+osm = importlib.import_module('3_OSM_Layers')
+
+# ================= TESTS =========================================
+
+# 6 x 4 tiles of 0.01 degrees
+BBOX = (2.305, 48.845, 2.355, 48.875)
+QUERY = '[out:json];(way["highway"="residential"]({s}););out geom;'
+
+
+@pytest.fixture
+def overpass(monkeypatch):
+    server, url = mock_overpass.serve(waysPerCell=5, failRate=0.3)
+    monkeypatch.setitem(osm.Overpass, 'url', url)
+    monkeypatch.setitem(osm.Overpass, 'retries', 20)
+    monkeypatch.setitem(osm.Overpass, 'backoff', 0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def query(tileDegrees, monkeypatch):
+    monkeypatch.setitem(osm.Overpass, 'tileDegrees', tileDegrees)
+    # cache disabled, every tile is queried
+    return list(osm.query_tiles(QUERY, BBOX, cache.DiskCache('.', 0), withIds=True))
+
+
+def test_rejected_requests_are_retried(overpass, monkeypatch):
+    ways = query(0.01, monkeypatch)
+    assert overpass.rejected > 0
+    assert overpass.requests - overpass.rejected == len(osm.bbox_tiles(BBOX, 0.01)) == 24
+    assert ways
+
+
+def test_ways_crossing_tiles_are_yielded_once(overpass, monkeypatch):
+    ways = query(0.01, monkeypatch)
+    ids = [wayId for wayId, tags, coords in ways]
+    assert len(ids) == len(set(ids))
+    # ways crossing tile borders are returned by several tiles
+    returned = sum(len(mock_overpass.query_elements(QUERY.format(s='{1},{0},{3},{2}'.format(*tile)), 5))
+                   for tile in osm.bbox_tiles(BBOX, 0.01))
+    assert returned > len(ids)
+
+
+def test_tiled_query_equals_single_query(overpass, monkeypatch):
+    tiled = query(0.01, monkeypatch)
+    single = query(1, monkeypatch)
+    assert len(osm.bbox_tiles(BBOX, 1)) == 1
+    assert {wayId for wayId, tags, coords in tiled} == {wayId for wayId, tags, coords in single}
+    coords = {wayId: c.tolist() for wayId, tags, c in single}
+    assert all(coords[wayId] == c.tolist() for wayId, tags, c in tiled)
+
+
+def test_connection_errors_are_retried(monkeypatch):
+    calls = []
+
+    class Session:
+        def get(self, *args, **kwargs):
+            calls.append(kwargs.get('timeout'))
+            if len(calls) < 3:
+                raise osm.requests.exceptions.ReadTimeout('stalled')
+            return osm.requests.get(*args, **kwargs)
+
+    server, url = mock_overpass.serve(waysPerCell=5)
+    monkeypatch.setitem(osm.Overpass, 'backoff', 0)
+    try:
+        response = osm.overpass_request(Session(), url, QUERY.format(s='48.84,2.30,48.85,2.31'))
+        assert response.status_code == 200
+        response.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(calls) == 3
+    assert all(timeout == osm.Overpass['timeout'] for timeout in calls)
+
+
+def test_refresh_queries_again_and_replaces_the_cache(overpass, monkeypatch, tmp_path):
+    monkeypatch.setitem(osm.Overpass, 'tileDegrees', 0.01)
+    queryCache = cache.DiskCache(str(tmp_path), 1 << 30)
+
+    def served(refresh):
+        before = overpass.requests - overpass.rejected
+        ways = list(osm.query_tiles(QUERY, BBOX, queryCache, withIds=True, refresh=refresh))
+        return overpass.requests - overpass.rejected - before, ways
+
+    queried, ways = served(False)
+    assert queried == 24
+    assert served(False)[0] == 0
+    queried, refreshed = served(True)
+    assert queried == 24
+    assert ways
+    assert {wayId for wayId, tags, coords in refreshed} == {wayId for wayId, tags, coords in ways}
+    # the new responses are cached
+    assert served(False)[0] == 0
+
+
+@pytest.mark.parametrize('value, refresh', [('1', True), ('true', True), ('Yes', True), ('', False),
+                                            ('0', False), ('false', False), ('no', False)])
+def test_refresh_requested(value, refresh, monkeypatch):
+    monkeypatch.setenv('OSM_REFRESH', value)
+    assert osm.refresh_requested() == refresh
@@ -0,0 +1,219 @@
+# ============ URBAN-NESS TILES =================
+
+# shared module for 11.7.1 indicator scripts
+
+# Offline build of the built-up mask and of the urban-ness classes of 2_City_Area.py over a large
+# extent (EEA-39 by default), once for all cities. The extent is cut in tiles on a fixed EPSG:3035
+# grid; every tile is computed from the CLC and HRL of the tile plus a halo of the kernel reach, so
+# the classes of neighbouring tiles join seamlessly (as one neighbourhood sum over the whole extent).
+# Tiles without CLC urban classes are not built and their HRL is not downloaded.
+# Every tile is written as an internally tiled, DEFLATE-compressed GeoTIFF with 2 bands (1 built-up
+# mask, 2 urban-ness classes) and all tiles are indexed by a VRT (urbanness.vrt). tiles.json lists
+# the finished tiles (saved every MANIFEST_SECONDS), so an interrupted build resumes close to where
+# it stopped.
+
+# At query time (URBANNESS_TILES=<path of urbanness.vrt>) 2_City_Area.py and pipeline.py read only the
+# blocks of the tiles that intersect the AOI, instead of downloading HRL, clipping CLC and computing
+# the neighbourhood sum. The classes then come from the neighbourhood of every pixel over the whole
+# extent, also for pixels near the border of the AOI (where a per-AOI run sees no built-up pixels
+# beyond the AOI); the built-up mask and the classes are set to 0 outside the AOI.
+
+# usage: python3 urbanness_tiles.py --out tiles [--bounds xmin ymin xmax ymax] [--pixel-size 10]
+#                                   [--tile-km 25] [--workers 2]
+#        URBANNESS_TILES=tiles/urbanness.vrt python3 pipeline.py
+
+# ============== IMPORTS =============================================
+import os
+import json
+import time
+import pathlib
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.features
+from rasterio.errors import WindowError
+from rasterio.transform import from_origin
+import gdal
+
+import neighbourhood
+import raster_windows
+
+# ================= FUNCTIONS =========================================
+
+# EEA-39 extent in EPSG:3035 (approximate, rounded outwards to 100 km)
+EEA39_BOUNDS = (900000, 900000, 7400000, 5500000)
+
+VRT = 'urbanness.vrt'
+MANIFEST = 'tiles.json'
+# seconds between two saves of the manifest while tiles are built
+MANIFEST_SECONDS = 30
+BUILTUP_BAND, CLASSES_BAND = 1, 2
+
+
+def tile_name(tile):
+    """File name of the tile with bounds ``tile`` (named after its lower left corner in km)"""
+    return 'urbanness_E{x}N{y}.tif'.format(x=int(tile[0] // 1000), y=int(tile[1] // 1000))
+
+
+def tiles(bounds, pixelSize, tileKm):
+    """Tiles of ``tileKm`` km on the fixed EPSG:3035 grid covering ``bounds``: list of
+    (xmin, ymin, xmax, ymax, width, height) tuples (see 0_Download_data.tile_grid)"""
+    download = importlib.import_module('0_Download_data')
+    return download.tile_grid(bounds[0], bounds[1], bounds[2], bounds[3], pixelSize,
+                              int(round(tileKm * 1000. / pixelSize)))
+
+
+def build_tile(args):
+    """Built-up mask and urban-ness classes of one tile, written to ``outDir``.
+    Returns the file name, or None if the tile (with its halo) has no CLC urban classes."""
+    tile, pixelSize, clc_path, outDir, maxWorkers, neighbourhoodMethod = args
+    download = importlib.import_module('0_Download_data')
+    city_area = importlib.import_module('2_City_Area')
+
+    kernelSize = neighbourhood.kernel_size(pixelSize)
+    halo = max(neighbourhood.kernel_reach(kernelSize))
+    xmin, ymin, xmax, ymax = (tile[0] - halo * pixelSize, tile[1] - halo * pixelSize,
+                              tile[2] + halo * pixelSize, tile[3] + halo * pixelSize)
+    profile = {'driver': 'GTiff', 'dtype': 'uint8', 'nodata': None, 'count': 1,
+               'crs': rasterio.crs.CRS.from_epsg(3035), 'transform': from_origin(xmin, ymax, pixelSize, pixelSize),
+               'width': tile[4] + 2 * halo, 'height': tile[5] + 2 * halo}
+
+    # CLC urban classes on the HRL grid of the tile with its halo
+    with rasterio.open(str(clc_path)) as clc_ds, city_area.warped_to_master(clc_ds, profile) as clc_res_ds:
+        clc_urban = city_area.urban_classes(clc_res_ds.read(1))
+    if not clc_urban.any():
+        return None
+
+    mosaic, out_meta = download.get_tiled_from_rest(xmin, ymin, xmax, ymax, pixelSize, "Imperviousness2018",
+                                                    maxWorkers)
+    hrl = mosaic[0]
+    del mosaic
+    if hrl.shape != clc_urban.shape:
+        raise ValueError("HRL of tile {t} is {h}, expected {c}".format(t=tile_name(tile), h=hrl.shape,
+                                                                      c=clc_urban.shape))
+
+    builtup = city_area.builtup_mask(clc_urban, hrl, out=clc_urban if clc_urban.dtype == np.uint8 else None)
+    del hrl
+    classes = city_area.urbanness_classes(neighbourhood.neighbourhood_sum(builtup, kernelSize, neighbourhoodMethod),
+                                          kernelSize)
+
+    # drop the halo
+    inner = (slice(halo, halo + tile[5]), slice(halo, halo + tile[4]))
+    profile.update({'count': 2, 'width': tile[4], 'height': tile[5],
+                    'transform': from_origin(tile[0], tile[3], pixelSize, pixelSize),
+                    'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate'})
+    name = tile_name(tile)
+    tmp = pathlib.Path(outDir) / (name + '.tmp')
+    with rasterio.open(str(tmp), 'w', **profile) as dst:
+        dst.write(builtup[inner], BUILTUP_BAND)
+        dst.write(classes[inner], CLASSES_BAND)
+    os.replace(str(tmp), str(pathlib.Path(outDir) / name))
+    return name
+
+
+def load_manifest(outDir):
+    try:
+        with open(str(pathlib.Path(outDir) / MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(outDir, manifest):
+    tmp = pathlib.Path(outDir) / (MANIFEST + '.tmp')
+    with open(str(tmp), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(str(tmp), str(pathlib.Path(outDir) / MANIFEST))
+
+
+def build(outDir, clc_path, bounds=EEA39_BOUNDS, pixelSize=10, tileKm=25, workers=2, maxWorkers=4,
+          neighbourhoodMethod='sat'):
+    """Build (or resume building) the urban-ness tiles of ``bounds`` in ``outDir``, ``workers`` tiles at a
+    time, and index them with a VRT. Returns the path of the VRT."""
+    outDir = pathlib.Path(outDir)
+    outDir.mkdir(parents=True, exist_ok=True)
+
+    manifest = load_manifest(outDir)
+    settings = {'pixelSize': pixelSize, 'tileKm': tileKm}
+    if manifest.get('settings', settings) != settings:
+        raise ValueError("{d} holds tiles built with {m}, not {s}".format(d=outDir, m=manifest['settings'],
+                                                                         s=settings))
+    manifest['settings'] = settings
+    done = manifest.setdefault('tiles', {})
+
+    todo = [t for t in tiles(bounds, pixelSize, tileKm) if tile_name(t) not in done]
+    print("{n} tile(s) to build, {d} already done ...".format(n=len(todo), d=len(done)))
+    tasks = [(t, pixelSize, clc_path, str(outDir), maxWorkers, neighbourhoodMethod) for t in todo]
+    # the manifest grows with the tiles, so it is saved every MANIFEST_SECONDS instead of after every tile
+    # (and when the build ends or fails); a resume builds the tiles finished since the last save again
+    saved = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for tile, name in zip(todo, executor.map(build_tile, tasks)):
+                # empty tiles are recorded too, so they are not checked again
+                done[tile_name(tile)] = name is not None
+                if time.time() - saved >= MANIFEST_SECONDS:
+                    save_manifest(outDir, manifest)
+                    saved = time.time()
+                print("{t}: {s}".format(t=tile_name(tile), s='built' if name else 'no urban classes'))
+    finally:
+        save_manifest(outDir, manifest)
+
+    built = [str(outDir / name) for name, written in sorted(done.items()) if written]
+    vrt_path = outDir / VRT
+    if not built:
+        raise ValueError("No tile of {b} has CLC urban classes".format(b=bounds))
+    gdal.BuildVRT(str(vrt_path), built)
+    return vrt_path
+
+
+def read_aoi(tiles_path, aoi):
+    """Built-up mask and urban-ness classes of the ``aoi`` GeoDataFrame from the tiles (``tiles_path``, the VRT
+    or any raster with the same bands), reading only the window of the AOI bounds. Pixels outside the AOI
+    are set to 0. Returns the two uint8 arrays and their profile."""
+    with rasterio.open(str(tiles_path)) as src:
+        aoi = aoi.to_crs(src.crs.to_wkt())
+        shapes = list(aoi.geometry)
+        try:
+            window = raster_windows.aoi_window(shapes, src.transform, src.width, src.height)
+        except WindowError:
+            raise ValueError("AOI outside the urban-ness tiles {p}".format(p=tiles_path))
+        builtup, classes = src.read([BUILTUP_BAND, CLASSES_BAND], window=window)
+        transform = src.window_transform(window)
+        crs = src.crs
+
+    outside = rasterio.features.geometry_mask(shapes, out_shape=builtup.shape, transform=transform)
+    builtup[outside] = 0
+    classes[outside] = 0
+
+    profile = {"driver": "GTiff", "dtype": 'uint8', "nodata": None, "count": 1, "crs": crs,
+               "height": builtup.shape[0], "width": builtup.shape[1], "transform": transform}
+    return builtup, classes, profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the urban-ness tiles (built-up mask and urban-ness classes) '
+                                                 'of a large extent')
+    parser.add_argument('--out', default='tiles', help='directory of the tiles')
+    parser.add_argument('--bounds', type=float, nargs=4, default=list(EEA39_BOUNDS),
+                        help='EPSG:3035 xmin ymin xmax ymax (default: EEA-39)')
+    parser.add_argument('--pixel-size', type=int, default=10, help='HRL pixel size in meters')
+    parser.add_argument('--tile-km', type=float, default=25, help='side of the tiles in km')
+    parser.add_argument('--workers', type=int, default=2, help='tiles built in parallel')
+    parser.add_argument('--max-workers', type=int, default=4, help='HRL requests in parallel per tile')
+    args = parser.parse_args()
+
+    pathlib.Path(args.out).mkdir(parents=True, exist_ok=True)
+    clc_clip = importlib.import_module('1_CLC_Clip')
+    clc_path = clc_clip.clc_source(pathlib.Path(args.out), 'CLC2018_1,2,3,10,11.tif', os.environ.get('CLC_PATH', ''))
+    vrt_path = build(args.out, clc_path, tuple(args.bounds), args.pixel_size, args.tile_km, args.workers,
+                     args.max_workers)
+    print("Tiles indexed by {p} (set URBANNESS_TILES to this path)".format(p=vrt_path))
+
+
+if __name__ == '__main__':
+    main()